@@ -0,0 +1,46 @@
+"""
+Compare the throughput and latency of the anonymiser backends.
+
+  python benchmarks/bench_anonymise.py
+
+The Comprehend backend is only measured when AWS credentials are configured.
+"""
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from utils.anonymise import Anonymiser, ComprehendAnonymiser, LocalAnonymiser
+
+TEXTS = int(os.getenv("BENCH_TEXTS", "2000"))
+COMPREHEND_TEXTS = int(os.getenv("BENCH_COMPREHEND_TEXTS", "20"))
+
+SAMPLE = (
+  "Hi, this is Mr John Tan, my NRIC is S1234567D. Please call me at +65 9123 4567 or email "
+  "john.tan@example.com. My card 4111 1111 1111 1111 was charged twice for the delivery to "
+  "Blk 123 #05-67, 10 Orchard Road, Singapore 238801. "
+)
+
+def measure(label: str, anonymiser: Anonymiser, texts: int) -> None:
+  latencies = []
+  for i in range(texts):
+    text = SAMPLE * (1 + i % 10)
+    start = time.perf_counter()
+    anonymiser.anonymise(text)
+    latencies.append(time.perf_counter() - start)
+  total = sum(latencies)
+  latencies.sort()
+  p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+  print(f"{label:>10}: {texts / total:10.1f} texts/s, p50 {statistics.median(latencies) * 1000:8.3f} ms, p99 {p99 * 1000:8.3f} ms")
+
+def main() -> None:
+  measure("local", LocalAnonymiser(), TEXTS)
+  if os.getenv("AWS_ACCESS_KEY_ID"):
+    measure("comprehend", ComprehendAnonymiser(), COMPREHEND_TEXTS)
+  else:
+    print("comprehend: skipped, AWS_ACCESS_KEY_ID is not set")
+
+if __name__ == "__main__":
+  main()
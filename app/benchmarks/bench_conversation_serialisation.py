@@ -0,0 +1,87 @@
+"""
+Measure the per-message CPU cost of turning the documents of a conversation read into a JSON response.
+
+Compares the model path GET /conversations/{id} used before, which built Beanie documents, converted
+them to PromptRead and ConversationFull, and let FastAPI validate and serialise the result, with the raw
+path that returns the Motor dicts and serialises them with orjson. The database is mocked with
+mongomock_motor, as only the work done on the documents after they are read is measured:
+
+  python benchmarks/bench_conversation_serialisation.py
+"""
+import asyncio
+import copy
+import json
+import os
+import sys
+import time
+from uuid import uuid4
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import orjson
+from beanie import init_beanie
+from mongomock_motor import AsyncMongoMockClient
+from pydantic import TypeAdapter
+from models.models import Conversation, Prompt
+from models.schemas import ConversationFull, PromptRead
+from db.db_conversations import raw_conversation_full, raw_message
+
+MESSAGES = int(os.getenv("BENCH_MESSAGES", "5000"))
+ROUNDS = int(os.getenv("BENCH_ROUNDS", "5"))
+
+response_adapter = TypeAdapter(ConversationFull)
+
+def model_path(db_conversation: dict, db_prompts: list) -> bytes:
+  # Beanie parses every prompt document, then the previous build_conversation_full converted them
+  prompts = [Prompt.model_validate(db_prompt) for db_prompt in db_prompts]
+  conversation = ConversationFull(
+    id=db_conversation["_id"],
+    name=db_conversation["name"],
+    params=db_conversation["params"],
+    tokens=db_conversation["tokens"],
+    messages=[PromptRead.model_validate(prompt.dict(by_alias=True)) for prompt in prompts]
+  )
+  # FastAPI validates the returned value against the response model, serialises it and renders it with json
+  validated = response_adapter.validate_python(conversation)
+  content = response_adapter.dump_python(validated, mode="json", by_alias=True, exclude_none=True)
+  return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+def raw_path(db_conversation: dict, db_prompts: list) -> bytes:
+  return orjson.dumps(raw_conversation_full(db_conversation, [raw_message(db_prompt) for db_prompt in db_prompts]))
+
+def report(label: str, elapsed: float) -> None:
+  print(f"{label:>12}: {elapsed * 1000:8.1f} ms per read, {elapsed / MESSAGES * 1e6:6.2f} us/message")
+
+async def main() -> None:
+  await init_beanie(database=AsyncMongoMockClient()["benchmark"], document_models=[Conversation, Prompt])
+
+  conversation_id = str(uuid4())
+  db_conversation = {"_id": conversation_id, "name": "benchmark", "params": {"temperature": 0.7}, "tokens": MESSAGES * 20}
+  db_prompts = [
+    {
+      "_id": str(uuid4()),
+      "role": "user" if i % 2 else "assistant",
+      "content": "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * (1 + i % 8),
+      "conversation_id": conversation_id,
+      "sequence": i + 1,
+      "tokens": 20
+    }
+    for i in range(MESSAGES)
+  ]
+  # the raw path reads these fields only
+  projected_prompts = [{key: value for key, value in db_prompt.items() if key != "conversation_id"} for db_prompt in db_prompts]
+
+  assert json.loads(model_path(dict(db_conversation), db_prompts)) == json.loads(raw_path(dict(db_conversation), copy.deepcopy(projected_prompts)))
+
+  for label, path, prompts in [("model path", model_path, db_prompts), ("raw path", raw_path, projected_prompts)]:
+    best = float("inf")
+    for _ in range(ROUNDS):
+      # both paths get fresh documents, as they would from a read
+      conversation, documents = dict(db_conversation), copy.deepcopy(prompts)
+      start = time.perf_counter()
+      path(conversation, documents)
+      best = min(best, time.perf_counter() - start)
+    report(label, best)
+
+if __name__ == "__main__":
+  asyncio.run(main())
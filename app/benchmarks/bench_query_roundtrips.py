@@ -0,0 +1,106 @@
+"""
+Count the MongoDB round trips made by the database side of one /query turn.
+
+Compares the original read-modify-save write path, the sequenced append path used by
+create_prompt, and the batched turn written by the query pipeline. Requires a running MongoDB:
+
+  MONGODB_URI=mongodb://localhost:27017 python benchmarks/bench_query_roundtrips.py
+"""
+import asyncio
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from beanie import init_beanie
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import monitoring
+from models.models import Conversation, Prompt
+from db.db_conversations import add_message_to_conversation, get_conversation_full
+from db.db_query import save_prompts
+
+TURNS = int(os.getenv("BENCH_TURNS", "50"))
+
+class CommandCounter(monitoring.CommandListener):
+  def __init__(self) -> None:
+    self.commands = Counter()
+
+  def started(self, event) -> None:
+    self.commands[event.command_name] += 1
+
+  def succeeded(self, event) -> None:
+    pass
+
+  def failed(self, event) -> None:
+    pass
+
+async def legacy_turn_message(conversation_id: str, role: str, content: str, with_history: bool) -> None:
+  # The original write path: insert the prompt, fetch the conversation, append to its `messages`
+  # array, rewrite the whole document, then read the conversation again and all of its prompts
+  conversations = Conversation.get_motor_collection()
+  prompts = Prompt.get_motor_collection()
+  prompt = Prompt(role=role, content=content, conversation_id=conversation_id)
+  await prompts.insert_one(prompt.model_dump(by_alias=True))
+  db_conversation = await conversations.find_one({"_id": conversation_id})
+  db_conversation.setdefault("messages", []).append(prompt.id)
+  db_conversation["tokens"] += 5
+  await conversations.replace_one({"_id": conversation_id}, db_conversation)
+  await conversations.find_one({"_id": conversation_id})
+  await prompts.find({"conversation_id": conversation_id}).to_list(None)
+
+async def sequenced_turn_message(conversation_id: str, role: str, content: str, with_history: bool) -> None:
+  # The current write path used by create_prompt, followed by the ordered history read
+  sequence = await add_message_to_conversation(conversation_id, 5)
+  await Prompt(role=role, content=content, conversation_id=conversation_id, sequence=sequence).insert()
+  if with_history:
+    await get_conversation_full(conversation_id)
+
+async def per_message_turn(turn_message, conversation_id: str, turn: int) -> None:
+  await turn_message(conversation_id, "user", f"question {turn}", True)
+  await turn_message(conversation_id, "assistant", f"answer {turn}", False)
+
+async def legacy_turn(conversation_id: str, turn: int) -> None:
+  await per_message_turn(legacy_turn_message, conversation_id, turn)
+
+async def sequenced_turn(conversation_id: str, turn: int) -> None:
+  await per_message_turn(sequenced_turn_message, conversation_id, turn)
+
+async def batched_turn(conversation_id: str, turn: int) -> None:
+  # The query pipeline's path: read the history, then save the query and the response together
+  await get_conversation_full(conversation_id)
+  await save_prompts(conversation_id, [
+    Prompt(role="user", content=f"question {turn}", conversation_id=conversation_id, tokens=5),
+    Prompt(role="assistant", content=f"answer {turn}", conversation_id=conversation_id, tokens=5)
+  ])
+
+async def run_turns(run_turn, counter: CommandCounter) -> float:
+  conversation = Conversation(name="benchmark", params={})
+  await conversation.insert()
+  counter.commands.clear()
+  start = time.perf_counter()
+  for turn in range(TURNS):
+    await run_turn(conversation.id, turn)
+  return time.perf_counter() - start
+
+async def main() -> None:
+  counter = CommandCounter()
+  client = AsyncIOMotorClient(os.environ["MONGODB_URI"], event_listeners=[counter])
+  database = client[os.getenv("MONGODB_NAME", "benchmark_roundtrips")]
+  await init_beanie(database=database, document_models=[Conversation, Prompt])
+
+  for label, run_turn in [
+    ("read-modify-save", legacy_turn),
+    ("sequenced append", sequenced_turn),
+    ("batched turn", batched_turn),
+  ]:
+    elapsed = await run_turns(run_turn, counter)
+    total = sum(counter.commands.values())
+    print(f"{label:>18}: {total / TURNS:5.1f} round trips/turn, {elapsed / TURNS * 1000:7.2f} ms/turn {dict(counter.commands)}")
+
+  await client.drop_database(database.name)
+  client.close()
+
+if __name__ == "__main__":
+  asyncio.run(main())
@@ -0,0 +1,54 @@
+"""
+Compare the token counting throughput of the previous per-call tokenizer with utils.token_counter.
+
+  python benchmarks/bench_token_counter.py
+
+tiktoken downloads the encoding on first use, so run it once with network access.
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import tiktoken
+from models.schemas import PromptCreate
+from utils.token_counter import count_message_tokens, count_messages_tokens, get_encoding
+
+MESSAGES = int(os.getenv("BENCH_MESSAGES", "2000"))
+
+def legacy_count_message_tokens(message: PromptCreate, model: str = "gpt-3.5-turbo") -> int:
+  # The previous implementation: look up the encoding on every call, for both content and role
+  encoder = tiktoken.encoding_for_model(model)
+  tokens = len(encoder.encode(message.content))
+  encoder = tiktoken.encoding_for_model(model)
+  return tokens + len(encoder.encode(message.role))
+
+def report(label: str, elapsed: float) -> None:
+  print(f"{label:>28}: {elapsed * 1000:8.1f} ms total, {elapsed / MESSAGES * 1e6:8.1f} us/message")
+
+async def main() -> None:
+  messages = [
+    PromptCreate(role="user" if i % 2 else "assistant", content=("Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * (1 + i % 40)))
+    for i in range(MESSAGES)
+  ]
+  # load the encoding before timing anything
+  get_encoding()
+
+  start = time.perf_counter()
+  for message in messages:
+    legacy_count_message_tokens(message)
+  report("legacy per-message", time.perf_counter() - start)
+
+  start = time.perf_counter()
+  for message in messages:
+    await count_message_tokens(message)
+  report("cached per-message", time.perf_counter() - start)
+
+  start = time.perf_counter()
+  await count_messages_tokens(messages)
+  report("cached batch (thread pool)", time.perf_counter() - start)
+
+if __name__ == "__main__":
+  asyncio.run(main())
@@ -1,12 +1,16 @@
 from motor.motor_asyncio import AsyncIOMotorClient
 import os
 from beanie import init_beanie
-from models.models import Conversation, Prompt 
+from models.models import Conversation, Prompt, CompletionCacheEntry, IdempotencyRecord, QueryJob
+from db.migrations import migrate_message_sequences, migrate_prompt_tokens
+from utils.metrics import mongo_command_metrics
 import logging
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+DOCUMENT_MODELS = [Conversation, Prompt, CompletionCacheEntry, IdempotencyRecord, QueryJob]
+
 # Store client and database globally but don't initialize them immediately
 client = None
 database = None
@@ -20,7 +24,8 @@ def get_database():
     if client is None:
         MONGO_URI = os.environ.get("MONGODB_URI")
         MONGODB_NAME = os.environ.get("MONGODB_NAME")
-        client = AsyncIOMotorClient(MONGO_URI)
+        # every command is timed for the mongo_command_seconds metric
+        client = AsyncIOMotorClient(MONGO_URI, event_listeners=[mongo_command_metrics])
         database = client[MONGODB_NAME]
     return database
 
@@ -28,12 +33,27 @@ async def init_db() -> None:
     try:
         # Initialize the database only when this function is called
         db = get_database()
-        await init_beanie(database=db, document_models=[Conversation, Prompt])
+        await init_beanie(database=db, document_models=DOCUMENT_MODELS)
         logger.info("Beanie initialization completed")
+        await verify_indexes()
+        await migrate_message_sequences()
+        await migrate_prompt_tokens()
     except Exception as e:
         logger.error(f"Failed to initialize Beanie: {str(e)}")
         raise
 
+async def verify_indexes() -> None:
+    """
+    Check that every index declared on the document models exists.
+    init_beanie creates missing indexes, so a missing index here means creation failed.
+    """
+    for model in DOCUMENT_MODELS:
+        existing = await model.get_motor_collection().index_information()
+        missing = [index.name for index in model.get_settings().indexes if index.name not in existing]
+        if missing:
+            raise RuntimeError(f"Missing indexes on {model.get_motor_collection().name}: {', '.join(missing)}")
+        logger.info(f"Verified indexes on {model.get_motor_collection().name}: {', '.join(existing)}")
+
 def close_connection() -> None:
     if client:
         client.close()
@@ -1,12 +1,22 @@
 from models.models import Conversation, Prompt, QueryRoleType
-from models.schemas import ConversationCreate, ConversationUpdate, ConversationFull, PromptRead, ConversationRead
+from models.schemas import ConversationCreate, ConversationUpdate, ConversationFull, PromptRead
 from beanie.exceptions import DocumentNotFound
-from beanie import Link
+from pymongo import ReturnDocument, ASCENDING, DESCENDING
+from utils.conversation_cache import ConversationCache
+import asyncio
 import logging
-from typing import List
+import os
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
+CONVERSATION_CACHE_SIZE = int(os.getenv('CONVERSATION_CACHE_SIZE', '1000'))
+CONVERSATION_CACHE_MAX_BYTES = int(os.getenv('CONVERSATION_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# assembled histories of recently read conversations
+conversation_cache = ConversationCache(CONVERSATION_CACHE_SIZE, CONVERSATION_CACHE_MAX_BYTES)
+
 async def create_conversation(conversation: ConversationCreate) ->  str:
   """
   Create a new conversation in the database
@@ -35,57 +45,169 @@ async def create_conversation(conversation: ConversationCreate) ->  str:
     logger.error(f"Database error creating conversation: {str(e)}")
     raise
 
-async def get_conversation(conversation_id: str) -> ConversationFull:
+async def get_conversation(conversation_id: str) -> Dict[str, Any]:
   """
   Get a conversation by id and return its full conversation history
 
+  The history is read through conversation_cache like get_conversation_full's, and returned as plain
+  dicts in the shape of ConversationFull, without building documents or models, to be serialised as they are.
+
   Args:
     conversation_id (str): The unique identifier for the conversation
 
   Returns:
-    ConversationFull: The conversation with the given id and its full conversation history
+    Dict[str, Any]: The conversation with the given id and its full conversation history, in the shape of ConversationFull
 
   Raises:
     - DocumentNotFound: If the conversation is not found
   """
   try:
-    db_conversation = await Conversation.get(conversation_id, fetch_links=True)
-    if db_conversation is None:
-      raise DocumentNotFound(f"Conversation with ID {conversation_id} not found")
-    
+    db_conversation, cached_messages, _, db_prompts = await read_conversation_history(conversation_id)
+    messages = [prompt_read_dict(message) for message in cached_messages]
+    messages.extend(raw_message(db_prompt) for db_prompt in db_prompts)
+
     # return the conversation
-    return await get_conversation_full(db_conversation.id)
+    return raw_conversation_full(db_conversation, messages)
   except DocumentNotFound as e:
     logger.error(f"Document not found getting conversation {conversation_id}: {str(e)}")
     raise
   
-async def get_all_conversations() -> List[ConversationRead]:
+async def conversation_exists(conversation_id: str) -> bool:
   """
-  Get all conversations and return the conversations details without the conversation history
+  Check that a conversation exists without reading it
+  """
+  return await Conversation.get_motor_collection().count_documents({"_id": conversation_id}, limit=1) > 0
+
+CONVERSATION_READ_PROJECTION = {"name": 1, "params": 1, "tokens": 1}
+# what a read of the full history needs to check the cached history is current
+CONVERSATION_HISTORY_PROJECTION = {**CONVERSATION_READ_PROJECTION, "version": 1, "message_count": 1}
+# the fields of PromptRead, which hot reads return straight from Motor
+MESSAGE_READ_PROJECTION = {"role": 1, "content": 1, "sequence": 1, "tokens": 1}
+# the fields that change whenever a conversation read would return something different
+CONVERSATION_STAMP_PROJECTION = {"version": 1, "stored_messages": 1, "updated_at": 1}
+
+async def get_conversation_stamp(conversation_id: str) -> Dict[str, Any]:
+  """
+  Get what identifies the current state of a conversation, without reading its messages
 
   Returns:
-    List[ConversationRead]: The conversations with the given id and its full conversation history
+    Dict[str, Any]: The conversation's version, stored message count and last update time
+
+  Raises:
+    - DocumentNotFound: If the conversation is not found
+  """
+  stamp = await Conversation.get_motor_collection().find_one({"_id": conversation_id}, CONVERSATION_STAMP_PROJECTION)
+  if stamp is None:
+    raise DocumentNotFound(f"Conversation with ID {conversation_id} not found")
+  return stamp
+
+async def get_conversation_stamps(limit: Optional[int] = None, after: Optional[str] = None) -> List[Dict[str, Any]]:
+  """
+  Get the stamps of the conversations in a page of get_all_conversations, see get_conversation_stamp
+  """
+  cursor = Conversation.get_motor_collection().find(
+    conversation_page_filter(after), CONVERSATION_STAMP_PROJECTION
+  ).sort("_id", ASCENDING)
+  if limit is not None:
+    cursor = cursor.limit(limit)
+  return await cursor.to_list(length=None)
+
+def conversation_page_filter(after: Optional[str]) -> Dict[str, Any]:
+  """
+  Build the keyset filter that starts a page right after the given conversation id
+  """
+  return {"_id": {"$gt": after}} if after is not None else {}
+
+def raw_conversation_read(db_conversation: Dict[str, Any]) -> Dict[str, Any]:
+  """
+  Fill in the defaults ConversationRead would give a raw conversation document read with CONVERSATION_READ_PROJECTION
+  """
+  db_conversation.setdefault("tokens", 0)
+  return db_conversation
+
+def raw_message(db_prompt: Dict[str, Any]) -> Dict[str, Any]:
+  """
+  Build a prompt document read with MESSAGE_READ_PROJECTION into PromptRead's serialised shape, fields in the same order
+  """
+  return {
+    "role": db_prompt["role"],
+    "content": db_prompt["content"],
+    "_id": db_prompt["_id"],
+    "sequence": db_prompt.get("sequence", 0),
+    "tokens": db_prompt.get("tokens", 0)
+  }
+
+def prompt_read_dict(message: PromptRead) -> Dict[str, Any]:
+  """
+  Build a cached PromptRead into the dict raw_message builds, cheaper than dumping the model
+  """
+  return {"role": message.role, "content": message.content, "_id": message.id, "sequence": message.sequence, "tokens": message.tokens}
+
+def raw_conversation_full(db_conversation: Dict[str, Any], messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+  """
+  Assemble a raw conversation document, read with CONVERSATION_READ_PROJECTION, and messages built by
+  raw_message in the shape and field order ConversationFull is serialised in, so the response is byte
+  for byte the one the model would give
+  """
+  return {
+    "_id": db_conversation["_id"],
+    "name": db_conversation["name"],
+    "params": db_conversation.get("params", {}),
+    "tokens": db_conversation.get("tokens", 0),
+    "messages": messages
+  }
+
+async def get_all_conversations(limit: Optional[int] = None, after: Optional[str] = None) -> List[Dict[str, Any]]:
+  """
+  Get a page of conversations ordered by id and return the conversations details without the conversation history
+
+  Only the fields of ConversationRead are fetched from the database, and returned as plain dicts.
+
+  Args:
+    limit (Optional[int]): The maximum number of conversations to return, all remaining conversations when None
+    after (Optional[str]): Only return conversations with an id greater than this cursor
+
+  Returns:
+    List[Dict[str, Any]]: The conversations in the page, in the shape of ConversationRead
 
   Raises:
     - Exception: If there was an unexpected server error
   """
   try:
-    db_conversations = await Conversation.find_all().to_list()
-    conversation_reads = [ConversationRead(
-      id=conversation.id,
-      name=conversation.name,
-      params=conversation
-      .params,
-      tokens=conversation.tokens
-    ) for conversation in db_conversations]
-    
+    cursor = Conversation.get_motor_collection().find(
+      conversation_page_filter(after), CONVERSATION_READ_PROJECTION
+    ).sort("_id", ASCENDING)
+    if limit is not None:
+      cursor = cursor.limit(limit)
+
     # return the conversations
-    return conversation_reads
+    return [raw_conversation_read(db_conversation) async for db_conversation in cursor]
 
   except Exception as e:
     logger.error(f"Database error getting all conversations: {str(e)}")
     raise
 
+async def stream_all_conversations(after: Optional[str] = None, batch_size: int = 500) -> AsyncIterator[Dict[str, Any]]:
+  """
+  Stream every conversation's details without holding the whole result set in memory
+
+  Args:
+    after (Optional[str]): Only return conversations with an id greater than this cursor
+    batch_size (int): The number of conversations fetched per database round trip
+
+  Yields:
+    Dict[str, Any]: The next conversation, ordered by id, in the shape of ConversationRead
+  """
+  try:
+    cursor = Conversation.get_motor_collection().find(
+      conversation_page_filter(after), CONVERSATION_READ_PROJECTION, batch_size=batch_size
+    ).sort("_id", ASCENDING)
+    async for db_conversation in cursor:
+      yield raw_conversation_read(db_conversation)
+  except Exception as e:
+    logger.error(f"Database error streaming conversations: {str(e)}")
+    raise
+
 async def update_conversation(conversation_id: str, conversation: ConversationUpdate) -> str:
   """
   Update a conversation by id and return a success message
@@ -98,17 +220,19 @@ async def update_conversation(conversation_id: str, conversation: ConversationUp
     str: A success message
   """
   try:
-    db_conversation = await Conversation.get(conversation_id)
-    if db_conversation is None:
-      raise DocumentNotFound(f"Conversation with ID {conversation_id} not found")
-
-    # Update conversation
+    # Update only the given fields so concurrent message counters are never overwritten
     update_data = conversation.dict(exclude_unset=True)
-    for key, value in update_data.items():
-      setattr(db_conversation, key, value)
-    
-    # save the updated conversation
-    await db_conversation.save()
+    if update_data:
+      result = await Conversation.get_motor_collection().update_one(
+        {"_id": conversation_id},
+        {"$set": {**update_data, "updated_at": datetime.now(timezone.utc)}, "$inc": {"version": 1}}
+      )
+      conversation_cache.invalidate(conversation_id)
+      found = result.matched_count > 0
+    else:
+      found = await Conversation.get_motor_collection().count_documents({"_id": conversation_id}, limit=1) > 0
+    if not found:
+      raise DocumentNotFound(f"Conversation with ID {conversation_id} not found")
 
     # return the updated conversation
     return "conversation updated successfully"
@@ -140,6 +264,7 @@ async def delete_conversation(conversation_id: str) -> str:
 
     # delete the conversation
     await db_conversation.delete()
+    conversation_cache.invalidate(conversation_id)
   except DocumentNotFound as e:
     logger.error(f"Document not found deleting conversation {conversation_id}: {str(e)}")
     raise
@@ -149,65 +274,203 @@ async def delete_conversation(conversation_id: str) -> str:
 
   return "conversation deleted successfully"
 
-async def add_message_to_conversation(conversation_id: str, prompt_id: str, message_tokens: int) -> ConversationFull:
+async def add_message_to_conversation(conversation_id: str, message_tokens: int) -> int:
   """
-  Add a message to a conversation and return the updated conversation
+  Reserve the next position in a conversation for a new message
 
   Args:
     conversation_id (str): The unique identifier for the conversation
-    prompt_id (str): The unique identifier for the prompt
     message_tokens (int): The number of tokens in the message
 
   Returns:
-    ConversationFull: The updated conversation
+    int: The sequence number for the new message
+
+  Raises:
+    - DocumentNotFound: If the conversation is not found
   """
-  try:
-    db_conversation = await Conversation.get(conversation_id, fetch_links=True)
-    if db_conversation is None:
-            raise DocumentNotFound(f"Conversation with ID {conversation_id} not found")
-    
-    # add the new message to the conversation
-    db_conversation.messages.append(prompt_id)
+  return await add_messages_to_conversation(conversation_id, [message_tokens])
+
+async def add_messages_to_conversation(conversation_id: str, message_tokens: List[int]) -> int:
+  """
+  Reserve consecutive positions in a conversation for new messages
+
+  The message count and token count are bumped with a single atomic update, so concurrent
+  messages always get distinct, increasing sequence numbers. A prompt that fails to insert
+  after its position was reserved leaves a gap in the sequence, which ordered reads tolerate.
 
-    # update the conversation's token count
-    db_conversation.tokens += message_tokens
+  Args:
+    conversation_id (str): The unique identifier for the conversation
+    message_tokens (List[int]): The number of tokens in each message, in conversation order
+
+  Returns:
+    int: The sequence number for the first message, the others follow it
 
-    # save the updated conversation
-    await db_conversation.save()
+  Raises:
+    - DocumentNotFound: If the conversation is not found
+  """
+  try:
+    db_conversation = await Conversation.get_motor_collection().find_one_and_update(
+      {"_id": conversation_id},
+      {"$inc": {"message_count": len(message_tokens), "tokens": sum(message_tokens)}},
+      projection={"message_count": 1},
+      return_document=ReturnDocument.AFTER
+    )
+    if db_conversation is None:
+      raise DocumentNotFound(f"Conversation with ID {conversation_id} not found")
 
-      # fetch the updated conversation
-    return await get_conversation_full(conversation_id)
+    return db_conversation["message_count"] - len(message_tokens) + 1
 
   except DocumentNotFound as e:
       logger.error(f"Document not found adding message to conversation {conversation_id}: {str(e)}")
       raise
   except Exception as e:
       logger.error(f"Database error adding message to conversation {conversation_id}: {str(e)}")
-      raise 
+      raise
+
+async def mark_messages_stored(conversation_id: str, count: int) -> None:
+  """
+  Record that messages were written to a conversation, once they can be read
+  """
+  await Conversation.get_motor_collection().update_one(
+    {"_id": conversation_id},
+    {"$inc": {"stored_messages": count}, "$set": {"updated_at": datetime.now(timezone.utc)}}
+  )
+
+def to_prompt_reads(prompts: List[Prompt]) -> List[PromptRead]:
+  return [PromptRead.model_validate(prompt.dict(by_alias=True)) for prompt in prompts]
+
+def conversation_full_with_messages(db_conversation: Dict[str, Any], messages: List[PromptRead]) -> ConversationFull:
+  return ConversationFull(
+    id=db_conversation["_id"],
+    name=db_conversation["name"],
+    params=db_conversation["params"],
+    tokens=db_conversation["tokens"],
+    messages=messages
+  )
+
+async def read_conversation_history(conversation_id: str) -> Tuple[Dict[str, Any], List[PromptRead], List[PromptRead], List[Dict[str, Any]]]:
+  """
+  Read a conversation and its history through conversation_cache
+
+  The conversation and its prompts are read concurrently, and the prompts come back already
+  ordered from the (conversation_id, sequence) index. When the history is cached for the
+  conversation's current version, only the prompts added since are read.
+
+  Returns:
+    Tuple[Dict[str, Any], List[PromptRead], List[PromptRead], List[Dict[str, Any]]]: The conversation document, the
+    cached messages, and the messages read after them both as models and as the prompt documents they were read from
+
+  Raises:
+    - DocumentNotFound: If the conversation is not found
+  """
+  cached = conversation_cache.peek(conversation_id)
+  # a history without messages cached may be one not yet migrated to sequence numbers
+  if cached is not None and cached.messages:
+    cached_messages = cached.messages
+    db_conversation, db_prompts = await asyncio.gather(
+      Conversation.get_motor_collection().find_one({"_id": conversation_id}, CONVERSATION_HISTORY_PROJECTION),
+      Prompt.get_motor_collection().find(
+        {"conversation_id": conversation_id, "sequence": {"$gt": cached.last_sequence}}, MESSAGE_READ_PROJECTION
+      ).sort("sequence", ASCENDING).to_list(length=None)
+    )
+    if db_conversation is None:
+      conversation_cache.invalidate(conversation_id)
+      raise DocumentNotFound(f"Conversation with ID {conversation_id} not found")
+    if conversation_cache.validate(conversation_id, db_conversation.get("version", 0), db_conversation.get("message_count", 0)):
+      new_messages = [PromptRead.model_validate(db_prompt) for db_prompt in db_prompts]
+      conversation_cache.extend(conversation_id, new_messages)
+      return db_conversation, cached_messages, new_messages, db_prompts
+  else:
+    conversation_cache.record_miss()
+
+  db_conversation, db_prompts = await asyncio.gather(
+    Conversation.get_motor_collection().find_one({"_id": conversation_id}, CONVERSATION_HISTORY_PROJECTION),
+    Prompt.get_motor_collection().find({"conversation_id": conversation_id}, MESSAGE_READ_PROJECTION).sort("sequence", ASCENDING).to_list(length=None)
+  )
+  if db_conversation is None:
+    raise DocumentNotFound(f"Conversation with ID {conversation_id} not found")
+
+  messages = [PromptRead.model_validate(db_prompt) for db_prompt in db_prompts]
+  conversation_cache.set(conversation_id, db_conversation.get("version", 0), messages)
+  return db_conversation, [], messages, db_prompts
 
 async def get_conversation_full(conversation_id: str) -> ConversationFull:
   """
-  Get a conversation by id and return its full conversation history
+  Get a conversation by id and return its full conversation history, read through conversation_cache
 
   Args:
     conversation_id (str): The unique identifier for the conversation
 
   Returns:
     ConversationFull: The conversation with the given id and its full conversation history
+
+  Raises:
+    - DocumentNotFound: If the conversation is not found
+  """
+  db_conversation, cached_messages, new_messages, _ = await read_conversation_history(conversation_id)
+  return conversation_full_with_messages(raw_conversation_read(db_conversation), cached_messages + new_messages)
+
+async def get_conversation_window(
+    conversation_id: str,
+    before: Optional[int] = None,
+    after: Optional[int] = None,
+    limit: Optional[int] = None,
+    tail: Optional[int] = None
+) -> Dict[str, Any]:
+  """
+  Get a conversation by id with a window of its history, read by an indexed sequence range
+
+  Like get_conversation, the window is read and returned as plain dicts.
+
+  Windows are returned in conversation order. Paging forward uses `after`, paging backward uses
+  `before`, and `tail` returns the newest messages.
+
+  Args:
+    conversation_id (str): The unique identifier for the conversation
+    before (Optional[int]): Only include messages with a sequence lower than this
+    after (Optional[int]): Only include messages with a sequence greater than this
+    limit (Optional[int]): The maximum number of messages in the window
+    tail (Optional[int]): Return the newest `tail` messages, overrides `limit`
+
+  Returns:
+    Dict[str, Any]: The conversation with the window of messages, the total message count and whether more messages exist,
+    in the shape of ConversationFull
+
+  Raises:
+    - DocumentNotFound: If the conversation is not found
   """
-  db_conversation = await Conversation.get(conversation_id)
+  query: Dict[str, Any] = {"conversation_id": conversation_id}
+  sequence_range = {}
+  if after is not None:
+    sequence_range["$gt"] = after
+  if before is not None:
+    sequence_range["$lt"] = before
+  if sequence_range:
+    query["sequence"] = sequence_range
+
+  # read backwards from the end of the range when paging towards older messages
+  newest_first = tail is not None or (before is not None and after is None)
+  window_size = tail if tail is not None else limit
+
+  prompts_cursor = Prompt.get_motor_collection().find(query, MESSAGE_READ_PROJECTION).sort("sequence", DESCENDING if newest_first else ASCENDING)
+  if window_size is not None:
+    # fetch one extra message to know whether the window is the last one
+    prompts_cursor = prompts_cursor.limit(window_size + 1)
+
+  db_conversation, db_prompts = await asyncio.gather(
+    Conversation.get_motor_collection().find_one({"_id": conversation_id}, {**CONVERSATION_READ_PROJECTION, "message_count": 1}),
+    prompts_cursor.to_list(length=None)
+  )
   if db_conversation is None:
     raise DocumentNotFound(f"Conversation with ID {conversation_id} not found")
-  prompts = await Prompt.find(Prompt.conversation_id == db_conversation.id).to_list()
-  prompt_reads = [PromptRead.model_validate(prompt.dict(by_alias=True)) for prompt in prompts]
-  
-  message_id_order = {str(msg_id): index for index, msg_id in enumerate(db_conversation.messages)}
-  prompt_reads.sort(key=lambda x: message_id_order.get(x.id, float('inf')))
 
-  return ConversationFull(
-    id=db_conversation.id,
-    name=db_conversation.name,
-    params=db_conversation.params,
-    tokens=db_conversation.tokens,
-    messages=prompt_reads
-  )
+  has_more = window_size is not None and len(db_prompts) > window_size
+  db_prompts = db_prompts[:window_size]
+  if newest_first:
+    db_prompts.reverse()
+
+  message_count = db_conversation.pop("message_count", 0)
+  conversation = raw_conversation_full(db_conversation, [raw_message(db_prompt) for db_prompt in db_prompts])
+  conversation["message_count"] = message_count
+  conversation["has_more"] = has_more
+  return conversation
@@ -0,0 +1,78 @@
+from models.models import IdempotencyRecord, IdempotencyStatus
+from pymongo.errors import DuplicateKeyError
+from pymongo import ReturnDocument
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# A pending key whose run started longer ago than this is treated as abandoned by a crashed worker
+IDEMPOTENCY_LOCK_TIMEOUT = float(os.getenv('IDEMPOTENCY_LOCK_TIMEOUT', '300'))
+
+class IdempotencyKeyMismatch(Exception):
+  pass
+
+class IdempotencyKeyInProgress(Exception):
+  pass
+
+async def claim_idempotency_key(record_id: str, request_hash: str) -> Optional[IdempotencyRecord]:
+  """
+  Claim an idempotency key for running a request
+
+  Args:
+    record_id (str): The conversation scoped idempotency key
+    request_hash (str): Hash of the request body
+
+  Returns:
+    Optional[IdempotencyRecord]: None if the caller now owns the key and must run the request,
+    otherwise the existing record of the request that used the key first
+  """
+  while True:
+    now = datetime.now(timezone.utc)
+    try:
+      await IdempotencyRecord.get_motor_collection().insert_one(
+        IdempotencyRecord(id=record_id, request_hash=request_hash, created_at=now, locked_at=now).model_dump(by_alias=True)
+      )
+      return None
+    except DuplicateKeyError:
+      pass
+
+    # take over a pending key whose owner stopped without completing or releasing it
+    taken_over = await IdempotencyRecord.get_motor_collection().find_one_and_update(
+      {
+        "_id": record_id,
+        "request_hash": request_hash,
+        "status": IdempotencyStatus.pending.value,
+        "locked_at": {"$lt": now - timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT)}
+      },
+      {"$set": {"locked_at": now}},
+      return_document=ReturnDocument.AFTER
+    )
+    if taken_over is not None:
+      logger.warning(f"Taking over abandoned idempotency key {record_id}")
+      return None
+
+    record = await IdempotencyRecord.get(record_id)
+    # the key was released between the insert and the read, try to claim it again
+    if record is not None:
+      return record
+
+async def get_idempotency_record(record_id: str) -> Optional[IdempotencyRecord]:
+  return await IdempotencyRecord.get(record_id)
+
+async def complete_idempotency_key(record_id: str, response: str, headers: Dict[str, str]) -> None:
+  """
+  Store the result of a request so retries with the same key replay it
+  """
+  await IdempotencyRecord.get_motor_collection().update_one(
+    {"_id": record_id},
+    {"$set": {"status": IdempotencyStatus.completed.value, "response": response, "headers": headers}}
+  )
+
+async def release_idempotency_key(record_id: str) -> None:
+  """
+  Release the key of a request that failed, so a retry runs it again
+  """
+  await IdempotencyRecord.get_motor_collection().delete_one({"_id": record_id, "status": IdempotencyStatus.pending.value})
@@ -0,0 +1,118 @@
+from models.models import QueryJob, JobStatus, QueryRoleType
+from pymongo import ReturnDocument, ASCENDING
+from pymongo.errors import DuplicateKeyError
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+from uuid import NAMESPACE_URL, uuid5
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+# A running job whose worker has not renewed its lock for this long is treated as abandoned by a crashed or restarted worker
+JOB_LOCK_TIMEOUT = float(os.getenv('JOB_LOCK_TIMEOUT', '300'))
+
+# job ids derived from idempotency keys live in their own namespace
+JOB_ID_NAMESPACE = uuid5(NAMESPACE_URL, "query_jobs")
+
+def idempotent_job_id(conversation_id: str, idempotency_key: str) -> str:
+  """
+  The id of the job queued on a conversation with an Idempotency-Key, the same for every retry
+  """
+  return str(uuid5(JOB_ID_NAMESPACE, f"{conversation_id}:{idempotency_key}"))
+
+async def create_job(
+    conversation_id: str,
+    role: str,
+    content: str,
+    force_cache: bool = False,
+    job_id: Optional[str] = None,
+    request_hash: Optional[str] = None
+) -> QueryJob:
+  """
+  Queue a query job
+
+  Args:
+    conversation_id (str): The unique identifier for the conversation
+    role (str): Role of the message sender
+    content (str): Anonymised content of the query
+    force_cache (bool): Use the completion cache even when the conversation samples with a temperature above 0
+    job_id (Optional[str]): The job's id, see idempotent_job_id, a random one when None
+    request_hash (Optional[str]): Hash of the request, to tell a retry from another request with the same key
+
+  Returns:
+    QueryJob: The queued job
+
+  Raises:
+    - DuplicateKeyError: If a job with the id already exists
+  """
+  try:
+    job = QueryJob(conversation_id=conversation_id, role=QueryRoleType(role), content=content, force_cache=force_cache, request_hash=request_hash)
+    if job_id is not None:
+      job.id = job_id
+    await job.insert()
+    return job
+  except DuplicateKeyError:
+    raise
+  except Exception as e:
+    logger.error(f"Database error creating job: {str(e)}")
+    raise
+
+async def get_job(job_id: str) -> Optional[QueryJob]:
+  return await QueryJob.get(job_id)
+
+async def count_queued_jobs() -> int:
+  return await QueryJob.get_motor_collection().count_documents({"status": JobStatus.queued.value})
+
+async def claim_next_job() -> Optional[QueryJob]:
+  """
+  Atomically take the oldest queued job, or a running job whose worker went away
+
+  Returns:
+    Optional[QueryJob]: The claimed job, now running, or None if no job is waiting
+  """
+  now = datetime.now(timezone.utc)
+  db_job = await QueryJob.get_motor_collection().find_one_and_update(
+    {"$or": [
+      {"status": JobStatus.queued.value},
+      {"status": JobStatus.running.value, "heartbeat_at": {"$lt": now - timedelta(seconds=JOB_LOCK_TIMEOUT)}}
+    ]},
+    {"$set": {"status": JobStatus.running.value, "started_at": now, "heartbeat_at": now}, "$inc": {"attempts": 1}},
+    sort=[("created_at", ASCENDING)],
+    return_document=ReturnDocument.AFTER
+  )
+  if db_job is None:
+    return None
+  if db_job["attempts"] > 1:
+    logger.warning(f"Resuming abandoned job {db_job['_id']}")
+  return QueryJob.model_validate(db_job)
+
+async def renew_job_lock(job_id: str, attempts: int) -> bool:
+  """
+  Keep a running job from being resumed by another worker
+
+  Args:
+    job_id (str): The unique identifier for the job
+    attempts (int): The job's attempts when the worker claimed it
+
+  Returns:
+    bool: Whether the worker still holds the job, False once another worker resumed it
+  """
+  result = await QueryJob.get_motor_collection().update_one(
+    {"_id": job_id, "status": JobStatus.running.value, "attempts": attempts},
+    {"$set": {"heartbeat_at": datetime.now(timezone.utc)}}
+  )
+  return result.matched_count == 1
+
+async def complete_job(job_id: str, attempts: int, response: str, headers: Dict[str, str]) -> None:
+  # a worker that lost the job to another one leaves its result alone
+  await QueryJob.get_motor_collection().update_one(
+    {"_id": job_id, "attempts": attempts},
+    {"$set": {"status": JobStatus.completed.value, "response": response, "headers": headers, "finished_at": datetime.now(timezone.utc)}}
+  )
+
+async def fail_job(job_id: str, attempts: int, error: Dict[str, Any]) -> None:
+  await QueryJob.get_motor_collection().update_one(
+    {"_id": job_id, "attempts": attempts},
+    {"$set": {"status": JobStatus.failed.value, "error": error, "finished_at": datetime.now(timezone.utc)}}
+  )
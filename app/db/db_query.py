@@ -2,42 +2,138 @@ from models.schemas import PromptCreate
 from models.models import Prompt, QueryRoleType
 from utils.token_counter import count_message_tokens
 import logging
-from typing import Dict, Union
-from utils.anonymise import anonymise
+import os
+from typing import Dict, List, Optional, Tuple, Union
+from uuid import NAMESPACE_URL, uuid5
+from utils.anonymise import anonymise_async
+from utils.group_commit import GroupCommit
+from utils.metrics import query_stage_seconds
+from db.db_conversations import add_messages_to_conversation, mark_messages_stored, conversation_cache, to_prompt_reads
 logger = logging.getLogger(__name__)
 
-async def create_prompt(conversation_id: str, prompt: PromptCreate) -> Dict[str, Union[str, int]]:
+PROMPT_INSERT_BATCH = int(os.getenv('PROMPT_INSERT_BATCH', '500'))
+
+async def insert_prompts(db_prompts: List[Prompt]) -> None:
+  await Prompt.insert_many(db_prompts, ordered=False)
+
+# prompts saved by concurrent turns are inserted together
+prompt_writer: GroupCommit[Prompt] = GroupCommit(insert_prompts, PROMPT_INSERT_BATCH)
+
+# prompt ids derived from turn ids live in their own namespace
+TURN_ID_NAMESPACE = uuid5(NAMESPACE_URL, "conversation_turns")
+
+def turn_prompt_ids(turn_id: str) -> Tuple[str, str]:
   """
-  Create a prompt in the database
+  The ids of the query and the response of a turn that may run more than once, e.g. a resumed query job
+  """
+  return str(uuid5(TURN_ID_NAMESPACE, f"{turn_id}:query")), str(uuid5(TURN_ID_NAMESPACE, f"{turn_id}:response"))
+
+async def get_turn_response(turn_id: str) -> Optional[PromptCreate]:
+  """
+  The stored response of a turn, if an earlier run of the turn already saved it
+  """
+  db_prompt = await Prompt.get(turn_prompt_ids(turn_id)[1])
+  if db_prompt is None:
+    return None
+  return PromptCreate(role=db_prompt.role, content=db_prompt.content)
+
+async def build_prompt(conversation_id: str, prompt: PromptCreate, anonymised: bool = False, prompt_id: Optional[str] = None) -> Prompt:
+  """
+  Anonymise a prompt and count its tokens, without saving it
 
   Args:
     conversation_id (str): The unique identifier for the conversation
     prompt (PromptCreate): The prompt object containing the query content
+    anonymised (bool): The content was already anonymised, e.g. before it was stored with a query job
+    prompt_id (Optional[str]): The prompt's id, see turn_prompt_ids, a random one when None
+
+  Returns:
+    Prompt: The unsaved prompt, its sequence is assigned by save_prompts. The given prompt is left as it is
+  """
+  # anonymise content, scanning as thoroughly as the prompt's role requires
+  if anonymised:
+    content = prompt.content
+  else:
+    with query_stage_seconds.time("anonymise"):
+      content = await anonymise_async(prompt.content, prompt.role)
+  stored_prompt = prompt.model_copy(update={"content": content})
+
+  # count tokens for the new message
+  with query_stage_seconds.time("count_tokens"):
+    message_tokens = await count_message_tokens(stored_prompt)
+
+  db_prompt = Prompt(
+    role=QueryRoleType(prompt.role),
+    content=content,
+    conversation_id=conversation_id,
+    tokens=message_tokens
+  )
+  if prompt_id is not None:
+    db_prompt.id = prompt_id
+  return db_prompt
+
+async def save_prompts(conversation_id: str, db_prompts: List[Prompt], skip_stored: bool = False) -> List[Dict[str, Union[str, int]]]:
+  """
+  Add prompts to a conversation with one update reserving their positions, one insert, which is
+  shared with the prompts other turns are saving at the same time, and one update marking them stored
+
+  Args:
+    conversation_id (str): The unique identifier for the conversation
+    db_prompts (List[Prompt]): Prompts built by build_prompt, in conversation order
+    skip_stored (bool): Leave out prompts whose id is already stored, so a turn with ids from turn_prompt_ids is saved once however often it runs
 
   Returns:
-    Dict[str, Union[str, int]]: The prompt id and the number of tokens in the prompt
+    List[Dict[str, Union[str, int]]]: The prompt id, the number of tokens in the prompt and its sequence number in the conversation, for each prompt saved
+
+  Raises:
+    - DocumentNotFound: If the conversation is not found
   """
   try:
-    # anonymise content
-    prompt.content = anonymise(prompt.content)
-
-    # create a new prompt
-    db_prompt = Prompt(
-      role=QueryRoleType(prompt.role),
-      content=prompt.content,
-      conversation_id=conversation_id
-    )
-    await db_prompt.insert()
-
-    # count tokens for the new message
-    message_tokens = await count_message_tokens(prompt)
-
-    return {
-      "prompt_id": db_prompt.id,
-      "tokens": message_tokens
-    }
-  
+    if skip_stored:
+      cursor = Prompt.get_motor_collection().find({"_id": {"$in": [db_prompt.id for db_prompt in db_prompts]}}, {"_id": 1})
+      stored = {db_prompt["_id"] async for db_prompt in cursor}
+      db_prompts = [db_prompt for db_prompt in db_prompts if db_prompt.id not in stored]
+      if not db_prompts:
+        return []
+    # reserve the messages' positions in the conversation
+    with query_stage_seconds.time("reserve_messages"):
+      first_sequence = await add_messages_to_conversation(conversation_id, [db_prompt.tokens for db_prompt in db_prompts])
+    for offset, db_prompt in enumerate(db_prompts):
+      db_prompt.sequence = first_sequence + offset
+    with query_stage_seconds.time("insert_prompts"):
+      await prompt_writer.write(db_prompts)
+    # change the conversation's ETag only now that its new messages can be read
+    with query_stage_seconds.time("mark_stored"):
+      await mark_messages_stored(conversation_id, len(db_prompts))
+    # the next read of the conversation does not have to fetch the prompts again
+    conversation_cache.extend(conversation_id, to_prompt_reads(db_prompts))
+
+    return [
+      {
+        "prompt_id": db_prompt.id,
+        "tokens": db_prompt.tokens,
+        "sequence": db_prompt.sequence
+      }
+      for db_prompt in db_prompts
+    ]
+
   except Exception as e:
     logger.error(f"Database error creating prompt: {str(e)}")
-    raise 
+    raise
+
+async def create_prompt(conversation_id: str, prompt: PromptCreate) -> Dict[str, Union[str, int]]:
+  """
+  Create a prompt in the database
 
+  Args:
+    conversation_id (str): The unique identifier for the conversation
+    prompt (PromptCreate): The prompt object containing the query content
+
+  Returns:
+    Dict[str, Union[str, int]]: The prompt id, the number of tokens in the prompt and its sequence number in the conversation
+
+  Raises:
+    - DocumentNotFound: If the conversation is not found
+  """
+  db_prompt = await build_prompt(conversation_id, prompt)
+  return (await save_prompts(conversation_id, [db_prompt]))[0]
@@ -0,0 +1,85 @@
+from models.models import Conversation, Prompt
+from models.schemas import PromptBase
+from pymongo import UpdateOne
+from utils.token_counter import count_messages_tokens
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '1000'))
+
+async def migrate_message_sequences() -> int:
+  """
+  Move conversations from the legacy `messages` id array to per-prompt sequence numbers
+
+  Prompts listed in the array are numbered in array order starting from 1. Prompts of the
+  conversation that were never linked into the array are numbered after them, which matches
+  where the old in-Python sort placed them. The conversation's `message_count` is set to the
+  number of prompts and the array is removed. Already migrated conversations are skipped,
+  so this is safe to run on every startup.
+
+  Returns:
+    int: The number of migrated conversations
+  """
+  conversations = Conversation.get_motor_collection()
+  prompts = Prompt.get_motor_collection()
+  migrated = 0
+
+  async for db_conversation in conversations.find({"messages": {"$exists": True}}, {"messages": 1}):
+    conversation_id = db_conversation["_id"]
+    ordered_ids = [str(message_id) for message_id in db_conversation["messages"]]
+    linked_ids = set(ordered_ids)
+    async for db_prompt in prompts.find({"conversation_id": conversation_id}, {"_id": 1}):
+      if db_prompt["_id"] not in linked_ids:
+        ordered_ids.append(db_prompt["_id"])
+
+    operations = [
+      UpdateOne({"_id": prompt_id, "conversation_id": conversation_id}, {"$set": {"sequence": sequence}})
+      for sequence, prompt_id in enumerate(ordered_ids, start=1)
+    ]
+    if operations:
+      await prompts.bulk_write(operations, ordered=False)
+
+    await conversations.update_one(
+      {"_id": conversation_id},
+      {"$set": {"message_count": len(ordered_ids)}, "$unset": {"messages": ""}}
+    )
+    migrated += 1
+
+  if migrated:
+    logger.info(f"Migrated {migrated} conversations to message sequence numbers")
+  return migrated
+
+async def migrate_prompt_tokens(batch_size: int = MIGRATION_BATCH_SIZE) -> int:
+  """
+  Store the token count of prompts saved before per-message token counts existed
+
+  The context builder trusts the stored counts, so they are counted once here rather than on
+  every turn. Counting runs off the event loop, a batch at a time. Every message counts at
+  least its ChatML framing, so counted prompts are never picked up again and this is safe to
+  run on every startup.
+
+  Returns:
+    int: The number of prompts whose tokens were counted
+  """
+  prompts = Prompt.get_motor_collection()
+  migrated = 0
+
+  while True:
+    batch = await prompts.find(
+      {"$or": [{"tokens": {"$exists": False}}, {"tokens": 0}]},
+      {"role": 1, "content": 1}
+    ).limit(batch_size).to_list(None)
+    if not batch:
+      break
+    counts = await count_messages_tokens([PromptBase(role=db_prompt["role"], content=db_prompt["content"]) for db_prompt in batch])
+    await prompts.bulk_write([
+      UpdateOne({"_id": db_prompt["_id"]}, {"$set": {"tokens": tokens}})
+      for db_prompt, tokens in zip(batch, counts)
+    ], ordered=False)
+    migrated += len(batch)
+
+  if migrated:
+    logger.info(f"Counted the tokens of {migrated} prompts")
+  return migrated
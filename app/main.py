@@ -9,8 +9,17 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.responses import JSONResponse
 from routes.api_conversations import router as conversations_router
 from routes.api_query import router as query_router
+from routes.api_jobs import router as jobs_router
+from routes.api_metrics import router as metrics_router
+from routes.api_compression import router as compression_router
 from db.db import init_db, close_connection
-from typing import Dict
+from utils.openai import close_client
+from utils.jobs import job_pool
+from utils.compression import (
+    CompressionMiddleware, available_encodings, compression_stats, COMPRESSION_ENABLED, COMPRESSION_MINIMUM_SIZE,
+    COMPRESSION_GZIP_LEVEL, COMPRESSION_BROTLI_QUALITY, COMPRESSION_ZSTD_LEVEL, COMPRESSION_ENCODINGS
+)
+from utils.metrics import MetricsMiddleware
 from models.schemas import APIError
 # Initialize FastAPI app
 app = FastAPI()
@@ -35,16 +44,35 @@ async def validation_exception_handler(request: Request, exc: RequestValidationE
         content=api_error.dict()
     )
 
+# Compress responses the client accepts compressed, streams are flushed per chunk
+if COMPRESSION_ENABLED:
+    app.add_middleware(
+        CompressionMiddleware,
+        minimum_size=COMPRESSION_MINIMUM_SIZE,
+        encodings=available_encodings(COMPRESSION_GZIP_LEVEL, COMPRESSION_BROTLI_QUALITY, COMPRESSION_ZSTD_LEVEL),
+        preference=COMPRESSION_ENCODINGS,
+        stats=compression_stats
+    )
+
+# Outermost, so request timings include compression
+app.add_middleware(MetricsMiddleware)
+
 # Include routers
 app.include_router(conversations_router)
 app.include_router(query_router)
+app.include_router(jobs_router)
+app.include_router(metrics_router)
+app.include_router(compression_router)
 
 # Initialize database connection on startup
 @app.on_event("startup")
 async def on_startup() -> None:
     await init_db()
+    await job_pool.start()
 
 # Close database connection on shutdown
 @app.on_event("shutdown")
 async def on_shutdown() -> None:
+    await job_pool.stop()
     close_connection()
+    await close_client()
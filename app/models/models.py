@@ -1,9 +1,11 @@
 from beanie import Document
 from pydantic import Field
-from typing import List
+from pymongo import IndexModel, ASCENDING
 from uuid import uuid4
+from datetime import datetime, timezone
+import os
 from enum import Enum
-from typing import Dict
+from typing import Any, Dict, Optional, Union
 
 class QueryRoleType(str, Enum):
   system = "system"
@@ -16,16 +18,25 @@ class Prompt(Document):
   role: QueryRoleType = Field(..., description="Role of the message sender")
   content: str = Field(..., description="Content of the message")
   conversation_id: str = Field(..., description="Unique identifier for the conversation")
+  sequence: int = Field(ge=0, default=0, description="Position of the message in the conversation, increasing from 1")
+  tokens: int = Field(ge=0, default=0, description="The number of tokens in the message")
 
   class Settings:
     collection = "prompts"
+    indexes = [
+      # serves history reads ordered by sequence and deletes by conversation_id
+      IndexModel([("conversation_id", ASCENDING), ("sequence", ASCENDING)], name="conversation_id_sequence")
+    ]
 
 class Conversation(Document):
   id: str = Field(default_factory=lambda: str(uuid4()), alias="_id", primary_key=True, description="Unique identifier for the conversation")
   name: str = Field(max_length=200, description="Name of the conversation")
-  params: Dict[str, float] = Field(..., description="Parameter dictionary to override defaults prescribed by the AI Model")
+  params: Dict[str, Union[float, str]] = Field(..., description="Parameter dictionary to override defaults prescribed by the AI Model, and the `provider` and `model` to use")
   tokens: int = Field(ge=0, default=0, description="The number of tokens used in the conversation")
-  messages: List[str] = Field(default_factory=list, description="Chat messages id included in the conversation")
+  message_count: int = Field(ge=0, default=0, description="The number of messages in the conversation, used to assign message sequence numbers")
+  version: int = Field(ge=0, default=0, description="Bumped by every change to the conversation other than new messages, used to validate cached histories")
+  stored_messages: int = Field(ge=0, default=0, description="Bumped once new messages are written, unlike message_count which is bumped when their positions are reserved")
+  updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), description="When the conversation or its messages last changed")
 
   class Config:
     from_attributes = True
@@ -35,14 +46,71 @@ class Conversation(Document):
         "name": "Example Conversation",
         "params": {"temperature": 0.7},
         "tokens": 1500,
-        "messages": [
-          {"role": "user", "content": "Hello!"},
-          {"role": "assistant", "content": "Hi! How can I assist you today?"}
-        ],
+        "message_count": 2,
       }
     }
 
   class Settings:
     collection = "conversations"
 
-    
\ No newline at end of file
+class CompletionCacheEntry(Document):
+  id: str = Field(..., alias="_id", primary_key=True, description="Hash of the model, params and messages the completion was generated for")
+  model: str = Field(..., description="Model that generated the completion")
+  content: str = Field(..., description="Content of the completion")
+  created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), description="When the completion was cached")
+
+  class Settings:
+    name = "completion_cache"
+    indexes = [
+      IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=int(os.getenv('COMPLETION_CACHE_TTL', '86400')))
+    ]
+
+class IdempotencyStatus(str, Enum):
+  pending = "pending"
+  completed = "completed"
+
+class IdempotencyRecord(Document):
+  id: str = Field(..., alias="_id", primary_key=True, description="Conversation id and the client's Idempotency-Key")
+  request_hash: str = Field(..., description="Hash of the request the key was first used with")
+  status: IdempotencyStatus = Field(default=IdempotencyStatus.pending, description="Whether the request is still running")
+  response: Optional[str] = Field(None, description="Content of the LLM's response once completed")
+  headers: Dict[str, str] = Field(default_factory=dict, description="Response headers of the completed request")
+  created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), description="When the key was first used")
+  locked_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), description="When the current run of the request started")
+
+  class Settings:
+    name = "idempotency_keys"
+    indexes = [
+      IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=int(os.getenv('IDEMPOTENCY_TTL', '86400')))
+    ]
+
+class JobStatus(str, Enum):
+  queued = "queued"
+  running = "running"
+  completed = "completed"
+  failed = "failed"
+
+class QueryJob(Document):
+  id: str = Field(default_factory=lambda: str(uuid4()), alias="_id", primary_key=True, description="Unique identifier for the job")
+  conversation_id: str = Field(..., description="Unique identifier for the conversation")
+  role: QueryRoleType = Field(..., description="Role of the message sender")
+  content: str = Field(..., description="Anonymised content of the query")
+  force_cache: bool = Field(default=False, description="Use the completion cache even when the conversation samples with a temperature above 0")
+  request_hash: Optional[str] = Field(None, description="Hash of the request that queued the job with an Idempotency-Key")
+  status: JobStatus = Field(default=JobStatus.queued, description="Where the job is in its lifecycle")
+  response: Optional[str] = Field(None, description="Content of the LLM's response once completed")
+  headers: Dict[str, str] = Field(default_factory=dict, description="Response headers of the completed query")
+  error: Optional[Dict[str, Any]] = Field(None, description="The API error of a failed job")
+  attempts: int = Field(default=0, ge=0, description="How many times a worker started the job")
+  created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc), description="When the job was queued")
+  started_at: Optional[datetime] = Field(None, description="When a worker last started the job")
+  heartbeat_at: Optional[datetime] = Field(None, description="When the worker running the job last renewed its lock")
+  finished_at: Optional[datetime] = Field(None, description="When the job completed or failed")
+
+  class Settings:
+    name = "query_jobs"
+    indexes = [
+      # serves workers claiming the oldest queued job
+      IndexModel([("status", ASCENDING), ("created_at", ASCENDING)], name="status_created_at"),
+      IndexModel([("created_at", ASCENDING)], name="created_at_ttl", expireAfterSeconds=int(os.getenv('JOB_TTL', '86400')))
+    ]
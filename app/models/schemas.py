@@ -1,6 +1,8 @@
-from pydantic import BaseModel, Field
-from typing import List, Dict, Optional, Any
+from pydantic import AfterValidator, BaseModel, Field
+from typing import List, Dict, Optional, Any, Union
+from typing_extensions import Annotated
 from enum import Enum
+from datetime import datetime
 
 
 class QueryRoleType(str, Enum):
@@ -9,6 +11,45 @@ class QueryRoleType(str, Enum):
   assistant = "assistant"
   function = "function"
 
+class StreamFormat(str, Enum):
+  sse = "sse"
+  ndjson = "ndjson"
+
+class QueryMode(str, Enum):
+  sync = "sync"
+  async_ = "async"
+
+class JobStatus(str, Enum):
+  queued = "queued"
+  running = "running"
+  completed = "completed"
+  failed = "failed"
+
+# conversation params that pick the backend rather than being sent to it, the others are numbers
+ROUTING_PARAMS = ("provider", "model")
+
+def validate_params(params: Dict[str, Union[float, str]]) -> Dict[str, Union[float, str]]:
+  """
+  Check each param's type by name, so a numeric param can be compared and sent to the LLM as a number
+
+  Raises:
+    ValueError: If a routing param is not a string or another param is not a number
+  """
+  validated: Dict[str, Union[float, str]] = {}
+  for name, value in params.items():
+    if name in ROUTING_PARAMS:
+      if not isinstance(value, str):
+        raise ValueError(f"param {name} must be a string")
+      validated[name] = value
+    else:
+      try:
+        validated[name] = float(value)
+      except ValueError:
+        raise ValueError(f"param {name} must be a number")
+  return validated
+
+ConversationParams = Annotated[Dict[str, Union[float, str]], AfterValidator(validate_params)]
+
 class PromptBase(BaseModel):
   role: QueryRoleType
   content: str
@@ -18,20 +59,22 @@ class PromptCreate(PromptBase):
 
 class PromptRead(PromptBase):
   id: str = Field(alias="_id")
+  sequence: int = Field(default=0, ge=0, description="Position of the message in the conversation, used as a history cursor")
+  tokens: int = Field(default=0, ge=0, description="The number of tokens in the message")
 
   class Config:
     from_attributes = True
 
 class ConversationBase(BaseModel):
   name: str = Field(..., max_length=200, description="Title of the conversation")
-  params: Optional[Dict[str, float]] = Field(default_factory=dict, description="Parameter dictionary to override defaults prescribed by the AI Model")
+  params: Optional[ConversationParams] = Field(default_factory=dict, description="Parameter dictionary to override defaults prescribed by the AI Model, and the `provider` and `model` to use")
 
 class ConversationCreate(ConversationBase):
   pass
   
 class ConversationUpdate(BaseModel):
   name: Optional[str] = Field(None, max_length=200, description="Title of the conversation")
-  params: Optional[Dict[str, float]] = Field(default_factory=dict, description="Parameter dictionary to override defaults prescribed by the AI Model")
+  params: Optional[ConversationParams] = Field(default_factory=dict, description="Parameter dictionary to override defaults prescribed by the AI Model, and the `provider` and `model` to use")
 
 class ConversationRead(ConversationBase):
   id: str = Field(..., alias="_id")
@@ -45,9 +88,44 @@ class ConversationRead(ConversationBase):
 class ConversationFull(BaseModel):
     id: str = Field(alias="_id")
     name: str = Field(..., max_length=200, description="Title of the conversation")
-    params: Optional[Dict[str, float]] = Field(default_factory=dict, description="Parameter dictionary to override defaults prescribed by the AI Model")
+    params: Optional[ConversationParams] = Field(default_factory=dict, description="Parameter dictionary to override defaults prescribed by the AI Model, and the `provider` and `model` to use")
     tokens: int = Field(default=0, ge=0, description="The number of tokens used in the conversation")
     messages: List[PromptRead] = Field(default_factory=list, description="Chat messages included in the conversation")
+    message_count: Optional[int] = Field(None, ge=0, description="Total number of messages in the conversation, set when only a window of messages is returned")
+    has_more: Optional[bool] = Field(None, description="Whether more messages exist beyond the window in the paging direction, set when only a window of messages is returned")
+
+    class Config:
+        from_attributes = True
+        populate_by_name = True
+
+class ContextMetadata(BaseModel):
+    messages_sent: int = Field(..., ge=0, description="Number of messages sent to the LLM")
+    messages_dropped: int = Field(..., ge=0, description="Number of older messages left out to fit the token budget")
+    prompt_tokens: int = Field(..., ge=0, description="Estimated number of tokens in the messages sent")
+    token_budget: int = Field(..., ge=0, description="Number of tokens available for messages after reserving room for the completion")
+
+    def to_headers(self) -> Dict[str, str]:
+        return {
+            "X-Context-Messages-Sent": str(self.messages_sent),
+            "X-Context-Messages-Dropped": str(self.messages_dropped),
+            "X-Context-Prompt-Tokens": str(self.prompt_tokens),
+            "X-Context-Token-Budget": str(self.token_budget)
+        }
+
+class BatchQueryItem(BaseModel):
+    conversation_id: str = Field(..., description="Unique identifier for the conversation")
+    query: PromptCreate = Field(..., description="The prompt to send to the conversation")
+
+class JobRead(BaseModel):
+    id: str = Field(..., alias="_id")
+    conversation_id: str = Field(..., description="Unique identifier for the conversation")
+    status: JobStatus = Field(..., description="Where the job is in its lifecycle")
+    response: Optional[str] = Field(None, description="Content of the LLM's response once completed")
+    error: Optional[Dict[str, Any]] = Field(None, description="The API error of a failed job")
+    attempts: int = Field(default=0, ge=0, description="How many times a worker started the job")
+    created_at: datetime = Field(..., description="When the job was queued")
+    started_at: Optional[datetime] = Field(None, description="When a worker last started the job")
+    finished_at: Optional[datetime] = Field(None, description="When the job completed or failed")
 
     class Config:
         from_attributes = True
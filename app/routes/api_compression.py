@@ -0,0 +1,40 @@
+from fastapi import APIRouter, HTTPException
+from typing import Any, Dict, List
+from models.schemas import APIError
+from utils.compression import compression_stats
+from utils.errors import create_error_response
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/compression", tags=["compression"])
+
+@router.get("/stats", responses={
+  200: {
+    "description": "Response compression statistics by route and content coding",
+    "model": List[Dict[str, Any]]
+  },
+  500: {
+    "description": "Internal server error",
+    "model": APIError
+  }
+},
+summary="Get response compression statistics",
+description="Retrieve the responses, bytes in and out, compression ratio and compression CPU time of each route template and content coding")
+async def get_compression_stats_endpoint() -> List[Dict[str, Any]]:
+  """
+  Get the response compression statistics
+
+  Returns:
+    List[Dict[str, Any]]: One entry per route template and content coding, with the number of responses,
+    the bytes before and after compression, their ratio and the CPU time spent compressing
+
+  Raises:
+    - 500: If there was an unexpected server error
+  """
+  try:
+    return compression_stats.stats()
+  except Exception as e:
+    logging.error(f"Error getting compression stats: {str(e)}")
+    error = create_error_response(500, "Internal Server Error", {"method": "GET", "url": "/compression/stats"}, e)
+    raise HTTPException(status_code=500, detail=error.dict())
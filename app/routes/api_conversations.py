@@ -1,15 +1,22 @@
-from fastapi import APIRouter, status, HTTPException
+from fastapi import APIRouter, status, HTTPException, Header, Query, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from beanie.exceptions import DocumentNotFound
-from db.db_conversations import create_conversation, get_all_conversations, get_conversation, update_conversation, delete_conversation
-from typing import List, Dict
+from db.db_conversations import create_conversation, get_all_conversations, stream_all_conversations, get_conversation, get_conversation_window, update_conversation, delete_conversation, conversation_cache, get_conversation_stamp, get_conversation_stamps
+from typing import AsyncIterator, List, Dict, Optional
 from models.schemas import ConversationCreate, ConversationFull, ConversationUpdate, ConversationRead, APIError
 from utils.errors import create_error_response
+from utils.conditional import conversation_etag, conversations_etag, etag_matches, validator_headers
 import logging
+import orjson
+import os
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/conversations", tags=["conversations"])
 
+DEFAULT_PAGE_SIZE = int(os.getenv('CONVERSATIONS_DEFAULT_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.getenv('CONVERSATIONS_MAX_PAGE_SIZE', '1000'))
+
 @router.post("", status_code=status.HTTP_201_CREATED, responses={
   201: {
     "description": "Conversation created successfully",
@@ -52,42 +59,117 @@ async def create_conversation_endpoint(
     error = create_error_response(500, "Internal Server Error", {"method": "POST", "url": "/conversations"}, e)
     raise HTTPException(status_code=500, detail=error.dict())
 
-@router.get("", summary="Get all conversations", description="Retrieve all conversations from the database", responses={
+@router.get("", summary="Get all conversations", description="Retrieve a page of conversations ordered by id, or stream all of them as NDJSON", responses={
   200: {
-    "description": "Conversations retrieved successfully",
-    "model": List[ConversationRead]
+    "description": "Conversations retrieved successfully. The X-Next-Cursor header holds the `after` value for the next page",
+    "model": List[ConversationRead],
+    "content": {
+      "application/x-ndjson": {}
+    }
+  },
+  304: {
+    "description": "The page has not changed since the ETag given in If-None-Match"
   },
   500: {
     "description": "Internal server error",
     "model": APIError
   }
 })
-async def get_conversations_endpoint() -> List[ConversationRead]:
+async def get_conversations_endpoint(
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE, description="The maximum number of conversations to return"),
+    after: Optional[str] = Query(None, description="Return conversations after this conversation id"),
+    stream: bool = Query(False, description="Stream all conversations after the cursor as NDJSON, ignoring limit"),
+    accept: Optional[str] = Header(None),
+    if_none_match: Optional[str] = Header(None)
+) -> List[ConversationRead]:
   """
   Get all conversations 
 
   Args:
-    None
+    limit (int): The maximum number of conversations to return
+    after (Optional[str]): The cursor returned in X-Next-Cursor by the previous page
+    stream (bool): Stream every conversation as NDJSON, also selected by an `application/x-ndjson` Accept header
+    if_none_match (Optional[str]): The ETag of a previously returned page
 
   Returns:
-    List[ConversationRead]: A list of all conversations without their full conversation history
+    List[ConversationRead]: A page of conversations without their full conversation history, with its ETag and
+    Last-Modified, or 304 Not Modified when the page still matches If-None-Match
 
   Raises:
   - 500: If there was an unexpected server error
   """
   try:
-    return await get_all_conversations()
+    if stream or (accept and "application/x-ndjson" in accept):
+      return StreamingResponse(stream_conversations_ndjson(after), media_type="application/x-ndjson")
+
+    # compare the page's stamps before reading the conversations themselves
+    stamps = await get_conversation_stamps(limit=limit, after=after)
+    headers = validator_headers(conversations_etag(stamps), max((stamp["updated_at"] for stamp in stamps if stamp.get("updated_at")), default=None))
+    if len(stamps) == limit:
+      headers["X-Next-Cursor"] = stamps[-1]["_id"]
+    if etag_matches(if_none_match, headers["ETag"]):
+      return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # the conversations are read as plain dicts and serialised without building models
+    conversations = await get_all_conversations(limit=limit, after=after)
+    if len(conversations) == limit:
+      headers["X-Next-Cursor"] = conversations[-1]["_id"]
+    return ORJSONResponse(content=conversations, headers=headers)
   except Exception as e:
     logging.error(f"Error getting conversations: {str(e)}")
     error = create_error_response(500, "Internal Server Error", {"method": "GET", "url": "/conversations"}, e)
     raise HTTPException(status_code=500, detail=error.dict())
 
+async def stream_conversations_ndjson(after: Optional[str]) -> AsyncIterator[bytes]:
+  """
+  Serialise conversations as NDJSON lines as they are read from the database
+  """
+  async for conversation in stream_all_conversations(after=after):
+    yield orjson.dumps(conversation) + b"\n"
+
+
+@router.get("/cache/stats", responses={
+  200: {
+    "description": "Conversation cache statistics",
+    "model": Dict[str, float]
+  },
+  500: {
+    "description": "Internal server error",
+    "model": APIError
+  }
+},
+summary="Get conversation cache statistics",
+description="Retrieve the hit ratio and estimated memory use of this process's cache of conversation histories")
+async def get_conversation_cache_stats_endpoint() -> Dict[str, float]:
+  """
+  Get the conversation cache's statistics
+
+  Returns:
+    Dict[str, float]: The number of cached conversations and their estimated size in bytes, with the limits on both,
+    and the hits, misses, hit ratio, extensions by new messages, invalidations and evictions
+
+  Raises:
+    - 500: If there was an unexpected server error
+  """
+  try:
+    return conversation_cache.stats()
+  except Exception as e:
+    logging.error(f"Error getting conversation cache stats: {str(e)}")
+    error = create_error_response(500, "Internal Server Error", {"method": "GET", "url": "/conversations/cache/stats"}, e)
+    raise HTTPException(status_code=500, detail=error.dict())
 
-@router.get("/{conversation_id}", summary="Get a conversation by ID", description="Retrieve a conversation by its unique identifier", responses={
+@router.get("/{conversation_id}", summary="Get a conversation by ID", description="Retrieve a conversation by its unique identifier, optionally with only a window of its history", response_model_exclude_none=True, responses={
+  304: {
+    "description": "The conversation has not changed since the ETag given in If-None-Match"
+  },
   200: {
     "description": "Conversation retrieved successfully",
     "model": ConversationFull
   },
+  400: {
+    "description": "Invalid parameter(s)",
+    "model": APIError
+  },
   404: {
     "description": "Conversation not found",
     "model": APIError
@@ -97,22 +179,54 @@ async def get_conversations_endpoint() -> List[ConversationRead]:
     "model": APIError
   }
 })
-async def get_conversation_endpoint(conversation_id: str) -> ConversationFull:
+async def get_conversation_endpoint(
+    conversation_id: str,
+    before: Optional[int] = Query(None, ge=0, description="Only return messages with a sequence lower than this"),
+    after: Optional[int] = Query(None, ge=0, description="Only return messages with a sequence greater than this"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="The maximum number of messages to return"),
+    tail: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Return only the newest messages"),
+    if_none_match: Optional[str] = Header(None)
+) -> ConversationFull:
   """
   Get a conversation by id
 
   Args:
     conversation_id (str): The unique identifier for the conversation
+    before (Optional[int]): Sequence cursor to page towards older messages
+    after (Optional[int]): Sequence cursor to page towards newer messages
+    limit (Optional[int]): The maximum number of messages to return
+    tail (Optional[int]): Return the newest `tail` messages, cannot be combined with the other window parameters
+    if_none_match (Optional[str]): The ETag of a previously returned read of the conversation
 
   Returns:
-    ConversationFull: The conversation with the given id and its full conversation history
+    ConversationFull: The conversation with the given id and its full conversation history,
+    or a window of it together with the total message count when window parameters are given.
+    The response carries the conversation's ETag and Last-Modified, and is 304 Not Modified without
+    reading the messages when the conversation still matches If-None-Match
 
   Raises:
+  - 400: If tail is combined with other window parameters
   - 404: If the conversation is not found
   - 500: If there was an unexpected server error
   """
   try:
-    return await get_conversation(conversation_id)
+    if tail is not None and (before is not None or after is not None or limit is not None):
+      error = create_error_response(400, "Invalid parameters provided", {"method": "GET", "url": "/conversations/" + conversation_id}, ValueError("tail cannot be combined with before, after or limit"))
+      raise HTTPException(status_code=400, detail=error.dict())
+
+    stamp = await get_conversation_stamp(conversation_id)
+    headers = validator_headers(conversation_etag(stamp), stamp.get("updated_at"))
+    if etag_matches(if_none_match, headers["ETag"]):
+      return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # the conversation is read as plain dicts and serialised without building models
+    if before is None and after is None and limit is None and tail is None:
+      conversation = await get_conversation(conversation_id)
+    else:
+      conversation = await get_conversation_window(conversation_id, before=before, after=after, limit=limit, tail=tail)
+    return ORJSONResponse(content=conversation, headers=headers)
+  except HTTPException:
+    raise
   except DocumentNotFound as e:
     logging.error(f"Error getting conversation: {str(e)}")
     error = create_error_response(404, "Conversation not found", {"method": "GET", "url": "/conversations/" + conversation_id}, e)
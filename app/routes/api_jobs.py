@@ -0,0 +1,90 @@
+from fastapi import APIRouter, HTTPException, Query
+from typing import Dict
+from models.schemas import JobRead, APIError
+from utils.jobs import job_pool
+from utils.errors import create_error_response
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/jobs", tags=["jobs"])
+
+JOB_MAX_WAIT = float(os.getenv('JOB_MAX_WAIT', '30'))
+
+@router.get("/stats", responses={
+  200: {
+    "description": "Worker pool and queue statistics",
+    "model": Dict[str, float]
+  },
+  500: {
+    "description": "Internal server error",
+    "model": APIError
+  }
+},
+summary="Get query job statistics",
+description="Retrieve the queue depth, worker usage and job timings of the query job pool")
+async def get_job_stats_endpoint() -> Dict[str, float]:
+  """
+  Get the query job pool's statistics
+
+  Returns:
+    Dict[str, float]: The number of workers and busy workers, queued jobs and the queue limit,
+    completed and failed jobs, and the average time jobs spent queued and running in this process
+
+  Raises:
+    - 500: If there was an unexpected server error
+  """
+  try:
+    return await job_pool.stats()
+  except Exception as e:
+    logging.error(f"Error getting job stats: {str(e)}")
+    error = create_error_response(500, "Internal Server Error", {"method": "GET", "url": "/jobs/stats"}, e)
+    raise HTTPException(status_code=500, detail=error.dict())
+
+@router.get("/{job_id}", response_model=JobRead, responses={
+  200: {
+    "description": "Job retrieved successfully",
+    "model": JobRead
+  },
+  500: {
+    "description": "Internal server error",
+    "model": APIError
+  },
+  404: {
+    "description": "Job not found",
+    "model": APIError
+  }
+},
+summary="Get a query job",
+description="Retrieve a query job and its result, optionally waiting for it to finish")
+async def get_job_endpoint(
+    job_id: str,
+    wait: float = Query(0, ge=0, description=f"Wait up to this many seconds for the job to finish, at most {JOB_MAX_WAIT:g}")
+) -> JobRead:
+  """
+  Get a query job by id
+
+  Args:
+    job_id (str): The unique identifier for the job
+    wait (float): Long-poll for up to this many seconds until the job completes or fails
+
+  Returns:
+    JobRead: The job's status, its response once completed or its error once failed, and its timings
+
+  Raises:
+    - 404: If the job is not found
+    - 500: If there was an unexpected server error
+  """
+  try:
+    job = await job_pool.wait(job_id, min(wait, JOB_MAX_WAIT))
+    if job is None:
+      error = create_error_response(404, "Job not found", {"method": "GET", "url": f"/jobs/{job_id}"}, Exception(f"Job with ID {job_id} not found"))
+      raise HTTPException(status_code=404, detail=error.dict())
+    return JobRead.model_validate(job.model_dump(by_alias=True))
+  except HTTPException:
+    raise
+  except Exception as e:
+    logging.error(f"Error getting job {job_id}: {str(e)}")
+    error = create_error_response(500, "Internal Server Error", {"method": "GET", "url": f"/jobs/{job_id}"}, e)
+    raise HTTPException(status_code=500, detail=error.dict())
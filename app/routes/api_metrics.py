@@ -0,0 +1,80 @@
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import PlainTextResponse
+from models.schemas import APIError
+from db.db_conversations import conversation_cache
+from db.db_query import prompt_writer
+from utils import completion_cache
+from utils.compression import compression_stats
+from utils.errors import create_error_response
+from utils.jobs import job_pool
+from utils.metrics import registry
+from utils.openai import breakers, hedgers, limiter, scheduler
+from utils.pipeline import query_flights, idempotency_flights, conversation_mailboxes
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(tags=["metrics"])
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+async def job_stats():
+  # counts the queued jobs in MongoDB
+  return [({}, await job_pool.stats())]
+
+# the components below already keep their stats, they are only read when /metrics is scraped
+registry.register_stats("llm", "LLM calls in flight across all conversations", lambda: [({}, {"requests_in_flight": limiter.in_flight})])
+registry.register_stats("llm_admission", "LLM rate limit admission", lambda: [({}, scheduler.stats())])
+registry.register_stats("llm_breaker", "LLM circuit breaker by provider, open is 1 while calls fail fast", lambda: [
+  ({"provider": provider}, {**breaker.stats(), "open": int(breaker.state != breaker.CLOSED)}) for provider, breaker in list(breakers.items())
+])
+registry.register_stats("llm_hedge", "LLM call hedging by provider and model", lambda: [
+  ({"model": model_key}, hedger.stats()) for model_key, hedger in list(hedgers.items())
+])
+registry.register_stats("query_flights", "Identical concurrent queries coalesced into one run", lambda: [
+  ({"flight": "query"}, {"in_flight": query_flights.in_flight, "executions": query_flights.executions, "coalesced": query_flights.coalesced}),
+  ({"flight": "idempotency"}, {"in_flight": idempotency_flights.in_flight, "executions": idempotency_flights.executions, "coalesced": idempotency_flights.coalesced})
+])
+registry.register_stats("query_mailboxes", "Conversation turns queued behind each other", lambda: [
+  ({}, {"active": len(conversation_mailboxes), "queued": conversation_mailboxes.queued, "processed": conversation_mailboxes.processed})
+])
+registry.register_stats("query_jobs", "Asynchronous query job pool", job_stats)
+registry.register_stats("prompt_writer", "Prompt inserts grouped into bulk writes", lambda: [
+  ({}, {"writes": prompt_writer.writes, "batches": prompt_writer.batches})
+])
+registry.register_stats("completion_cache", "Completion cache", lambda: [({}, completion_cache.get_stats())])
+registry.register_stats("conversation_cache", "Conversation history cache", lambda: [({}, conversation_cache.stats())])
+registry.register_stats("compression", "Response compression by route template and content coding", lambda: [
+  ({"route": stats["route"], "encoding": stats["encoding"]}, stats) for stats in compression_stats.stats()
+])
+
+@router.get("/metrics", response_class=PlainTextResponse, responses={
+  200: {
+    "description": "Metrics in the Prometheus text format",
+    "content": {PROMETHEUS_CONTENT_TYPE: {}}
+  },
+  500: {
+    "description": "Internal server error",
+    "model": APIError
+  }
+},
+summary="Get metrics",
+description="Retrieve the query pipeline's stage latencies, MongoDB command timings, LLM token usage, requests in flight and the stats of the caches, queues and rate limits in the Prometheus text format")
+async def get_metrics_endpoint() -> PlainTextResponse:
+  """
+  Render this process's metrics for a Prometheus scrape
+
+  Returns:
+    PlainTextResponse: Histograms of the seconds spent in each query pipeline stage, in MongoDB commands and in HTTP
+    requests, LLM tokens by model, HTTP requests in flight, and the stats of the LLM limits, breakers and hedgers,
+    coalesced queries, conversation mailboxes, job pool, prompt writer, caches and response compression
+
+  Raises:
+    - 500: If there was an unexpected server error
+  """
+  try:
+    return PlainTextResponse(await registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+  except Exception as e:
+    logging.error(f"Error rendering metrics: {str(e)}")
+    error = create_error_response(500, "Internal Server Error", {"method": "GET", "url": "/metrics"}, e)
+    raise HTTPException(status_code=500, detail=error.dict())
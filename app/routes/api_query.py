@@ -1,19 +1,174 @@
-from fastapi import APIRouter, HTTPException, Depends
-from typing import Dict
-from models.schemas import PromptCreate, ConversationFull, APIError
-from db.db_query import create_prompt
-from utils.openai import generate_response, OpenAIException
-from db.db_conversations import add_message_to_conversation
-from utils.errors import create_error_response
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Response
+from fastapi.responses import StreamingResponse
+from typing import Any, AsyncIterator, Dict, List, Optional
+from models.schemas import PromptCreate, APIError, StreamFormat, QueryMode, BatchQueryItem
+from utils.openai import OpenAIException
+from utils.scheduler import RateLimitExceeded, AdmissionQueueFull
+from utils.resilience import CircuitOpenError
+from utils.pipeline import open_query_stream, run_query_once, run_query_idempotent, run_query_batch
+from utils.jobs import job_pool, JobQueueFull
+from db.db_conversations import conversation_exists
+from db.db_idempotency import IdempotencyKeyMismatch, IdempotencyKeyInProgress
+from utils.errors import create_error_response, create_query_error_response
 from beanie.exceptions import DocumentNotFound
+import json
 import logging
+import math
+import os
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/query", tags=["query"])
 
+BATCH_QUERY_MAX_ITEMS = int(os.getenv('BATCH_QUERY_MAX_ITEMS', '10000'))
+
+STREAM_MEDIA_TYPES = {
+  StreamFormat.sse: "text/event-stream",
+  StreamFormat.ndjson: "application/x-ndjson"
+}
+
+def get_stream_format(stream: Optional[StreamFormat], accept: Optional[str]) -> Optional[StreamFormat]:
+  """
+  Pick the streaming format from the query flag, falling back to the Accept header
+
+  Args:
+    stream (Optional[StreamFormat]): The explicitly requested stream format
+    accept (Optional[str]): The request's Accept header
+
+  Returns:
+    Optional[StreamFormat]: The stream format, or None if the client wants a single JSON response
+  """
+  if stream is not None:
+    return stream
+  if accept:
+    for stream_format, media_type in STREAM_MEDIA_TYPES.items():
+      if media_type in accept:
+        return stream_format
+  return None
+
+def format_stream_event(stream_format: StreamFormat, event: str, data: Dict[str, Any]) -> str:
+  """
+  Serialise a single stream event as an SSE frame or an NDJSON line
+  """
+  if stream_format == StreamFormat.sse:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+  return json.dumps({"event": event, **data}) + "\n"
+
+async def stream_query(conversation_id: str, deltas: AsyncIterator[str], stream_format: StreamFormat) -> AsyncIterator[str]:
+  """
+  Forward LLM deltas to the client as stream events, ending with the assembled response
+
+  Args:
+    conversation_id (str): The unique identifier for the conversation
+    deltas (AsyncIterator[str]): The LLM's response deltas
+    stream_format (StreamFormat): The wire format of the stream
+
+  Yields:
+    str: Serialised stream events
+  """
+  chunks = []
+  try:
+    async for delta in deltas:
+      chunks.append(delta)
+      yield format_stream_event(stream_format, "delta", {"content": delta})
+
+    yield format_stream_event(stream_format, "done", {"response": "".join(chunks).strip()})
+  except CircuitOpenError as e:
+    logging.error(f"Error streaming LLM response: {str(e)}")
+    error = create_error_response(503, "LLM is unavailable", {"method": "POST", "url": "/query/" + conversation_id}, e)
+    yield format_stream_event(stream_format, "error", error.dict())
+  except OpenAIException as e:
+    logging.error(f"Error streaming LLM response: {str(e)}")
+    error = create_error_response(422, "Unable to create resource due to errors", {"method": "POST", "url": "/query/" + conversation_id}, e)
+    yield format_stream_event(stream_format, "error", error.dict())
+  except Exception as e:
+    logging.error(f"Error streaming LLM response: {str(e)}")
+    error = create_error_response(500, "Internal Server Error", {"method": "POST", "url": "/query/" + conversation_id}, e)
+    yield format_stream_event(stream_format, "error", error.dict())
+
+async def stream_batch_results(items: List[BatchQueryItem], force_cache: bool, stream_format: StreamFormat) -> AsyncIterator[str]:
+  """
+  Run a batch of queries and stream each item's result or error as soon as it completes, ending with a summary
+
+  Args:
+    items (List[BatchQueryItem]): The conversations and the prompts to send to them
+    force_cache (bool): Use the completion cache even when the conversations sample with a temperature above 0
+    stream_format (StreamFormat): The wire format of the stream
+
+  Yields:
+    str: Serialised stream events
+  """
+  completed = failed = 0
+  async for index, result in run_query_batch(items, force_cache):
+    conversation_id = items[index].conversation_id
+    if isinstance(result, Exception):
+      failed += 1
+      logging.error(f"Error querying LLM for batch item {index}: {str(result)}")
+      error = create_query_error_response(conversation_id, result)
+      yield format_stream_event(stream_format, "error", {"index": index, "conversation_id": conversation_id, "error": error.dict()})
+    else:
+      completed += 1
+      yield format_stream_event(stream_format, "result", {"index": index, "conversation_id": conversation_id, "response": result.content})
+  yield format_stream_event(stream_format, "done", {"completed": completed, "failed": failed})
+
+@router.post("/batch", responses={
+  200: {
+    "description": "Batch started. Each item's result is streamed as NDJSON, or as Server-Sent Events when requested, in completion order",
+    "content": {
+      "application/x-ndjson": {},
+      "text/event-stream": {}
+    }
+  },
+  400: {
+    "description": "Invalid parameter(s)",
+    "model": APIError
+  }
+},
+summary="Query many conversations",
+description="Send prompts to many conversations concurrently and stream back each result as it completes")
+async def query_batch_endpoint(
+    items: List[BatchQueryItem],
+    stream: Optional[StreamFormat] = None,
+    force_cache: bool = Query(False, description="Use the completion cache even when the conversations sample with a temperature above 0"),
+    accept: Optional[str] = Header(None)
+) -> StreamingResponse:
+  """
+  Query the LLM for a batch of conversations
+
+  Args:
+    items (List[BatchQueryItem]): The conversations and the prompts to send to them, prompts to the same conversation run in list order
+    stream (Optional[StreamFormat]): The stream format, NDJSON unless "sse" is requested here or in the Accept header
+    force_cache (bool): Use the completion cache even when the conversations sample with a temperature above 0
+    accept (Optional[str]): Accept header, used to select a stream format when `stream` is not given
+
+  Returns:
+    StreamingResponse: A "result" event with the response, or an "error" event with the API error, for every item
+    as it completes, each carrying the item's index, followed by a "done" event counting both
+
+  Raises:
+    - 400: If the batch is empty or has more than BATCH_QUERY_MAX_ITEMS items
+  """
+  if not 0 < len(items) <= BATCH_QUERY_MAX_ITEMS:
+    error = create_error_response(400, "Invalid parameters provided", {"method": "POST", "url": "/query/batch"}, Exception(f"A batch must have between 1 and {BATCH_QUERY_MAX_ITEMS} items"))
+    raise HTTPException(status_code=400, detail=error.dict())
+
+  stream_format = get_stream_format(stream, accept) or StreamFormat.ndjson
+  return StreamingResponse(
+    stream_batch_results(items, force_cache, stream_format),
+    media_type=STREAM_MEDIA_TYPES[stream_format],
+    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+  )
+
 @router.post("/{conversation_id}", responses={
   200: {
-    "description": "Query successful",
+    "description": "Query successful. Streamed as Server-Sent Events or NDJSON when requested via the `stream` flag or the Accept header",
+    "model": Dict[str, str],
+    "content": {
+      "text/event-stream": {},
+      "application/x-ndjson": {}
+    }
+  },
+  202: {
+    "description": "Query job queued, with `mode=async`",
     "model": Dict[str, str]
   },
   500: {
@@ -23,57 +178,127 @@ router = APIRouter(prefix="/query", tags=["query"])
   404: {
     "description": "Conversation not found",
     "model": APIError
+  },
+  409: {
+    "description": "Request with the same idempotency key is in progress",
+    "model": APIError
+  },
+  422: {
+    "description": "LLM error, or idempotency key reused with a different request",
+    "model": APIError
+  },
+  429: {
+    "description": "LLM rate limits cannot admit the query in time, retry after the Retry-After header",
+    "model": APIError
+  },
+  503: {
+    "description": "Query job queue or LLM admission queue is full",
+    "model": APIError
   }
 })
-async def query_endpoint(conversation_id: str, query: PromptCreate) -> Dict[str, str]:
+async def query_endpoint(
+    conversation_id: str,
+    query: PromptCreate,
+    response: Response,
+    stream: Optional[StreamFormat] = None,
+    mode: QueryMode = Query(QueryMode.sync, description="`async` queues the query as a job and returns its id, poll GET /jobs/{job_id} for the response"),
+    force_cache: bool = Query(False, description="Use the completion cache even when the conversation samples with a temperature above 0"),
+    accept: Optional[str] = Header(None),
+    idempotency_key: Optional[str] = Header(None, max_length=255, description="Retries with the same key replay the first response instead of querying again. Not applied to streamed queries")
+) -> Dict[str, str]:
   """
   Query the LLM and return the response
 
   Args:
     id (str): The unique identifier for the query
     prompt (PromptCreate): The prompt object containing the query content
-    
+    stream (Optional[StreamFormat]): Stream the response token by token as "sse" or "ndjson"
+    mode (QueryMode): "async" returns a job id right away instead of waiting for the LLM, streaming is not applied to async queries.
+      Retries with the Idempotency-Key of an earlier async query return that query's job
+    force_cache (bool): Use the completion cache even when the conversation samples with a temperature above 0
+    accept (Optional[str]): Accept header, used to select a stream format when `stream` is not given
+    idempotency_key (Optional[str]): Idempotency-Key header, retries with the same key replay the stored response
+
   Returns:
-    str: The LLM's response
-  
+    str: The LLM's response. The X-Context-* headers describe which messages were sent to the LLM,
+    X-Cache tells whether the completion cache was hit, missed or bypassed, and X-Coalesced is set
+    when the response was shared with an identical query that was already in flight.
+    In async mode, the id of the queued job with status 202
+
   Raises:
     - 404: If the conversation is not found
+    - 409: If a request with the same Idempotency-Key is still in progress
+    - 422: If the LLM call failed or the Idempotency-Key was used with a different request
+    - 429: If the LLM rate limits cannot admit the query in time
+    - 503: If the query job queue or the LLM admission queue is full
     - 500: If there was an unexpected server error
   """
   try:
-    # create the prompt in the database
-    created_prompt = await create_prompt(conversation_id, query)
-
-    prompt_id = created_prompt["prompt_id"]
-    message_tokens = created_prompt["tokens"]
-
-    # add the query to the conversation and get the updated conversation messages
-    conversation: ConversationFull = await add_message_to_conversation(conversation_id, prompt_id, message_tokens)
-
-    # query the LLM
-    prompt_response: PromptCreate = generate_response(conversation)
+    if mode == QueryMode.async_:
+      if not await conversation_exists(conversation_id):
+        raise DocumentNotFound(f"Conversation with ID {conversation_id} not found")
+      job, replayed = await job_pool.submit(conversation_id, query, force_cache, idempotency_key)
+      response.status_code = 202
+      response.headers["Location"] = f"/jobs/{job.id}"
+      if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+      return {
+        "job_id": job.id
+      }
 
-    # add the response to the conversation and get the updated conversation messages
-    created_prompt_response = await create_prompt(conversation_id, prompt_response)
-    prompt_id = created_prompt_response["prompt_id"]
-    message_tokens = created_prompt_response["tokens"]
+    stream_format = get_stream_format(stream, accept)
+    if stream_format is not None:
+      headers, deltas = await open_query_stream(conversation_id, query, force_cache)
+      return StreamingResponse(
+        stream_query(conversation_id, deltas, stream_format),
+        media_type=STREAM_MEDIA_TYPES[stream_format],
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", **headers}
+      )
 
-    # add the response to the conversation and get the updated conversation messages
-    await add_message_to_conversation(conversation_id, prompt_id, message_tokens)
+    # run the query, sharing the LLM call with an identical query that is already in flight
+    if idempotency_key is not None:
+      prompt_response, headers = await run_query_idempotent(conversation_id, query, idempotency_key, force_cache)
+    else:
+      prompt_response, headers = await run_query_once(conversation_id, query, force_cache)
+    response.headers.update(headers)
 
     return {
       "response": prompt_response.content
     }
-  
+
   except DocumentNotFound as e:
     logging.error(f"Error querying LLM: {str(e)}")
     error = create_error_response(404, "Conversation not found", {"method": "POST", "url": "/query/" + conversation_id}, e)
     raise HTTPException(status_code=404, detail=error.dict())
+  except JobQueueFull as e:
+    logging.error(f"Error querying LLM: {str(e)}")
+    error = create_error_response(503, "Query job queue is full", {"method": "POST", "url": "/query/" + conversation_id}, e)
+    raise HTTPException(status_code=503, detail=error.dict())
+  except IdempotencyKeyInProgress as e:
+    logging.error(f"Error querying LLM: {str(e)}")
+    error = create_error_response(409, "Request with the same idempotency key is in progress", {"method": "POST", "url": "/query/" + conversation_id}, e)
+    raise HTTPException(status_code=409, detail=error.dict())
+  except IdempotencyKeyMismatch as e:
+    logging.error(f"Error querying LLM: {str(e)}")
+    error = create_error_response(422, "Idempotency key was used with a different request", {"method": "POST", "url": "/query/" + conversation_id}, e)
+    raise HTTPException(status_code=422, detail=error.dict())
+  except RateLimitExceeded as e:
+    logging.error(f"Error querying LLM: {str(e)}")
+    error = create_error_response(429, "Rate limit exceeded", {"method": "POST", "url": "/query/" + conversation_id}, e)
+    raise HTTPException(status_code=429, detail=error.dict(), headers={"Retry-After": str(math.ceil(e.retry_after))})
+  except AdmissionQueueFull as e:
+    logging.error(f"Error querying LLM: {str(e)}")
+    error = create_error_response(503, "Too many queries are waiting for the LLM", {"method": "POST", "url": "/query/" + conversation_id}, e)
+    raise HTTPException(status_code=503, detail=error.dict(), headers={"Retry-After": str(math.ceil(e.retry_after))})
+  except CircuitOpenError as e:
+    logging.error(f"Error querying LLM: {str(e)}")
+    error = create_error_response(503, "LLM is unavailable", {"method": "POST", "url": "/query/" + conversation_id}, e)
+    raise HTTPException(status_code=503, detail=error.dict(), headers={"Retry-After": str(math.ceil(e.retry_after))})
   except OpenAIException as e:
     logging.error(f"Error querying LLM: {str(e)}")
     error = create_error_response(422, "Unable to create resource due to errors", {"method": "POST", "url": "/query/" + conversation_id}, e)
     raise HTTPException(status_code=422, detail=error.dict())
-  except Exception as e: 
+  except Exception as e:
     logging.error(f"Error querying LLM: {str(e)}")
     error = create_error_response(500, "Internal Server Error", {"method": "POST", "url": "/query/" + conversation_id}, e)
     raise HTTPException(status_code=500, detail=error.dict())
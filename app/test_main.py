@@ -1,20 +1,34 @@
 import os
 os.environ['ENVIRONMENT'] = 'testing'
 import pytest
+import pytest_asyncio
 from httpx import AsyncClient
 from unittest.mock import patch, AsyncMock
 from models.models import Conversation, Prompt
-from models.schemas import ConversationFull, PromptCreate
+from models.schemas import ConversationFull, PromptCreate, PromptRead
 from beanie import init_beanie
 from mongomock_motor import AsyncMongoMockClient
 import logging
 
 from main import app  # Adjust based on your project structure
 
+async def fake_build_prompt(conversation_id, prompt, anonymised=False, prompt_id=None):
+    return Prompt(role=prompt.role, content=prompt.content, conversation_id=conversation_id, tokens=10)
+
+@pytest_asyncio.fixture
+async def mock_db():
+    # Back the Beanie models with an in-memory MongoDB for database level tests
+    from db.db import DOCUMENT_MODELS
+
+    client = AsyncMongoMockClient()
+    await init_beanie(database=client["test"], document_models=DOCUMENT_MODELS)
+    yield client["test"]
+
 @pytest.mark.asyncio
 async def test_get_conversations():
     # Mock the get_all_conversations function
-    with patch('routes.api_conversations.get_all_conversations', new_callable=AsyncMock) as mock_get_all:
+    with patch('routes.api_conversations.get_all_conversations', new_callable=AsyncMock) as mock_get_all, \
+         patch('routes.api_conversations.get_conversation_stamps', new_callable=AsyncMock, return_value=[{"_id": "1", "version": 0, "stored_messages": 0}]):
         # Define what the mock should return
         mock_get_all.return_value = [
             {
@@ -31,12 +45,14 @@ async def test_get_conversations():
 
         assert response.status_code == 200
         assert response.json() == mock_get_all.return_value
+        assert response.headers["ETag"].startswith('W/"')
         mock_get_all.assert_awaited_once()
 
 @pytest.mark.asyncio
 async def test_get_conversation():
     # Mock the get_conversation function
-    with patch('routes.api_conversations.get_conversation', new_callable=AsyncMock) as mock_get_by_id:
+    with patch('routes.api_conversations.get_conversation', new_callable=AsyncMock) as mock_get_by_id, \
+         patch('routes.api_conversations.get_conversation_stamp', new_callable=AsyncMock, return_value={"_id": "1", "version": 0, "stored_messages": 0}):
         # Define what the mock should return
         mock_get_by_id.return_value = {
             "_id": "1",
@@ -52,6 +68,7 @@ async def test_get_conversation():
 
         assert response.status_code == 200
         assert response.json() == mock_get_by_id.return_value
+        assert response.headers["ETag"] == 'W/"0-0"'
         mock_get_by_id.assert_awaited_once()
 
 @pytest.mark.asyncio
@@ -110,21 +127,18 @@ async def test_delete_conversation():
         mock_delete.assert_awaited_once()
 
 @pytest.mark.asyncio
-async def test_create_prompt():
+async def test_create_prompt(mock_db):
     conversation_id = "test_id"
     query = PromptCreate(content="Test query", role="user")
 
     # Mock all the function calls
-    with patch('routes.api_query.create_prompt', new_callable=AsyncMock) as mock_create_prompt, \
-         patch('routes.api_query.add_message_to_conversation', new_callable=AsyncMock) as mock_add_message, \
-         patch('routes.api_query.generate_response') as mock_generate_response:
+    with patch('utils.pipeline.build_prompt', new_callable=AsyncMock, side_effect=fake_build_prompt) as mock_build_prompt, \
+         patch('utils.pipeline.save_prompts', new_callable=AsyncMock) as mock_save_prompts, \
+         patch('utils.pipeline.get_conversation_full', new_callable=AsyncMock) as mock_get_conversation_full, \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock) as mock_generate_response:
 
         # Set up return values for the mocks
-        mock_create_prompt.side_effect = [
-            {"prompt_id": "prompt1", "tokens": 10},  # For the query
-            {"prompt_id": "prompt2", "tokens": 15}   # For the response
-        ]
-        mock_add_message.return_value = ConversationFull(id=conversation_id, name="Test Conversation", params={}, tokens=0, messages=[])
+        mock_get_conversation_full.return_value = ConversationFull(id=conversation_id, name="Test Conversation", params={}, tokens=0, messages=[])
         mock_generate_response.return_value = PromptCreate(content="Test response", role="assistant")
 
         # Make the request
@@ -134,13 +148,1255 @@ async def test_create_prompt():
         # Assertions
         assert response.status_code == 200
         assert response.json() == {"response": "Test response"}
+        assert response.headers["X-Context-Messages-Dropped"] == "0"
+        assert response.headers["X-Cache"] == "BYPASS"
 
         # Verify that our mocked functions were called with the expected arguments
-        mock_create_prompt.assert_any_call(conversation_id, query)
-        mock_add_message.assert_any_call(conversation_id, "prompt1", 10)
-        mock_generate_response.assert_called_once()
-        mock_create_prompt.assert_any_call(conversation_id, PromptCreate(content="Test response", role="assistant"))
-        mock_add_message.assert_any_call(conversation_id, "prompt2", 15)
-
-    
-            
\ No newline at end of file
+        mock_build_prompt.assert_any_call(conversation_id, query, anonymised=False, prompt_id=None)
+        mock_get_conversation_full.assert_awaited_once_with(conversation_id)
+        mock_generate_response.assert_awaited_once()
+        assert mock_generate_response.await_args.args[0].messages[-1].content == "Test query"
+        mock_build_prompt.assert_any_call(conversation_id, PromptCreate(content="Test response", role="assistant"), prompt_id=None)
+        # the query and the response are written together
+        mock_save_prompts.assert_awaited_once()
+        saved = mock_save_prompts.await_args.args[1]
+        assert [(prompt.role, prompt.content) for prompt in saved] == [("user", "Test query"), ("assistant", "Test response")]
+
+@pytest.mark.asyncio
+async def test_generate_response_respects_concurrency_limits():
+    import asyncio
+    from types import SimpleNamespace
+    from utils import openai as openai_utils
+    from utils.limiter import ConcurrencyLimiter
+
+    active = {"conversation": 0, "peak": 0}
+
+    async def fake_create(**kwargs):
+        active["conversation"] += 1
+        active["peak"] = max(active["peak"], active["conversation"])
+        await asyncio.sleep(0.01)
+        active["conversation"] -= 1
+        completion = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=" Hi "))])
+        return SimpleNamespace(headers={}, parse=lambda: completion)
+
+    fake_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(with_raw_response=SimpleNamespace(create=fake_create))))
+    limiter = ConcurrencyLimiter(global_limit=10, per_key_limit=2)
+    conversation = ConversationFull(id="1", name="Test Conversation", params={}, tokens=0, messages=[])
+
+    with patch.object(openai_utils, 'get_client', return_value=fake_client), \
+         patch.object(openai_utils, 'limiter', limiter):
+        responses = await asyncio.gather(*[openai_utils.generate_response(conversation) for _ in range(6)])
+
+    assert all(response == PromptCreate(content="Hi", role="assistant") for response in responses)
+    assert active["peak"] == 2
+    assert limiter.in_flight == 0
+    assert limiter._per_key == {}
+
+@pytest.mark.asyncio
+async def test_create_prompt_streaming(mock_db):
+    import json
+    conversation_id = "test_id"
+    query = PromptCreate(content="Test query", role="user")
+
+    async def fake_stream(conversation):
+        for delta in ["Test", " response"]:
+            yield delta
+
+    with patch('utils.pipeline.build_prompt', new_callable=AsyncMock, side_effect=fake_build_prompt) as mock_build_prompt, \
+         patch('utils.pipeline.save_prompts', new_callable=AsyncMock) as mock_save_prompts, \
+         patch('utils.pipeline.get_conversation_full', new_callable=AsyncMock) as mock_get_conversation_full, \
+         patch('utils.pipeline.stream_response', new=fake_stream):
+
+        mock_get_conversation_full.return_value = ConversationFull(id=conversation_id, name="Test Conversation", params={}, tokens=0, messages=[])
+
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            ndjson_response = await client.post(f"/query/{conversation_id}?stream=ndjson", json=query.dict())
+
+        assert ndjson_response.status_code == 200
+        assert ndjson_response.headers["content-type"].startswith("application/x-ndjson")
+        events = [json.loads(line) for line in ndjson_response.text.splitlines()]
+        assert events == [
+            {"event": "delta", "content": "Test"},
+            {"event": "delta", "content": " response"},
+            {"event": "done", "response": "Test response"}
+        ]
+        mock_build_prompt.assert_any_call(conversation_id, PromptCreate(content="Test response", role="assistant"))
+        assert mock_build_prompt.await_count == 2
+        mock_save_prompts.assert_awaited_once()
+
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            sse_response = await client.post(f"/query/{conversation_id}", json=query.dict(), headers={"Accept": "text/event-stream"})
+
+        assert sse_response.status_code == 200
+        assert sse_response.headers["content-type"].startswith("text/event-stream")
+        assert sse_response.text.startswith('event: delta\ndata: {"content": "Test"}\n\n')
+        assert 'event: done\ndata: {"response": "Test response"}\n\n' in sse_response.text
+
+@pytest.mark.asyncio
+async def test_add_message_to_conversation(mock_db):
+    from db.db_conversations import add_message_to_conversation, get_conversation_full
+    from db.db_query import create_prompt
+    from beanie.exceptions import DocumentNotFound
+
+    conversation = Conversation(name="Test Conversation", params={"temperature": 0.0})
+    await conversation.insert()
+
+    assert await add_message_to_conversation(conversation.id, 4) == 1
+    assert await add_message_to_conversation(conversation.id, 5) == 2
+
+    with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=2):
+        created = await create_prompt(conversation.id, PromptCreate(content="Hello!", role="user"))
+        await create_prompt(conversation.id, PromptCreate(content="Hi! How can I assist you today?", role="assistant"))
+
+    assert created["sequence"] == 3
+    conversation_full = await get_conversation_full(conversation.id)
+    assert conversation_full.tokens == 13
+    assert conversation_full.params == {"temperature": 0.0}
+    assert [message.content for message in conversation_full.messages] == ["Hello!", "Hi! How can I assist you today?"]
+    assert (await Conversation.get(conversation.id)).message_count == 4
+
+    with pytest.raises(DocumentNotFound):
+        await add_message_to_conversation("missing", 1)
+
+@pytest.mark.asyncio
+async def test_migrate_message_sequences(mock_db):
+    from db.migrations import migrate_message_sequences, migrate_prompt_tokens
+    from db.db_conversations import get_conversation_full
+
+    await Conversation.get_motor_collection().insert_one({
+        "_id": "legacy", "name": "Legacy Conversation", "params": {}, "tokens": 3, "messages": ["b", "a"]
+    })
+    await Prompt.get_motor_collection().insert_many([
+        {"_id": "a", "role": "assistant", "content": "second", "conversation_id": "legacy"},
+        {"_id": "c", "role": "user", "content": "unlinked", "conversation_id": "legacy"},
+        {"_id": "b", "role": "user", "content": "first", "conversation_id": "legacy"},
+    ])
+
+    assert await migrate_message_sequences() == 1
+    assert await migrate_message_sequences() == 0
+
+    conversation_full = await get_conversation_full("legacy")
+    assert [message.content for message in conversation_full.messages] == ["first", "second", "unlinked"]
+    db_conversation = await Conversation.get_motor_collection().find_one({"_id": "legacy"})
+    assert db_conversation["message_count"] == 3
+    assert "messages" not in db_conversation
+
+    # legacy prompts have no token counts, they are counted once rather than on every turn
+    with patch('db.migrations.count_messages_tokens', new_callable=AsyncMock, side_effect=lambda messages: [len(message.content) for message in messages]) as mock_count:
+        assert await migrate_prompt_tokens(batch_size=2) == 3
+        assert await migrate_prompt_tokens() == 0
+    assert mock_count.await_count == 2
+    assert {db_prompt["_id"]: db_prompt["tokens"] async for db_prompt in Prompt.get_motor_collection().find({})} == {"a": 6, "b": 5, "c": 8}
+
+@pytest.mark.asyncio
+async def test_verify_indexes(mock_db):
+    from db.db import verify_indexes
+
+    await verify_indexes()
+    await Prompt.get_motor_collection().drop_index("conversation_id_sequence")
+    with pytest.raises(RuntimeError):
+        await verify_indexes()
+
+def find_plan_stages(plan):
+    # Walk an explain() plan tree and collect every stage name
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages.extend(find_plan_stages(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            stages.extend(find_plan_stages(value))
+    return stages
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(not os.environ.get("MONGODB_URI"), reason="explain() needs a real MongoDB, set MONGODB_URI to run")
+async def test_hot_queries_use_indexes():
+    from motor.motor_asyncio import AsyncIOMotorClient
+    from db.db import verify_indexes
+
+    client = AsyncIOMotorClient(os.environ["MONGODB_URI"])
+    database = client["test_query_plans"]
+    try:
+        await init_beanie(database=database, document_models=[Conversation, Prompt])
+        await verify_indexes()
+        await Prompt.insert_many([Prompt(role="user", content=str(i), conversation_id=str(i % 10)) for i in range(100)])
+        prompts = Prompt.get_motor_collection().name
+
+        hot_queries = {
+            "conversation history": {"find": prompts, "filter": {"conversation_id": "1"}, "sort": {"sequence": 1}},
+            "delete conversation prompts": {"delete": prompts, "deletes": [{"q": {"conversation_id": "1"}, "limit": 0}]},
+        }
+        for name, command in hot_queries.items():
+            explanation = await database.command("explain", command, verbosity="queryPlanner")
+            stages = find_plan_stages(explanation["queryPlanner"]["winningPlan"])
+            assert "COLLSCAN" not in stages, f"{name} falls back to a collection scan: {stages}"
+    finally:
+        await client.drop_database(database.name)
+        client.close()
+
+@pytest.mark.asyncio
+async def test_get_conversations_pagination(mock_db):
+    import json
+
+    await Conversation.insert_many([Conversation(id=f"conversation-{i}", name=f"Conversation {i}", params={}, tokens=i) for i in range(5)])
+
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        first_page = await client.get("/conversations", params={"limit": 2})
+        second_page = await client.get("/conversations", params={"limit": 2, "after": first_page.headers["X-Next-Cursor"]})
+        last_page = await client.get("/conversations", params={"limit": 2, "after": second_page.headers["X-Next-Cursor"]})
+        export = await client.get("/conversations", params={"after": "conversation-0"}, headers={"Accept": "application/x-ndjson"})
+
+    assert [conversation["_id"] for conversation in first_page.json()] == ["conversation-0", "conversation-1"]
+    assert [conversation["_id"] for conversation in second_page.json()] == ["conversation-2", "conversation-3"]
+    assert last_page.json() == [{"_id": "conversation-4", "name": "Conversation 4", "params": {}, "tokens": 4}]
+    assert "X-Next-Cursor" not in last_page.headers
+
+    assert export.headers["content-type"].startswith("application/x-ndjson")
+    assert [json.loads(line)["_id"] for line in export.text.splitlines()] == [f"conversation-{i}" for i in range(1, 5)]
+
+@pytest.mark.asyncio
+async def test_get_conversation_window(mock_db):
+    conversation = Conversation(name="Long Conversation", params={}, tokens=0, message_count=10)
+    await conversation.insert()
+    await Prompt.insert_many([
+        Prompt(role="user" if i % 2 else "assistant", content=f"message {i}", conversation_id=conversation.id, sequence=i)
+        for i in range(1, 11)
+    ])
+
+    def sequences(response):
+        return [message["sequence"] for message in response.json()["messages"]]
+
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        full = await client.get(f"/conversations/{conversation.id}")
+        tail = await client.get(f"/conversations/{conversation.id}", params={"tail": 3})
+        older = await client.get(f"/conversations/{conversation.id}", params={"before": 8, "limit": 3})
+        newer = await client.get(f"/conversations/{conversation.id}", params={"after": 8, "limit": 3})
+        invalid = await client.get(f"/conversations/{conversation.id}", params={"tail": 3, "before": 8})
+
+    assert sequences(full) == list(range(1, 11))
+    assert "message_count" not in full.json()
+    assert sequences(tail) == [8, 9, 10]
+    assert tail.json()["message_count"] == 10
+    assert tail.json()["has_more"] is True
+    assert sequences(older) == [5, 6, 7]
+    assert older.json()["has_more"] is True
+    assert sequences(newer) == [9, 10]
+    assert newer.json()["has_more"] is False
+    assert invalid.status_code == 400
+
+def test_build_context_fits_token_budget():
+    from models.schemas import PromptRead
+    from utils.context import build_context, get_token_budget, CONTEXT_TOKEN_BUDGET
+
+    messages = [PromptRead(_id="0", role="system", content="Be brief.", sequence=1, tokens=10)] + [
+        PromptRead(_id=str(i), role="user" if i % 2 else "assistant", content=f"message {i}", sequence=i + 1, tokens=100)
+        for i in range(1, 11)
+    ]
+    conversation = ConversationFull(id="1", name="Test Conversation", params={"max_tokens": 200}, tokens=1010, messages=messages)
+
+    context, metadata = build_context(conversation, token_budget=563)
+
+    assert [message.id for message in context.messages] == ["0", "8", "9", "10"]
+    assert metadata.messages_sent == 4
+    assert metadata.messages_dropped == 7
+    assert metadata.prompt_tokens == 310
+    assert metadata.token_budget == 360
+    assert len(conversation.messages) == 11
+
+    # the newest message is always sent, even when it does not fit
+    context, metadata = build_context(conversation, token_budget=253)
+    assert [message.id for message in context.messages] == ["0", "10"]
+
+    # the budget is the context window of the model the turn is routed to
+    assert get_token_budget("gpt-3.5-turbo") == 16385
+    assert get_token_budget("gpt-4o-2024-08-06") == 128000
+    assert get_token_budget("gpt-4-0613") == 8192
+    assert get_token_budget("fake") == CONTEXT_TOKEN_BUDGET
+
+@pytest.mark.asyncio
+async def test_token_counter_caches_encoding_and_counts_chat_format():
+    from utils import token_counter
+
+    class FakeEncoding:
+        def encode_ordinary(self, text):
+            return text.split()
+
+    token_counter.get_encoding.cache_clear()
+    try:
+        with patch('utils.token_counter.tiktoken.encoding_for_model', return_value=FakeEncoding()) as mock_encoding_for_model:
+            short = PromptCreate(content="one two three", role="user")
+            long = PromptCreate(content="word " * token_counter.TOKENIZER_OFFLOAD_MIN_CHARS, role="assistant")
+
+            assert await token_counter.count_message_tokens(short) == token_counter.TOKENS_PER_MESSAGE + 3 + 1
+            assert await token_counter.count_messages_tokens([short, long]) == [7, token_counter.TOKENS_PER_MESSAGE + token_counter.TOKENIZER_OFFLOAD_MIN_CHARS + 1]
+            assert token_counter.count_request_tokens([7, 7]) == 14 + token_counter.TOKENS_PER_REPLY
+            mock_encoding_for_model.assert_called_once()
+    finally:
+        token_counter.get_encoding.cache_clear()
+
+def test_local_anonymiser(tmp_path):
+    from utils.anonymise import LocalAnonymiser, load_names
+
+    anonymiser = LocalAnonymiser(names=["Alice"])
+    text = ("Mr John Tan (S1234567D) can be reached at john.tan@example.com or +65 9123 4567. "
+            "Card 4111 1111 1111 1111, order 4111 1111 1111 1112. Ship to 10 Orchard Road, Singapore 238801. Thanks, Alice")
+
+    assert anonymiser.anonymise(text) == (
+        "[NAME] ([NRIC]) can be reached at [EMAIL] or [PHONE]. "
+        "Card [CREDIT_DEBIT_NUMBER], order 4111 1111 1111 1112. Ship to [ADDRESS], [ADDRESS]. Thanks, [NAME]"
+    )
+    assert anonymiser.anonymise("Nothing personal here.") == "Nothing personal here."
+    # year ranges, bare ids and short street-like phrases are not PII
+    assert anonymiser.anonymise("The war lasted 1939-1945, see case 12345678, go 2 Way.") == "The war lasted 1939-1945, see case 12345678, go 2 Way."
+    assert anonymiser.anonymise("Call (65) 6123 4567 or 415-555-0100") == "Call [PHONE] or [PHONE]"
+    # the built-in names are matched by dictionary, a names file extends or replaces them
+    assert LocalAnonymiser().anonymise("Tan and Wong went to Lim's") == "[NAME] and [NAME] went to [NAME]'s"
+    names_file = tmp_path / "names.txt"
+    names_file.write_text("Quentin\n\n")
+    assert "Quentin" in load_names(str(names_file)) and "Tan" in load_names(str(names_file))
+    assert load_names(str(names_file), include_defaults=False) == ["Quentin"]
+    assert LocalAnonymiser(load_names(str(names_file), include_defaults=False)).anonymise("Tan met Quentin") == "Tan met [NAME]"
+
+def test_comprehend_anonymiser_falls_back_to_local():
+    from utils.anonymise import ComprehendAnonymiser, LocalAnonymiser, create_anonymiser
+
+    anonymiser = ComprehendAnonymiser(fallback=LocalAnonymiser(names=[]))
+    with patch.object(anonymiser.client, 'detect_pii_entities', return_value={"Entities": [
+        {"BeginOffset": 10, "EndOffset": 21, "Type": "NAME"},
+        {"BeginOffset": 0, "EndOffset": 5, "Type": "NAME"},
+    ]}):
+        assert anonymiser.anonymise("Alice met Bob Jenkins.") == "[NAME] met [NAME]."
+
+    with patch.object(anonymiser.client, 'detect_pii_entities', side_effect=Exception("unreachable")):
+        assert anonymiser.anonymise("Write to a@b.co") == "Write to [EMAIL]"
+
+    assert isinstance(create_anonymiser("local"), LocalAnonymiser)
+    with pytest.raises(ValueError):
+        create_anonymiser("unknown")
+
+@pytest.mark.asyncio
+async def test_anonymisation_pipeline_chunks_caches_and_skips_by_role():
+    from concurrent.futures import ThreadPoolExecutor
+    from utils import anonymise as anonymise_utils
+    from utils.anonymise import AnonymisationPipeline, ComprehendAnonymiser, LocalAnonymiser
+    from utils.cache import TTLCache
+
+    local = LocalAnonymiser(names=[])
+    comprehend = ComprehendAnonymiser(fallback=local)
+    pipeline = AnonymisationPipeline(
+        comprehend, local, {"assistant": "local", "system": "skip"}, TTLCache(100, 60), ThreadPoolExecutor(max_workers=2)
+    )
+
+    def detect_entities(text):
+        start = text.find("secret")
+        return [{"BeginOffset": start, "EndOffset": start + 6, "Type": "NAME"}] if start >= 0 else []
+
+    text = "a" * 45 + "secret" + "b" * 49
+    with patch.object(anonymise_utils, 'ANONYMISE_CHUNK_CHARS', 40), \
+         patch.object(anonymise_utils, 'ANONYMISE_CHUNK_OVERLAP', 10), \
+         patch.object(comprehend, 'detect_entities', side_effect=detect_entities) as mock_detect:
+        assert await pipeline.anonymise(text, "user") == "a" * 45 + "[NAME]" + "b" * 49
+        assert mock_detect.call_count == 3
+
+        # repeated content is served from the cache
+        assert await pipeline.anonymise(text, "user") == "a" * 45 + "[NAME]" + "b" * 49
+        assert mock_detect.call_count == 3
+
+        # assistant messages only get the local scan, system messages are not scanned
+        assert await pipeline.anonymise("mail a@b.co secret", "assistant") == "mail [EMAIL] secret"
+        assert await pipeline.anonymise("mail a@b.co", "system") == "mail a@b.co"
+        assert mock_detect.call_count == 3
+
+    with patch.object(comprehend, 'detect_entities', side_effect=Exception("unreachable")):
+        assert await pipeline.anonymise("write to a@b.co", "user") == "write to [EMAIL]"
+
+@pytest.mark.asyncio
+async def test_query_completion_cache(mock_db):
+    from utils import completion_cache
+
+    completion_cache.memory_cache.clear()
+    conversation = Conversation(name="Deterministic Conversation", params={"temperature": 0.0})
+    await conversation.insert()
+    query = PromptCreate(content="What is 2 + 2?", role="user")
+
+    async def reset_history():
+        await Prompt.find(Prompt.conversation_id == conversation.id).delete()
+        await Conversation.get_motor_collection().update_one({"_id": conversation.id}, {"$set": {"message_count": 0, "tokens": 0}})
+
+    with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5), \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock, return_value=PromptCreate(content="4", role="assistant")) as mock_generate_response:
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            first = await client.post(f"/query/{conversation.id}", json=query.dict())
+            await reset_history()
+            second = await client.post(f"/query/{conversation.id}", json=query.dict())
+            await reset_history()
+            # the Mongo tier still serves the completion after the memory tier is lost
+            completion_cache.memory_cache.clear()
+            third = await client.post(f"/query/{conversation.id}", json=query.dict())
+
+    assert [r.json() for r in (first, second, third)] == [{"response": "4"}] * 3
+    assert [r.headers["X-Cache"] for r in (first, second, third)] == ["MISS", "HIT", "HIT"]
+    mock_generate_response.assert_awaited_once()
+    assert await Prompt.find(Prompt.conversation_id == conversation.id).count() == 2
+
+    sampled = ConversationFull(id="2", name="Sampled", params={"temperature": 0.7}, messages=[])
+    assert completion_cache.is_cacheable(sampled) is False
+    assert completion_cache.is_cacheable(sampled, force=True) is True
+
+@pytest.mark.asyncio
+async def test_identical_concurrent_queries_are_coalesced(mock_db):
+    import asyncio
+    conversation_id = "test_id"
+    query = PromptCreate(content="Test query", role="user")
+
+    async def slow_response(conversation):
+        await asyncio.sleep(0.05)
+        return PromptCreate(content="Test response", role="assistant")
+
+    with patch('utils.pipeline.build_prompt', new_callable=AsyncMock, side_effect=fake_build_prompt) as mock_build_prompt, \
+         patch('utils.pipeline.save_prompts', new_callable=AsyncMock) as mock_save_prompts, \
+         patch('utils.pipeline.get_conversation_full', new_callable=AsyncMock) as mock_get_conversation_full, \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock, side_effect=slow_response) as mock_generate_response:
+
+        mock_get_conversation_full.return_value = ConversationFull(id=conversation_id, name="Test Conversation", params={}, tokens=0, messages=[])
+
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            responses = await asyncio.gather(*[client.post(f"/query/{conversation_id}", json=query.dict()) for _ in range(3)])
+
+    assert [response.json() for response in responses] == [{"response": "Test response"}] * 3
+    assert sorted(response.headers.get("X-Coalesced", "false") for response in responses) == ["false", "true", "true"]
+    mock_generate_response.assert_awaited_once()
+    # one user message and one assistant message
+    assert mock_build_prompt.await_count == 2
+    mock_save_prompts.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_query_idempotency_key(mock_db):
+    import asyncio
+    from models.models import IdempotencyRecord
+
+    conversation = Conversation(name="Test Conversation", params={})
+    await conversation.insert()
+    query = PromptCreate(content="Test query", role="user")
+    headers = {"Idempotency-Key": "retry-1"}
+
+    async def slow_response(conversation):
+        await asyncio.sleep(0.05)
+        return PromptCreate(content="Test response", role="assistant")
+
+    with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5), \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock, side_effect=slow_response) as mock_generate_response:
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            # a retry while the first request is running waits for it
+            first, retry = await asyncio.gather(
+                client.post(f"/query/{conversation.id}", json=query.dict(), headers=headers),
+                client.post(f"/query/{conversation.id}", json=query.dict(), headers=headers)
+            )
+            replay = await client.post(f"/query/{conversation.id}", json=query.dict(), headers=headers)
+            mismatch = await client.post(f"/query/{conversation.id}", json={"content": "Other query", "role": "user"}, headers=headers)
+
+    assert [r.json() for r in (first, retry, replay)] == [{"response": "Test response"}] * 3
+    assert replay.headers["Idempotent-Replayed"] == "true"
+    assert mismatch.status_code == 422
+    mock_generate_response.assert_awaited_once()
+    assert await Prompt.find(Prompt.conversation_id == conversation.id).count() == 2
+    assert (await IdempotencyRecord.get(f"{conversation.id}:retry-1")).status == "completed"
+
+@pytest.mark.asyncio
+async def test_mailboxes_order_per_key_and_evict_idle():
+    import asyncio
+    from utils.mailbox import Mailboxes
+
+    mailboxes = Mailboxes(idle_timeout=0.05)
+    events = []
+
+    def work(key, item):
+        async def run():
+            events.append(("start", key, item))
+            await asyncio.sleep(0.01)
+            events.append(("end", key, item))
+            return item
+        return run
+
+    results = await asyncio.gather(*[mailboxes.submit(key, work(key, item)) for item in range(3) for key in ("a", "b")])
+
+    assert results == [0, 0, 1, 1, 2, 2]
+    # work for one key never overlaps and keeps submission order
+    for key in ("a", "b"):
+        assert [event[0::2] for event in events if event[1] == key] == [("start", 0), ("end", 0), ("start", 1), ("end", 1), ("start", 2), ("end", 2)]
+    # different keys run in parallel
+    assert events[:2] == [("start", "a", 0), ("start", "b", 0)]
+
+    assert len(mailboxes) == 2
+    await asyncio.sleep(0.1)
+    assert len(mailboxes) == 0
+
+@pytest.mark.asyncio
+async def test_concurrent_queries_on_a_conversation_take_turns(mock_db):
+    import asyncio
+
+    conversation = Conversation(name="Test Conversation", params={})
+    await conversation.insert()
+    histories = []
+
+    async def respond(conversation):
+        histories.append([message.content for message in conversation.messages])
+        await asyncio.sleep(0.01)
+        return PromptCreate(content=f"Answer {len(histories)}", role="assistant")
+
+    with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5), \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock, side_effect=respond):
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            responses = await asyncio.gather(*[
+                client.post(f"/query/{conversation.id}", json={"content": f"Question {i}", "role": "user"}) for i in (1, 2)
+            ])
+
+    assert all(response.status_code == 200 for response in responses)
+    # the second turn sees the whole first turn
+    assert histories == [["Question 1"], ["Question 1", "Answer 1", "Question 2"]]
+    prompts = await Prompt.find(Prompt.conversation_id == conversation.id).sort(+Prompt.sequence).to_list()
+    assert [(prompt.sequence, prompt.content) for prompt in prompts] == [(1, "Question 1"), (2, "Answer 1"), (3, "Question 2"), (4, "Answer 2")]
+    db_conversation = await Conversation.get(conversation.id)
+    assert (db_conversation.message_count, db_conversation.tokens) == (4, 20)
+
+@pytest.mark.asyncio
+async def test_async_query_jobs(mock_db):
+    from models.models import QueryJob
+    from utils.jobs import job_pool
+
+    conversation = Conversation(name="Test Conversation", params={})
+    await conversation.insert()
+    # a job queued before a restart
+    leftover = QueryJob(conversation_id=conversation.id, role="user", content="Earlier query")
+    await leftover.insert()
+
+    with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text) as mock_anonymise, \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5), \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock, return_value=PromptCreate(content="Test response", role="assistant")), \
+         patch.object(job_pool, 'poll_interval', 0.05):
+        await job_pool.start()
+        try:
+            async with AsyncClient(app=app, base_url="http://testserver") as client:
+                queued = await client.post(f"/query/{conversation.id}?mode=async", json={"content": "Test query", "role": "user"})
+                job_id = queued.json()["job_id"]
+                finished = await client.get(f"/jobs/{job_id}?wait=5")
+                resumed = await client.get(f"/jobs/{leftover.id}?wait=5")
+                stats = await client.get("/jobs/stats")
+                missing_conversation = await client.post("/query/missing?mode=async", json={"content": "Test query", "role": "user"})
+                missing_job = await client.get("/jobs/missing")
+                with patch.object(job_pool, 'queue_limit', 0):
+                    full = await client.post(f"/query/{conversation.id}?mode=async", json={"content": "Test query", "role": "user"})
+        finally:
+            await job_pool.stop()
+
+    assert queued.status_code == 202
+    assert queued.headers["Location"] == f"/jobs/{job_id}"
+    assert finished.status_code == 200
+    assert finished.json()["status"] == "completed"
+    assert finished.json()["response"] == "Test response"
+    assert finished.json()["attempts"] == 1
+    assert resumed.json()["status"] == "completed"
+    assert stats.json()["workers"] == job_pool.workers
+    assert stats.json()["completed"] >= 2
+    assert stats.json()["queued"] == 0
+    assert missing_conversation.status_code == 404
+    assert missing_job.status_code == 404
+    assert full.status_code == 503
+    assert await Prompt.find(Prompt.conversation_id == conversation.id).count() == 4
+    # job queries are anonymised when they are queued, only the responses are anonymised when the jobs run
+    assert {call.args[1] for call in mock_anonymise.await_args_list} == {"assistant"}
+
+@pytest.mark.asyncio
+async def test_group_commit_batches_concurrent_writes():
+    import asyncio
+    from pymongo.errors import BulkWriteError
+    from utils.group_commit import GroupCommit
+
+    written = []
+
+    async def write_many(items):
+        await asyncio.sleep(0.01)
+        if "bad" in items:
+            raise BulkWriteError({"writeErrors": [{"index": items.index("bad")}]})
+        written.append(items)
+
+    group_commit = GroupCommit(write_many, max_batch=3)
+    results = await asyncio.gather(*[group_commit.write(items) for items in (["a"], ["b"], ["c", "d"], ["e"], ["bad"])], return_exceptions=True)
+
+    # writes queued together are combined up to max_batch items, without splitting a write
+    assert written == [["a", "b"], ["c", "d", "e"]]
+    assert results[:4] == [None, None, None, None]
+    assert isinstance(results[4], BulkWriteError)
+    assert (group_commit.writes, group_commit.batches) == (5, 3)
+
+    # only the write holding the failed item fails
+    results = await asyncio.gather(group_commit.write(["f"]), group_commit.write(["bad"]), return_exceptions=True)
+    assert results[0] is None and isinstance(results[1], BulkWriteError)
+
+    # a flush that fails unexpectedly fails its writes instead of leaving them waiting
+    async def broken_write_many(items):
+        raise BulkWriteError(None)
+
+    group_commit.write_many = broken_write_many
+    results = await asyncio.wait_for(asyncio.gather(group_commit.write(["g"]), return_exceptions=True), 1)
+    await asyncio.sleep(0)
+    assert isinstance(results[0], Exception) and group_commit._flusher is None
+
+@pytest.mark.asyncio
+async def test_query_batch(mock_db):
+    import asyncio
+    import json
+
+    first = Conversation(name="First Conversation", params={})
+    second = Conversation(name="Second Conversation", params={})
+    await first.insert()
+    await second.insert()
+
+    async def respond(conversation):
+        await asyncio.sleep(0.01)
+        return PromptCreate(content=f"Answer to {conversation.messages[-1].content}", role="assistant")
+
+    items = [
+        {"conversation_id": first.id, "query": {"content": "Q1", "role": "user"}},
+        {"conversation_id": second.id, "query": {"content": "Q2", "role": "user"}},
+        {"conversation_id": "missing", "query": {"content": "Q3", "role": "user"}},
+        {"conversation_id": first.id, "query": {"content": "Q4", "role": "user"}}
+    ]
+    with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5), \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock, side_effect=respond):
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            response = await client.post("/query/batch", json=items)
+            empty = await client.post("/query/batch", json=[])
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    events = [json.loads(line) for line in response.text.splitlines()]
+    results = {event["index"]: event for event in events if event["event"] in ("result", "error")}
+    assert [results[index].get("response") for index in (0, 1, 3)] == ["Answer to Q1", "Answer to Q2", "Answer to Q4"]
+    assert results[2]["event"] == "error" and results[2]["error"]["code"] == 404
+    assert events[-1] == {"event": "done", "completed": 3, "failed": 1}
+    # prompts to the same conversation keep their order
+    prompts = await Prompt.find(Prompt.conversation_id == first.id).sort(+Prompt.sequence).to_list()
+    assert [prompt.content for prompt in prompts] == ["Q1", "Answer to Q1", "Q4", "Answer to Q4"]
+    assert empty.status_code == 400
+
+@pytest.mark.asyncio
+async def test_admission_scheduler_priorities_deadlines_and_headers():
+    import asyncio
+    import time
+    from utils.scheduler import AdmissionScheduler, Priority, RateLimitExceeded, AdmissionQueueFull, parse_duration
+
+    # 6000 requests per minute refill one request every 10ms
+    scheduler = AdmissionScheduler(requests_per_minute=6000, tokens_per_minute=10**6, max_queue=3)
+    scheduler.requests.tokens = 0
+    admitted = []
+
+    async def admit(name, priority):
+        await scheduler.admit(10, priority)
+        admitted.append(name)
+
+    background = asyncio.ensure_future(admit("background", Priority.background))
+    await asyncio.sleep(0)
+    interactive = asyncio.ensure_future(admit("interactive", Priority.interactive))
+    await asyncio.sleep(0)
+
+    # two requests are ahead, so a deadline shorter than ~30ms cannot be met and is shed straight away
+    started = time.monotonic()
+    with pytest.raises(RateLimitExceeded) as rejected:
+        await scheduler.admit(10, Priority.interactive, deadline=time.monotonic() + 0.005)
+    assert time.monotonic() - started < 0.005
+    assert rejected.value.retry_after > 0.005
+
+    await asyncio.gather(background, interactive)
+    assert admitted == ["interactive", "background"]
+
+    scheduler.requests.tokens = 0
+    waiting = [asyncio.ensure_future(scheduler.admit(10, Priority.batch)) for _ in range(3)]
+    await asyncio.sleep(0)
+    with pytest.raises(AdmissionQueueFull):
+        await scheduler.admit(10, Priority.batch)
+    await asyncio.gather(*waiting)
+
+    scheduler.observe_headers({"x-ratelimit-limit-tokens": "40000", "x-ratelimit-remaining-tokens": "12"})
+    assert scheduler.tokens.capacity == 40000 and scheduler.tokens.tokens <= 13
+    scheduler.observe_headers({"x-ratelimit-reset-requests": "1s", "x-ratelimit-reset-tokens": "6m0s"}, rate_limited=True)
+    assert scheduler.blocked_until - time.monotonic() > 359
+    assert parse_duration("1m30.5s") == 90.5 and parse_duration("20ms") == 0.02
+
+    # Retry-After may be an HTTP date, a malformed one falls back to the reset headers
+    from email.utils import format_datetime
+    from datetime import datetime, timedelta, timezone
+    from utils.scheduler import parse_retry_after
+    assert parse_retry_after("2.5") == 2.5
+    assert 0 < parse_retry_after(format_datetime(datetime.now(timezone.utc) + timedelta(minutes=10), usegmt=True)) <= 600
+    assert parse_retry_after("soon") is None
+    scheduler.blocked_until = 0
+    scheduler.observe_headers({"retry-after": "soon", "x-ratelimit-reset-requests": "2m"}, rate_limited=True)
+    assert 119 < scheduler.blocked_until - time.monotonic() <= 120
+
+@pytest.mark.asyncio
+async def test_query_shed_by_rate_limits(mock_db):
+    from utils.scheduler import AdmissionScheduler
+
+    conversation = Conversation(name="Test Conversation", params={})
+    await conversation.insert()
+    # an empty token bucket that refills 1 token a minute cannot admit the query within the deadline
+    scheduler = AdmissionScheduler(requests_per_minute=100, tokens_per_minute=1, max_queue=10)
+    scheduler.tokens.tokens = 0
+
+    with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5), \
+         patch('utils.pipeline.scheduler', scheduler), \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock) as mock_generate_response:
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            response = await client.post(f"/query/{conversation.id}", json={"content": "Test query", "role": "user"})
+
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 60
+    mock_generate_response.assert_not_awaited()
+    # the shed query is not persisted, so the client can retry it
+    assert await Prompt.find(Prompt.conversation_id == conversation.id).count() == 0
+
+def fake_llm_client(fake):
+    import httpx
+    from openai import AsyncOpenAI
+    from utils.fake_llm import create_app
+    http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=create_app(fake)))
+    return AsyncOpenAI(api_key="test", base_url="http://fake-llm/v1", http_client=http_client, max_retries=0)
+
+@pytest.mark.asyncio
+async def test_generate_response_hedges_slow_calls():
+    import asyncio
+    import time
+    import utils.openai as openai_utils
+    from utils.fake_llm import FakeLLM
+    from utils.resilience import Hedger
+
+    # the first call stalls, the hedged call answers straight away
+    latencies = iter([5.0, 0.01])
+    fake = FakeLLM(latency=lambda: next(latencies), tokens_per_second=1000, reply_tokens=3)
+    hedger = Hedger(percentile=95, min_samples=3, window=10)
+    for latency in (0.05, 0.05, 0.1):
+        hedger.latencies.record(latency)
+    conversation = ConversationFull(id="1", name="Test Conversation", params={}, tokens=0, messages=[])
+
+    with patch.object(openai_utils, 'get_client', return_value=fake_llm_client(fake)), \
+         patch.dict(openai_utils.hedgers, {f"openai:{openai_utils.OPENAI_MODEL}": hedger}), \
+         patch.object(openai_utils, 'OPENAI_HEDGE_ENABLED', True):
+        started = time.monotonic()
+        response = await openai_utils.generate_response(conversation)
+        elapsed = time.monotonic() - started
+
+    assert response == PromptCreate(content="token0 token1 token2", role="assistant")
+    assert elapsed < 1
+    assert hedger.stats()["hedged"] == 1 and hedger.stats()["hedge_wins"] == 1
+    await asyncio.sleep(0)
+    # the slow call was cancelled rather than left running
+    assert fake.started == 2 and fake.completed == 1 and fake.cancelled == 1
+    assert openai_utils.limiter.in_flight == 0
+
+@pytest.mark.asyncio
+async def test_circuit_breaker_fails_fast_and_probes(mock_db):
+    import asyncio
+    import utils.openai as openai_utils
+    from utils.fake_llm import FakeLLM
+    from utils.resilience import CircuitBreaker, CircuitOpenError
+    from utils.openai import OpenAIException
+
+    fake = FakeLLM(latency=lambda: 0, tokens_per_second=1000, reply_tokens=1, error_rate=1.0)
+    breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=0.1, half_open_max_calls=1, is_failure=openai_utils.is_provider_failure)
+    conversation = ConversationFull(id="1", name="Test Conversation", params={}, tokens=0, messages=[])
+
+    with patch.object(openai_utils, 'get_client', return_value=fake_llm_client(fake)), \
+         patch.dict(openai_utils.breakers, {"openai": breaker}):
+        for _ in range(2):
+            with pytest.raises(OpenAIException):
+                await openai_utils.generate_response(conversation)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        # while open, calls fail without reaching the LLM
+        with pytest.raises(CircuitOpenError):
+            await openai_utils.generate_response(conversation)
+        assert fake.started == 2
+
+        # a failed probe reopens the circuit
+        await asyncio.sleep(0.1)
+        with pytest.raises(OpenAIException):
+            await openai_utils.generate_response(conversation)
+        assert breaker.state == CircuitBreaker.OPEN and fake.started == 3
+
+        # a successful probe closes it
+        await asyncio.sleep(0.1)
+        fake.error_rate = 0
+        assert await openai_utils.generate_response(conversation) == PromptCreate(content="token0", role="assistant")
+        assert breaker.stats() == {"state": CircuitBreaker.CLOSED, "consecutive_failures": 0, "rejected": 1}
+
+        # the query route reports an open circuit as 503 with Retry-After
+        breaker._open()
+        conversation_doc = Conversation(name="Test Conversation", params={})
+        await conversation_doc.insert()
+        with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+             patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5):
+            async with AsyncClient(app=app, base_url="http://testserver") as client:
+                response = await client.post(f"/query/{conversation_doc.id}", json={"content": "Test query", "role": "user"})
+
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+@pytest.mark.asyncio
+async def test_llm_providers_selected_per_conversation_and_by_size(mock_db):
+    import utils.openai as openai_utils
+    from utils.fake_llm import FakeLLM, FakeProvider
+    from utils.providers import parse_size_routes
+    from utils.openai import OpenAIException
+
+    fake = FakeLLM(latency=lambda: 0, tokens_per_second=1000, reply_tokens=3, seed=1)
+
+    def conversation_with(params, tokens=10):
+        message = PromptRead(_id="m1", role="user", content="Hello", tokens=tokens)
+        return ConversationFull(id="1", name="Test Conversation", params=params, tokens=tokens, messages=[message])
+
+    with patch.dict(openai_utils.providers, {"fake": FakeProvider(fake)}), \
+         patch.object(openai_utils, 'LLM_SIZE_ROUTES', parse_size_routes("50=fake:fake-small, 1000=openai:gpt-4o-mini")):
+        # small prompts go to the cheaper route, large ones to the default provider
+        assert openai_utils.select_llm(conversation_with({}, tokens=10)) == ("fake", "fake-small")
+        assert openai_utils.select_llm(conversation_with({}, tokens=500)) == ("openai", "gpt-4o-mini")
+        assert openai_utils.select_llm(conversation_with({}, tokens=5000)) == ("openai", openai_utils.OPENAI_MODEL)
+        # the conversation's params win over the size routes
+        assert openai_utils.select_llm(conversation_with({"model": "gpt-4o"})) == ("openai", "gpt-4o")
+        assert openai_utils.select_llm(conversation_with({"provider": "fake"}, tokens=5000)) == ("fake", "fake")
+        with pytest.raises(OpenAIException):
+            openai_utils.select_llm(conversation_with({"provider": "unknown"}))
+
+        # routing params are not sent to the provider
+        conversation = conversation_with({"provider": "fake", "max_tokens": 2})
+        assert openai_utils.get_api_params(conversation) == {"max_tokens": 2}
+        assert await openai_utils.generate_response(conversation) == PromptCreate(content="token0 token1", role="assistant")
+        assert [delta async for delta in openai_utils.stream_response(conversation)] == ["token0", " token1"]
+        assert fake.started == 2 and fake.completed == 2
+
+        # a conversation picks the fake provider through its params, end to end
+        with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+             patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5):
+            async with AsyncClient(app=app, base_url="http://testserver") as client:
+                created = await client.post("/conversations", json={"name": "Fake", "params": {"provider": "fake", "temperature": 0}})
+                assert created.status_code == 201
+                conversation_id = created.json()["id"]
+                response = await client.post(f"/query/{conversation_id}", json={"content": "Test query", "role": "user"})
+                # the context is fitted to the window of the model the turn goes to
+                routed = await client.post("/conversations", json={"name": "Routed", "params": {"provider": "fake", "model": "gpt-4o"}})
+                routed_response = await client.post(f"/query/{routed.json()['id']}", json={"content": "Test query", "role": "user"})
+
+    assert response.status_code == 200
+    assert response.json() == {"response": "token0 token1 token2"}
+    assert response.headers["X-Context-Token-Budget"] == str(16385 - 1024 - 3)
+    assert routed_response.headers["X-Context-Token-Budget"] == str(128000 - 1024 - 3)
+    assert fake.completed == 4
+
+@pytest.mark.asyncio
+async def test_conversation_params_are_typed_by_name():
+    from utils import completion_cache
+
+    # numeric params sent as strings are numbers once validated, so they can be compared
+    conversation = ConversationFull(id="1", name="Test Conversation", params={"temperature": "0", "provider": "fake"}, messages=[])
+    assert conversation.params == {"temperature": 0.0, "provider": "fake"}
+    with patch.object(completion_cache, 'COMPLETION_CACHE_ENABLED', True):
+        assert completion_cache.is_cacheable(conversation)
+
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        not_a_number = await client.post("/conversations", json={"name": "Test", "params": {"temperature": "warm"}})
+        not_a_name = await client.post("/conversations", json={"name": "Test", "params": {"model": 4}})
+
+    assert not_a_number.status_code == 400
+    assert not_a_name.status_code == 400
+
+@pytest.mark.asyncio
+async def test_conversation_cache_extends_and_invalidates(mock_db):
+    from db.db_conversations import get_conversation_full, add_messages_to_conversation, update_conversation, delete_conversation
+    from db.db_query import save_prompts
+    from models.schemas import ConversationUpdate
+    from beanie.exceptions import DocumentNotFound
+    from utils.conversation_cache import ConversationCache
+
+    cache = ConversationCache(max_entries=10, max_bytes=1024 * 1024)
+    conversation = Conversation(name="Cached Conversation", params={})
+    await conversation.insert()
+
+    def prompt(content):
+        return Prompt(role="user", content=content, conversation_id=conversation.id, tokens=3)
+
+    with patch('db.db_conversations.conversation_cache', cache), \
+         patch('db.db_query.conversation_cache', cache), \
+         patch('routes.api_conversations.conversation_cache', cache):
+        await save_prompts(conversation.id, [prompt("one"), prompt("two")])
+        assert [m.content for m in (await get_conversation_full(conversation.id)).messages] == ["one", "two"]
+        assert cache.stats()["misses"] == 1 and cache.stats()["hits"] == 0
+
+        # a new turn extends the cached history, and tokens come from the conversation document
+        await save_prompts(conversation.id, [prompt("three")])
+        full = await get_conversation_full(conversation.id)
+        assert [m.content for m in full.messages] == ["one", "two", "three"] and full.tokens == 9
+        assert cache.stats()["hits"] == 1 and cache.stats()["extensions"] == 1
+
+        # a reserved position whose prompt is not written yet is not skipped once it is
+        await add_messages_to_conversation(conversation.id, [3])
+        await save_prompts(conversation.id, [prompt("five")])
+        assert [m.sequence for m in (await get_conversation_full(conversation.id)).messages] == [1, 2, 3, 5]
+        late = prompt("four")
+        late.sequence = 4
+        await late.insert()
+        assert [m.content for m in (await get_conversation_full(conversation.id)).messages] == ["one", "two", "three", "four", "five"]
+        assert cache.peek(conversation.id).last_sequence == 5
+
+        # updates bump the version, which drops the cached history
+        await update_conversation(conversation.id, ConversationUpdate(name="Renamed"))
+        assert cache.peek(conversation.id) is None
+        assert (await get_conversation_full(conversation.id)).name == "Renamed"
+
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            stats = (await client.get("/conversations/cache/stats")).json()
+        assert stats["hits"] == 3 and stats["misses"] == 2 and stats["invalidations"] == 1
+        assert stats["entries"] == 1 and stats["bytes"] > 5 * 1000
+
+        await delete_conversation(conversation.id)
+        assert len(cache) == 0 and cache.size == 0
+        with pytest.raises(DocumentNotFound):
+            await get_conversation_full(conversation.id)
+
+@pytest.mark.asyncio
+async def test_conditional_conversation_reads(mock_db):
+    from db.db_query import save_prompts
+
+    conversation = Conversation(name="Polled Conversation", params={})
+    await conversation.insert()
+
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        first = await client.get(f"/conversations/{conversation.id}")
+        page = await client.get("/conversations")
+        assert first.status_code == 200 and page.status_code == 200
+        etag, page_etag = first.headers["ETag"], page.headers["ETag"]
+        assert first.headers["Last-Modified"].endswith("GMT")
+
+        # unchanged conversations are answered without reading their messages
+        with patch('routes.api_conversations.get_conversation', new_callable=AsyncMock) as mock_get_conversation, \
+             patch('routes.api_conversations.get_all_conversations', new_callable=AsyncMock) as mock_get_all:
+            not_modified = await client.get(f"/conversations/{conversation.id}", headers={"If-None-Match": etag})
+            page_not_modified = await client.get("/conversations", headers={"If-None-Match": f'"other", {page_etag}'})
+        assert not_modified.status_code == 304 and not_modified.content == b"" and not_modified.headers["ETag"] == etag
+        assert page_not_modified.status_code == 304
+        mock_get_conversation.assert_not_awaited()
+        mock_get_all.assert_not_awaited()
+
+        # new messages change the ETag only once they are stored
+        await save_prompts(conversation.id, [Prompt(role="user", content="Hello", conversation_id=conversation.id, tokens=3)])
+        after_append = await client.get(f"/conversations/{conversation.id}", headers={"If-None-Match": etag})
+        assert after_append.status_code == 200 and after_append.headers["ETag"] != etag
+        assert [m["content"] for m in after_append.json()["messages"]] == ["Hello"]
+        assert (await client.get("/conversations", headers={"If-None-Match": page_etag})).status_code == 200
+
+        # so do updates and deletes
+        etag = after_append.headers["ETag"]
+        await client.put(f"/conversations/{conversation.id}", json={"name": "Renamed"})
+        assert (await client.get(f"/conversations/{conversation.id}", headers={"If-None-Match": etag})).status_code == 200
+        page_etag = (await client.get("/conversations")).headers["ETag"]
+        await client.delete(f"/conversations/{conversation.id}")
+        assert (await client.get(f"/conversations/{conversation.id}", headers={"If-None-Match": etag})).status_code == 404
+        assert (await client.get("/conversations", headers={"If-None-Match": page_etag})).status_code == 200
+
+@pytest.mark.asyncio
+async def test_response_compression(mock_db):
+    import asyncio
+    import json
+    import zlib
+    from starlette.responses import StreamingResponse
+    from utils.compression import CompressionMiddleware, CompressionStats, available_encodings, negotiate_encoding
+
+    assert negotiate_encoding("gzip;q=0.5, br", ["zstd", "br", "gzip"]) == "br"
+    assert negotiate_encoding("gzip, br", ["zstd", "br", "gzip"]) == "br"
+    assert negotiate_encoding("*;q=0.1, gzip;q=0", ["gzip"]) is None
+    assert negotiate_encoding("identity", ["gzip"]) is None
+
+    conversation = Conversation(name="Compressed Conversation", params={})
+    await conversation.insert()
+    await Prompt(role="user", content="All work and no play. " * 200, conversation_id=conversation.id, sequence=1, tokens=5).insert()
+
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        large = await client.get(f"/conversations/{conversation.id}", headers={"Accept-Encoding": "gzip"})
+        small = await client.get("/conversations", headers={"Accept-Encoding": "gzip"})
+        identity = await client.get(f"/conversations/{conversation.id}", headers={"Accept-Encoding": "identity"})
+        stats = (await client.get("/compression/stats")).json()
+
+    assert large.headers["Content-Encoding"] == "gzip" and "Accept-Encoding" in large.headers["Vary"]
+    assert int(large.headers["Content-Length"]) < len(large.content) / 10
+    assert large.json()["messages"][0]["content"] == "All work and no play. " * 200
+    assert "Content-Encoding" not in small.headers and "Accept-Encoding" in small.headers["Vary"]
+    assert "Content-Encoding" not in identity.headers and identity.json() == large.json()
+    route_stats = next(s for s in stats if s["route"] == "/conversations/{conversation_id}" and s["encoding"] == "gzip")
+    assert route_stats["responses"] >= 1 and route_stats["ratio"] > 1 and route_stats["cpu_seconds"] >= 0
+
+    # every streamed chunk is flushed, so it can be decoded as soon as it arrives
+    async def events():
+        for i in range(3):
+            yield f"data: {json.dumps({'content': 'token', 'index': i})}\n\n"
+
+    stream_app = StreamingResponse(events(), media_type="text/event-stream")
+    stream_stats = CompressionStats()
+    middleware = CompressionMiddleware(stream_app, minimum_size=1024, encodings=available_encodings(6, 4, 3), preference=["gzip"], stats=stream_stats)
+    sent = []
+
+    async def receive():
+        # the response listens for a disconnect until it has been sent
+        await asyncio.Event().wait()
+
+    async def send(message):
+        sent.append(message)
+
+    await middleware({"type": "http", "method": "GET", "path": "/events", "headers": [(b"accept-encoding", b"gzip")]}, receive, send)
+
+    headers = dict(sent[0]["headers"])
+    assert headers[b"content-encoding"] == b"gzip" and b"content-length" not in headers
+    decompressor = zlib.decompressobj(31)
+    chunks = [decompressor.decompress(message["body"]) for message in sent[1:] if message["body"]]
+    assert chunks[:3] == [f"data: {json.dumps({'content': 'token', 'index': i})}\n\n".encode() for i in range(3)]
+    assert decompressor.eof
+    assert stream_stats.stats()[0]["route"] == "/events" and stream_stats.stats()[0]["responses"] == 1
+
+@pytest.mark.asyncio
+async def test_metrics_time_query_stages(mock_db):
+    import asyncio
+    from types import SimpleNamespace
+    from utils.metrics import registry, query_stage_seconds, llm_tokens, mongo_command_metrics, mongo_command_seconds, mongo_command_failures
+
+    conversation = Conversation(name="Measured Conversation", params={"temperature": 0.7})
+    await conversation.insert()
+
+    async def slow_response(conversation):
+        await asyncio.sleep(0.05)
+        return PromptCreate(content="Test response", role="assistant")
+
+    registry.reset()
+    with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5), \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock, side_effect=slow_response):
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            response = await client.post(f"/query/{conversation.id}", json={"content": "Test query", "role": "user"})
+            # pymongo calls the listener for every command of a real client
+            mongo_command_metrics.started(SimpleNamespace(command={"find": "prompts"}, command_name="find", connection_id=("db", 27017), request_id=1))
+            mongo_command_metrics.succeeded(SimpleNamespace(command_name="find", connection_id=("db", 27017), request_id=1, duration_micros=1500))
+            mongo_command_metrics.started(SimpleNamespace(command={"getMore": 42, "collection": "prompts"}, command_name="getMore", connection_id=("db", 27017), request_id=2))
+            mongo_command_metrics.failed(SimpleNamespace(command_name="getMore", connection_id=("db", 27017), request_id=2, duration_micros=500))
+            metrics = await client.get("/metrics")
+
+    assert response.status_code == 200
+    # one query and one response prompt are built, and saved together
+    for stage, count in [("anonymise", 2), ("count_tokens", 2), ("load_conversation", 1), ("build_context", 1), ("admission", 1),
+                         ("generate_response", 1), ("reserve_messages", 1), ("insert_prompts", 1), ("mark_stored", 1)]:
+        assert query_stage_seconds.labels(stage).count == count, stage
+    # stage budgets: the LLM call dominates and the rest of the pipeline stays well under it
+    assert query_stage_seconds.labels("generate_response").max >= 0.05
+    assert query_stage_seconds.labels("load_conversation").max < 0.05
+    assert query_stage_seconds.labels("anonymise").max < 0.01
+    assert llm_tokens.labels("openai:gpt-3.5-turbo", "prompt").value == 5
+    assert llm_tokens.labels("openai:gpt-3.5-turbo", "completion").value == 5
+    assert mongo_command_seconds.labels("find", "prompts").sum == 0.0015
+    assert mongo_command_failures.labels("getMore", "prompts").value == 1
+
+    assert metrics.status_code == 200
+    assert metrics.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+    text = metrics.text
+    assert '# TYPE query_stage_seconds histogram' in text
+    assert 'query_stage_seconds_bucket{stage="generate_response",le="0.025"} 0' in text
+    assert 'query_stage_seconds_bucket{stage="generate_response",le="+Inf"} 1' in text
+    assert 'query_stage_seconds_count{stage="anonymise"} 2' in text
+    assert 'llm_tokens_total{model="openai:gpt-3.5-turbo",kind="completion"} 5' in text
+    assert 'mongo_command_seconds_count{command="find",collection="prompts"} 1' in text
+    assert 'http_request_seconds_count{route="/query/{conversation_id}",method="POST",status="200"} 1' in text
+    assert 'http_requests_in_flight 1' in text
+    assert 'prompt_writer_writes ' in text and 'conversation_cache_hits ' in text and 'query_jobs_workers ' in text
+
+@pytest.mark.asyncio
+async def test_query_returns_the_llm_text_and_stores_the_anonymised_copy(mock_db):
+    conversation = Conversation(name="Redacted Conversation", params={})
+    await conversation.insert()
+    reply = PromptCreate(content="Write to jane@example.com", role="assistant")
+
+    from utils import anonymise as anonymise_utils
+    from utils.anonymise import LocalAnonymiser
+
+    # the default role policy scans the LLM's replies with the local engine before they are stored
+    assert anonymise_utils.pipeline.role_policy["assistant"] == "local"
+    # user prompts get the full scan, served by the local engine rather than AWS here
+    with patch.object(anonymise_utils.pipeline, 'anonymiser', LocalAnonymiser(names=[])), \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5), \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock, return_value=reply):
+        async with AsyncClient(app=app, base_url="http://testserver") as client:
+            response = await client.post(f"/query/{conversation.id}", json={"content": "Who do I write to?", "role": "user"})
+
+    assert response.json() == {"response": "Write to jane@example.com"}
+    assert reply.content == "Write to jane@example.com"
+    prompts = await Prompt.find(Prompt.conversation_id == conversation.id).sort(+Prompt.sequence).to_list()
+    assert [(prompt.role, prompt.content) for prompt in prompts] == [("user", "Who do I write to?"), ("assistant", "Write to [EMAIL]")]
+
+@pytest.mark.asyncio
+async def test_conversation_reads_are_cached_and_match_the_model_path(mock_db):
+    import json
+    from db.db_conversations import conversation_cache, get_conversation_full
+    from db.db_query import save_prompts
+
+    conversation_cache.clear()
+    conversation = Conversation(name="Cached Conversation", params={"temperature": 0.7})
+    await conversation.insert()
+    await save_prompts(conversation.id, [
+        Prompt(role="user", content="Héllo \"there\"\n", conversation_id=conversation.id, tokens=4),
+        Prompt(role="assistant", content="你好", conversation_id=conversation.id, tokens=2)
+    ])
+
+    def model_path(conversation_full):
+        content = conversation_full.model_dump(mode="json", by_alias=True, exclude_none=True)
+        return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+    hits, misses = conversation_cache.hits, conversation_cache.misses
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        first = await client.get(f"/conversations/{conversation.id}")
+        second = await client.get(f"/conversations/{conversation.id}")
+        await save_prompts(conversation.id, [Prompt(role="user", content="More", conversation_id=conversation.id, tokens=1)])
+        third = await client.get(f"/conversations/{conversation.id}")
+
+    # the first read fills the cache, later reads only fetch the messages added since
+    assert (conversation_cache.hits, conversation_cache.misses) == (hits + 2, misses + 1)
+    assert first.content == second.content
+    assert [m["content"] for m in third.json()["messages"]] == ["Héllo \"there\"\n", "你好", "More"]
+    assert third.content == model_path(await get_conversation_full(conversation.id))
+    # a read that misses the cache gives the same bytes
+    conversation_cache.clear()
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        assert (await client.get(f"/conversations/{conversation.id}")).content == third.content
+
+@pytest.mark.asyncio
+async def test_query_timeout_never_cuts_persistence_short(mock_db):
+    import asyncio
+    from db import db_query
+    from utils.pipeline import run_query
+
+    conversation = Conversation(name="Timed Conversation", params={})
+    await conversation.insert()
+    save_prompts = db_query.save_prompts
+
+    async def slow_save(conversation_id, db_prompts, skip_stored=False):
+        await asyncio.sleep(0.1)
+        return await save_prompts(conversation_id, db_prompts, skip_stored)
+
+    async def slow_response(conversation):
+        await asyncio.sleep(0.1)
+        return PromptCreate(content="Late response", role="assistant")
+
+    with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5):
+        # a slow write finishes even though it outlasts the timeout
+        with patch('utils.pipeline.save_prompts', side_effect=slow_save), \
+             patch('utils.pipeline.generate_response', new_callable=AsyncMock, return_value=PromptCreate(content="Test response", role="assistant")):
+            prompt_response, _ = await run_query(conversation.id, PromptCreate(content="First", role="user"), timeout=0.05)
+        assert prompt_response.content == "Test response"
+
+        # a slow LLM call times out, and only the query is kept
+        with patch('utils.pipeline.generate_response', side_effect=slow_response):
+            with pytest.raises(asyncio.TimeoutError):
+                await run_query(conversation.id, PromptCreate(content="Second", role="user"), timeout=0.05)
+
+    prompts = await Prompt.find(Prompt.conversation_id == conversation.id).sort(+Prompt.sequence).to_list()
+    assert [prompt.content for prompt in prompts] == ["First", "Test response", "Second"]
+
+@pytest.mark.asyncio
+async def test_async_query_idempotency_key(mock_db):
+    from models.models import QueryJob
+
+    conversation = Conversation(name="Retried Conversation", params={})
+    await conversation.insert()
+    url = f"/query/{conversation.id}?mode=async"
+    headers = {"Idempotency-Key": "retry-1"}
+
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        first = await client.post(url, json={"content": "Test query", "role": "user"}, headers=headers)
+        retry = await client.post(url, json={"content": "Test query", "role": "user"}, headers=headers)
+        other = await client.post(url, json={"content": "Another query", "role": "user"}, headers=headers)
+        without_key = await client.post(url, json={"content": "Test query", "role": "user"})
+
+    assert first.status_code == 202 and retry.status_code == 202
+    assert retry.json()["job_id"] == first.json()["job_id"] and retry.headers["Location"] == first.headers["Location"]
+    assert retry.headers["Idempotent-Replayed"] == "true" and "Idempotent-Replayed" not in first.headers
+    assert other.status_code == 422
+    assert without_key.json()["job_id"] != first.json()["job_id"]
+    assert await QueryJob.find(QueryJob.conversation_id == conversation.id).count() == 2
+
+@pytest.mark.asyncio
+async def test_resumed_query_jobs_store_their_turn_once(mock_db):
+    import asyncio
+    from datetime import datetime, timedelta, timezone
+    from models.models import QueryJob
+    from db.db_jobs import claim_next_job, complete_job, renew_job_lock
+    from utils.jobs import JobWorkerPool
+    from utils.openai import OpenAIException
+
+    # the lock must be renewed before it times out
+    with pytest.raises(ValueError):
+        JobWorkerPool(1, 10, 60, 1, heartbeat_interval=300, lock_timeout=300)
+    pool = JobWorkerPool(1, 10, 60, 1, heartbeat_interval=0.05, lock_timeout=300)
+
+    conversation = Conversation(name="Test Conversation", params={})
+    await conversation.insert()
+    job = QueryJob(conversation_id=conversation.id, role="user", content="Test query")
+    await job.insert()
+    collection = QueryJob.get_motor_collection()
+
+    async def abandon():
+        # the worker died before it could record how the job ended
+        long_ago = datetime.now(timezone.utc) - timedelta(hours=1)
+        await collection.update_one({"_id": job.id}, {"$set": {"status": "running", "heartbeat_at": long_ago}})
+        return await claim_next_job()
+
+    async def slow_response(conversation):
+        await asyncio.sleep(0.15)
+        return PromptCreate(content="Test response", role="assistant")
+
+    with patch('db.db_query.anonymise_async', new_callable=AsyncMock, side_effect=lambda text, role: text), \
+         patch('db.db_query.count_message_tokens', new_callable=AsyncMock, return_value=5), \
+         patch('utils.pipeline.generate_response', new_callable=AsyncMock, side_effect=[OpenAIException("down"), slow_response]) as mock_generate:
+        # the first run stores the query without a response
+        claimed = await claim_next_job()
+        await pool._run(claimed)
+        assert (await QueryJob.get(job.id)).status == "failed"
+
+        # a running job whose worker renews its lock is not resumed, however long ago it started
+        resumed = await abandon()
+        mock_generate.side_effect = slow_response
+        run = asyncio.ensure_future(pool._run(resumed))
+        await asyncio.sleep(0.01)
+        long_ago = datetime.now(timezone.utc) - timedelta(hours=1)
+        await collection.update_one({"_id": job.id}, {"$set": {"started_at": long_ago, "heartbeat_at": long_ago}})
+        await asyncio.sleep(0.08)
+        assert await claim_next_job() is None
+        await run
+        assert not await renew_job_lock(job.id, claimed.attempts)
+
+        # a job resumed after its turn was stored replays the stored response
+        replayed = await abandon()
+        await pool._run(replayed)
+
+    assert mock_generate.await_count == 2
+    db_job = await QueryJob.get(job.id)
+    assert (db_job.status, db_job.response, db_job.attempts) == ("completed", "Test response", 3)
+    assert db_job.headers == {"X-Turn-Replayed": "true"}
+    # the worker that lost the job cannot overwrite its result
+    await complete_job(job.id, resumed.attempts, "Stale response", {})
+    assert (await QueryJob.get(job.id)).response == "Test response"
+
+    prompts = await Prompt.find(Prompt.conversation_id == conversation.id).sort(+Prompt.sequence).to_list()
+    assert [(prompt.role, prompt.content) for prompt in prompts] == [("user", "Test query"), ("assistant", "Test response")]
+    assert (await Conversation.get(conversation.id)).message_count == 2
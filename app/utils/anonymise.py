@@ -1,19 +1,264 @@
+import asyncio
 import boto3
+import hashlib
+import logging
 import os
+import re
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, List, Match, Optional
+from utils.cache import TTLCache
 
-client = boto3.client('comprehend', region_name='ap-southeast-1', aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'), aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'))
+logger = logging.getLogger(__name__)
+
+ANONYMISER_BACKEND = os.getenv('ANONYMISER_BACKEND', 'comprehend')
+# A file with one name per line, matched by the local engine in addition to the built-in names
+ANONYMISE_NAMES_FILE = os.getenv('ANONYMISE_NAMES_FILE')
+# Set to false to match only the names in ANONYMISE_NAMES_FILE
+ANONYMISE_DEFAULT_NAMES = os.getenv('ANONYMISE_DEFAULT_NAMES', 'true').lower() == 'true'
+ANONYMISE_THREADS = int(os.getenv('ANONYMISE_THREADS', '8'))
+# Comprehend accepts at most 100KB of UTF-8 per request, 25000 characters always fit
+ANONYMISE_CHUNK_CHARS = int(os.getenv('ANONYMISE_CHUNK_CHARS', '25000'))
+ANONYMISE_CHUNK_OVERLAP = int(os.getenv('ANONYMISE_CHUNK_OVERLAP', '200'))
+ANONYMISE_CACHE_SIZE = int(os.getenv('ANONYMISE_CACHE_SIZE', '10000'))
+ANONYMISE_CACHE_TTL = float(os.getenv('ANONYMISE_CACHE_TTL', '3600'))
+# Role -> "full" (configured backend), "local" (offline engine only) or "skip"
+ANONYMISE_ROLE_POLICY = os.getenv('ANONYMISE_ROLE_POLICY', 'assistant:local')
+# Local scans of shorter texts run inline, the thread hop costs more than the scan
+ANONYMISE_OFFLOAD_MIN_CHARS = int(os.getenv('ANONYMISE_OFFLOAD_MIN_CHARS', '5000'))
+
+class Anonymiser(ABC):
+    """Replaces personally identifiable information in a text with `[ENTITY_TYPE]` placeholders."""
+
+    @abstractmethod
+    def anonymise(self, text: str) -> str:
+        """Return the text with every detected entity replaced by its placeholder."""
+
+def replace_entities(text: str, entities: Iterable[Dict]) -> str:
+    """
+    Replace detected entities with their type in a single pass over the text.
+
+    Args:
+      text (str): The original text
+      entities (Iterable[Dict]): Entities with BeginOffset, EndOffset and Type, as returned by Comprehend
+
+    Returns:
+      str: The text with every entity replaced by `[Type]`
+    """
+    pieces: List[str] = []
+    position = 0
+    # on overlaps the earliest, then longest, entity wins
+    for entity in sorted(entities, key=lambda x: (x['BeginOffset'], -x['EndOffset'])):
+        start, end = entity['BeginOffset'], entity['EndOffset']
+        if start < position:
+            # skip entities overlapping one that was already replaced
+            continue
+        pieces.append(text[position:start])
+        pieces.append(f"[{entity['Type']}]")
+        position = end
+    pieces.append(text[position:])
+    return "".join(pieces)
+
+class ComprehendAnonymiser(Anonymiser):
+    """Detects PII with AWS Comprehend, falling back to another anonymiser when the call fails."""
+
+    def __init__(self, fallback: Optional[Anonymiser] = None) -> None:
+        self.client = boto3.client('comprehend', region_name='ap-southeast-1', aws_access_key_id=os.getenv('AWS_ACCESS_KEY_ID'), aws_secret_access_key=os.getenv('AWS_SECRET_ACCESS_KEY'))
+        self.fallback = fallback
+
+    def detect_entities(self, text: str) -> List[Dict]:
+        """Detect PII entities in a text that fits in a single Comprehend request."""
+        return self.client.detect_pii_entities(Text=text, LanguageCode='en')['Entities']
+
+    def anonymise(self, text: str) -> str:
+        try:
+            return replace_entities(text, self.detect_entities(text))
+        except Exception as e:
+            logger.warning(f"Comprehend PII detection failed: {str(e)}")
+            if self.fallback is not None:
+                return self.fallback.anonymise(text)
+            return text
+
+DEFAULT_NAMES = (
+    "Ahmad", "Aisha", "Alice", "Amir", "Ananya", "Arjun", "Bob", "Charlotte", "Chen", "Daniel",
+    "David", "Divya", "Emily", "Farah", "Fatimah", "Hassan", "Huang", "Jessica", "John", "Kumar",
+    "Lakshmi", "Lim", "Ling", "Mary", "Michael", "Muhammad", "Nurul", "Priya", "Rahul", "Rajesh",
+    "Sarah", "Siti", "Tan", "Wei", "Wong", "Xiaoming", "Yusof", "Zhang"
+)
+
+def load_names(path: Optional[str], include_defaults: bool = True) -> List[str]:
+    """Load the name dictionary: the built-in names, extended with a file of one name per line."""
+    names = list(DEFAULT_NAMES) if include_defaults else []
+    if path:
+        with open(path, encoding="utf-8") as names_file:
+            names.extend(line.strip() for line in names_file if line.strip())
+    return names
+
+def luhn_valid(digits: str) -> bool:
+    """Check a card number against the Luhn checksum."""
+    total = 0
+    for index, digit in enumerate(reversed(digits)):
+        value = int(digit)
+        if index % 2 == 1:
+            value *= 2
+            if value > 9:
+                value -= 9
+        total += value
+    return total % 10 == 0
+
+STREET_SUFFIXES = r"Road|Rd|Street|St|Avenue|Ave|Drive|Dr|Lane|Ln|Crescent|Cres|Boulevard|Blvd|Way|Close|Walk|Place|Terrace|Central|Link"
+
+class LocalAnonymiser(Anonymiser):
+    """
+    Detects PII offline with compiled regexes and a name dictionary.
+
+    All patterns are combined into one alternation with a named group per entity type,
+    so the text is scanned and substituted in a single linear pass.
+    """
+
+    def __init__(self, names: Optional[Iterable[str]] = None) -> None:
+        names = sorted(set(names if names is not None else load_names(ANONYMISE_NAMES_FILE, ANONYMISE_DEFAULT_NAMES)), key=len, reverse=True)
+        patterns = {
+            "EMAIL": r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}",
+            "CREDIT_DEBIT_NUMBER": r"(?<!\d)(?:\d[ -]?){12,18}\d(?!\d)",
+            "NRIC": r"\b[STFGMstfgm]\d{7}[A-Za-z]\b",
+            # a bare run of digits is as likely an id or a year range, so a number needs a country code,
+            # an area code in brackets, or the separators of a written phone number
+            "PHONE": (
+                r"(?<![\w+])(?:"
+                r"\+\d{1,3}[ -]?(?:\(\d{1,4}\)[ -]?)?\d{3,4}[ -]?\d{4}"
+                r"|\(\d{1,4}\)[ -]?\d{3,4}[ -]?\d{4}"
+                r"|\d{3}[ .-]\d{3}[ .-]\d{4}"
+                r"|\d{4} \d{4}"
+                r")(?!\w)"
+            ),
+            "ADDRESS": (
+                rf"\b\d{{1,5}}[A-Za-z]?\s+(?:[A-Z][a-z]+\s+){{1,3}}(?:{STREET_SUFFIXES})\b"
+                r"|(?i:\b(?:blk|block)\s+\d{1,4}[a-z]?\b)"
+                r"|(?i:\bsingapore\s+\d{6}\b)"
+                r"|#\d{1,3}-\d{1,5}\b"
+            ),
+            "NAME": r"\b(?:Mr|Mrs|Ms|Miss|Mdm|Dr|Prof)\.?\s+[A-Z][a-z]+(?:\s+[A-Z][a-z]+)?",
+        }
+        if names:
+            patterns["NAME"] += r"|\b(?:" + "|".join(re.escape(name) for name in names) + r")\b"
+        self.pattern = re.compile("|".join(f"(?P<{entity_type}>{pattern})" for entity_type, pattern in patterns.items()))
+
+    def replace(self, match: Match) -> str:
+        entity_type = match.lastgroup
+        if entity_type == "CREDIT_DEBIT_NUMBER" and not luhn_valid(re.sub(r"\D", "", match.group())):
+            return match.group()
+        return f"[{entity_type}]"
+
+    def anonymise(self, text: str) -> str:
+        return self.pattern.sub(self.replace, text)
+
+def create_anonymiser(backend: str = ANONYMISER_BACKEND) -> Anonymiser:
+    """
+    Create the anonymiser selected by ANONYMISER_BACKEND: "comprehend" or "local".
+    Comprehend falls back to the local engine when AWS is unreachable.
+    """
+    if backend == "local":
+        return LocalAnonymiser()
+    if backend == "comprehend":
+        return ComprehendAnonymiser(fallback=LocalAnonymiser())
+    raise ValueError(f"Unknown anonymiser backend: {backend}")
+
+anonymiser = create_anonymiser()
 
 def anonymise(text: str) -> str:
-    try: 
-      response = client.detect_pii_entities(Text=text, LanguageCode='en')
-      entities = sorted(response['Entities'], key=lambda x: x['BeginOffset'], reverse=True)
-      for entity in entities:
-          start = entity['BeginOffset']
-          end = entity['EndOffset']
-          entity_type = entity['Type']
-          anonymised_text = text[:start] + f"[{entity_type}]" + text[end:]
-          text = anonymised_text
-      return text
-    except Exception as e:
-        print(e)
-        return text
+    return anonymiser.anonymise(text)
+
+def split_chunks(text: str, chunk_chars: int, overlap: int) -> List[int]:
+    """
+    Split a text into overlapping chunks, so an entity cut by one chunk's boundary is whole in the next.
+
+    Returns:
+      List[int]: The start offset of every chunk, each chunk is `chunk_chars` long
+    """
+    step = max(chunk_chars - overlap, 1)
+    starts = [0]
+    while starts[-1] + chunk_chars < len(text):
+        starts.append(starts[-1] + step)
+    return starts
+
+def parse_role_policy(policy: str) -> Dict[str, str]:
+    """Parse a "role:mode,role:mode" policy string."""
+    modes = {}
+    for item in filter(None, (part.strip() for part in policy.split(","))):
+        role, mode = item.split(":")
+        if mode not in ("full", "local", "skip"):
+            raise ValueError(f"Unknown anonymisation mode for role {role}: {mode}")
+        modes[role.strip()] = mode
+    return modes
+
+class AnonymisationPipeline:
+    """
+    Runs anonymisation off the event loop with a content-hash cache and per-role scanning modes.
+
+    Comprehend calls run on a bounded thread pool, and texts over the request size limit are
+    split into overlapping chunks that are scanned in parallel.
+    """
+
+    def __init__(self, anonymiser: Anonymiser, local: LocalAnonymiser, role_policy: Dict[str, str], cache: TTLCache[str], executor: ThreadPoolExecutor) -> None:
+        self.anonymiser = anonymiser
+        self.local = local
+        self.role_policy = role_policy
+        self.cache = cache
+        self.executor = executor
+
+    async def anonymise(self, text: str, role: Optional[str] = None) -> str:
+        mode = self.role_policy.get(role, "full")
+        if mode == "skip" or not text:
+            return text
+        engine = self.local if mode == "local" else self.anonymiser
+
+        key = (type(engine).__name__, hashlib.sha256(text.encode("utf-8")).digest())
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+
+        if isinstance(engine, ComprehendAnonymiser):
+            result = await self.anonymise_comprehend(engine, text)
+        elif len(text) < ANONYMISE_OFFLOAD_MIN_CHARS:
+            result = engine.anonymise(text)
+        else:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, engine.anonymise, text)
+
+        self.cache.set(key, result)
+        return result
+
+    async def anonymise_comprehend(self, engine: ComprehendAnonymiser, text: str) -> str:
+        loop = asyncio.get_running_loop()
+        starts = split_chunks(text, ANONYMISE_CHUNK_CHARS, ANONYMISE_CHUNK_OVERLAP)
+        try:
+            chunk_entities = await asyncio.gather(*[
+                loop.run_in_executor(self.executor, engine.detect_entities, text[start:start + ANONYMISE_CHUNK_CHARS])
+                for start in starts
+            ])
+        except Exception as e:
+            logger.warning(f"Comprehend PII detection failed: {str(e)}")
+            if engine.fallback is None:
+                return text
+            return await loop.run_in_executor(self.executor, engine.fallback.anonymise, text)
+
+        entities = [
+            {**entity, "BeginOffset": entity["BeginOffset"] + start, "EndOffset": entity["EndOffset"] + start}
+            for start, found in zip(starts, chunk_entities)
+            for entity in found
+        ]
+        return replace_entities(text, entities)
+
+pipeline = AnonymisationPipeline(
+    anonymiser,
+    anonymiser.fallback if isinstance(anonymiser, ComprehendAnonymiser) else anonymiser,
+    parse_role_policy(ANONYMISE_ROLE_POLICY),
+    TTLCache(ANONYMISE_CACHE_SIZE, ANONYMISE_CACHE_TTL),
+    ThreadPoolExecutor(max_workers=ANONYMISE_THREADS, thread_name_prefix="anonymise")
+)
+
+async def anonymise_async(text: str, role: Optional[str] = None) -> str:
+    """
+    Anonymise a text without blocking the event loop, applying the scanning mode configured for the role.
+    """
+    return await pipeline.anonymise(text, role)
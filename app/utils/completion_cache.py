@@ -0,0 +1,98 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Dict, Optional, Tuple
+from models.models import CompletionCacheEntry
+from models.schemas import ConversationFull, PromptCreate
+from utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+COMPLETION_CACHE_ENABLED = os.getenv('COMPLETION_CACHE_ENABLED', 'true').lower() == 'true'
+COMPLETION_CACHE_SIZE = int(os.getenv('COMPLETION_CACHE_SIZE', '1000'))
+COMPLETION_CACHE_TTL = float(os.getenv('COMPLETION_CACHE_TTL', '86400'))
+# OpenAI samples with temperature 1 when the conversation does not set one
+DEFAULT_TEMPERATURE = 1.0
+
+CACHE_HIT = "HIT"
+CACHE_MISS = "MISS"
+CACHE_BYPASS = "BYPASS"
+
+memory_cache: TTLCache[str] = TTLCache(COMPLETION_CACHE_SIZE, COMPLETION_CACHE_TTL)
+stats: Dict[str, int] = {"memory_hits": 0, "mongo_hits": 0, "misses": 0, "bypasses": 0}
+
+def completion_cache_key(conversation: ConversationFull, model: str) -> str:
+  """
+  Hash the ordered (role, content) history together with the params and model name
+  """
+  payload = {
+    "model": model,
+    "params": conversation.params,
+    "messages": [[message.role, message.content] for message in conversation.messages]
+  }
+  return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+def is_cacheable(conversation: ConversationFull, force: bool = False) -> bool:
+  """
+  Completions are only reused when they are deterministic, unless the caller opts in
+  """
+  if not COMPLETION_CACHE_ENABLED:
+    return False
+  return force or conversation.params.get("temperature", DEFAULT_TEMPERATURE) <= 0
+
+async def get_cached_completion(conversation: ConversationFull, model: str, force: bool = False) -> Tuple[Optional[PromptCreate], str, Optional[str]]:
+  """
+  Look up a completion in the memory tier, then in the Mongo tier
+
+  Args:
+    conversation (ConversationFull): The conversation history the completion is for
+    model (str): The model name
+    force (bool): Use the cache even when the conversation samples with a temperature above 0
+
+  Returns:
+    Tuple[Optional[PromptCreate], str, Optional[str]]: The cached response if any, the cache status
+    (HIT, MISS or BYPASS) and the cache key, which is None when the cache is bypassed
+  """
+  if not is_cacheable(conversation, force):
+    stats["bypasses"] += 1
+    return None, CACHE_BYPASS, None
+
+  key = completion_cache_key(conversation, model)
+  content = memory_cache.get(key)
+  if content is not None:
+    stats["memory_hits"] += 1
+    return PromptCreate(content=content, role="assistant"), CACHE_HIT, key
+
+  try:
+    entry = await CompletionCacheEntry.get(key)
+  except Exception as e:
+    logger.error(f"Database error reading completion cache: {str(e)}")
+    entry = None
+  if entry is not None:
+    stats["mongo_hits"] += 1
+    memory_cache.set(key, entry.content)
+    return PromptCreate(content=entry.content, role="assistant"), CACHE_HIT, key
+
+  stats["misses"] += 1
+  return None, CACHE_MISS, key
+
+async def set_cached_completion(key: Optional[str], model: str, response: PromptCreate) -> None:
+  """
+  Store a completion in both tiers, the Mongo tier expires it through its TTL index
+  """
+  if key is None:
+    return
+  memory_cache.set(key, response.content)
+  try:
+    await CompletionCacheEntry(id=key, model=model, content=response.content).save()
+  except Exception as e:
+    logger.error(f"Database error writing completion cache: {str(e)}")
+
+def get_stats() -> Dict[str, float]:
+  lookups = stats["memory_hits"] + stats["mongo_hits"] + stats["misses"]
+  return {
+    **stats,
+    "memory_size": len(memory_cache),
+    "hit_ratio": (stats["memory_hits"] + stats["mongo_hits"]) / lookups if lookups else 0.0
+  }
@@ -0,0 +1,248 @@
+import os
+import time
+import zlib
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# brotli and zstd are offered only when their packages are installed, gzip always is
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+COMPRESSION_ENABLED = os.getenv('COMPRESSION_ENABLED', 'true').lower() == 'true'
+# Complete responses smaller than this are not worth the CPU, streamed ones are always compressed
+COMPRESSION_MINIMUM_SIZE = int(os.getenv('COMPRESSION_MINIMUM_SIZE', '1024'))
+COMPRESSION_GZIP_LEVEL = int(os.getenv('COMPRESSION_GZIP_LEVEL', '6'))
+COMPRESSION_BROTLI_QUALITY = int(os.getenv('COMPRESSION_BROTLI_QUALITY', '4'))
+COMPRESSION_ZSTD_LEVEL = int(os.getenv('COMPRESSION_ZSTD_LEVEL', '3'))
+# Server preference when the client accepts several codings equally
+COMPRESSION_ENCODINGS = [encoding.strip() for encoding in os.getenv('COMPRESSION_ENCODINGS', 'zstd,br,gzip').split(',') if encoding.strip()]
+
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+class GzipCompressor:
+    def __init__(self, level: int) -> None:
+        # wbits 31 writes the gzip header and trailer
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+class BrotliCompressor:
+    def __init__(self, quality: int) -> None:
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+class ZstdCompressor:
+    def __init__(self, level: int) -> None:
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+def available_encodings(gzip_level: int, brotli_quality: int, zstd_level: int) -> Dict[str, Callable[[], Any]]:
+    """Compressor factories by content coding, for the codecs that are installed."""
+    encodings: Dict[str, Callable[[], Any]] = {"gzip": lambda: GzipCompressor(gzip_level)}
+    if brotli is not None:
+        encodings["br"] = lambda: BrotliCompressor(brotli_quality)
+    if zstandard is not None:
+        encodings["zstd"] = lambda: ZstdCompressor(zstd_level)
+    return encodings
+
+def negotiate_encoding(accept_encoding: str, preference: List[str]) -> Optional[str]:
+    """
+    Pick the content coding for an Accept-Encoding header
+
+    The client's q-values decide first, then the server's preference order. None means the
+    response is sent uncompressed.
+    """
+    accepted: Dict[str, float] = {}
+    for part in accept_encoding.split(","):
+        coding, _, parameters = part.strip().partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for parameter in parameters.split(";"):
+            name, _, value = parameter.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding] = quality
+
+    wildcard = accepted.get("*", 0.0)
+    candidates = [
+        (accepted.get(coding, wildcard), -rank, coding)
+        for rank, coding in enumerate(preference)
+        if accepted.get(coding, wildcard) > 0
+    ]
+    return max(candidates)[2] if candidates else None
+
+class CompressionStats:
+    """Bytes in and out and compression CPU time, by route and content coding."""
+
+    def __init__(self) -> None:
+        # (route, encoding) -> [responses, bytes in, bytes out, cpu seconds]
+        self._routes: Dict[Tuple[str, str], List[float]] = {}
+
+    def record(self, route: str, encoding: str, bytes_in: int, bytes_out: int, cpu_seconds: float) -> None:
+        entry = self._routes.setdefault((route, encoding), [0, 0, 0, 0.0])
+        entry[0] += 1
+        entry[1] += bytes_in
+        entry[2] += bytes_out
+        entry[3] += cpu_seconds
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "route": route,
+                "encoding": encoding,
+                "responses": responses,
+                "bytes_in": bytes_in,
+                "bytes_out": bytes_out,
+                "ratio": bytes_in / bytes_out if bytes_out else 0.0,
+                "cpu_seconds": cpu_seconds,
+                "cpu_us_per_kib": cpu_seconds * 1e6 / (bytes_in / 1024) if bytes_in else 0.0
+            }
+            for (route, encoding), (responses, bytes_in, bytes_out, cpu_seconds) in sorted(self._routes.items())
+        ]
+
+class CompressionMiddleware:
+    """
+    Compresses responses with the best content coding the client accepts.
+
+    Complete responses smaller than `minimum_size` are sent as they are. Streamed responses are
+    compressed chunk by chunk, and every chunk is flushed so the client receives each event as
+    soon as it is produced. Only text, JSON and NDJSON responses are compressed.
+
+    A plain ASGI middleware, so streamed bodies pass through without being buffered.
+    """
+
+    def __init__(self, app: Any, minimum_size: int, encodings: Dict[str, Callable[[], Any]], preference: List[str], stats: CompressionStats) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+        self.encodings = encodings
+        self.preference = [encoding for encoding in preference if encoding in encodings]
+        self.stats = stats
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept_encoding = value.decode("latin-1")
+        encoding = negotiate_encoding(accept_encoding, self.preference) if accept_encoding else None
+        await self.app(scope, receive, CompressingSender(self, scope, send, encoding))
+
+class CompressingSender:
+    """Wraps the ASGI send of one response, deciding on compression when the first body arrives."""
+
+    def __init__(self, middleware: CompressionMiddleware, scope: Dict[str, Any], send: Callable, encoding: Optional[str]) -> None:
+        self.middleware = middleware
+        self.scope = scope
+        self.send = send
+        self.encoding = encoding
+        self.start: Optional[Dict[str, Any]] = None
+        self.compressor: Any = None
+        self.passthrough = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.cpu_seconds = 0.0
+
+    def _route(self) -> str:
+        # the router stores the matched route in the scope, so requests are grouped by path template
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or self.scope.get("path", "")
+
+    def _compressible(self, headers: List[Tuple[bytes, bytes]]) -> bool:
+        content_type = ""
+        for name, value in headers:
+            if name == b"content-encoding":
+                return False
+            if name == b"content-type":
+                content_type = value.decode("latin-1").lower()
+        return content_type.startswith(COMPRESSIBLE_TYPES) and self.start["status"] not in (204, 304)
+
+    def _compress(self, data: bytes, final: bool) -> bytes:
+        started = time.thread_time()
+        compressed = self.compressor.compress(data) + (self.compressor.finish() if final else self.compressor.flush())
+        self.cpu_seconds += time.thread_time() - started
+        self.bytes_in += len(data)
+        self.bytes_out += len(compressed)
+        return compressed
+
+    def _headers(self, content_length: Optional[int]) -> List[Tuple[bytes, bytes]]:
+        headers = [(name, value) for name, value in self.start["headers"] if name not in (b"content-length", b"vary")]
+        vary = [value for name, value in self.start["headers"] if name == b"vary"]
+        headers.append((b"vary", b", ".join(vary + [b"Accept-Encoding"])))
+        if self.compressor is not None:
+            headers.append((b"content-encoding", self.encoding.encode("latin-1")))
+        if content_length is not None:
+            headers.append((b"content-length", str(content_length).encode("latin-1")))
+        return headers
+
+    async def __call__(self, message: Dict[str, Any]) -> None:
+        if message["type"] == "http.response.start":
+            self.start = message
+            return
+        if message["type"] != "http.response.body" or self.passthrough:
+            await self.send(message)
+            return
+
+        body, more_body = message.get("body", b""), message.get("more_body", False)
+        if self.start is not None:
+            start = self.start
+            if not self._compressible(start["headers"]):
+                self.passthrough = True
+                await self.send(start)
+                await self.send(message)
+                return
+            if self.encoding is None or (not more_body and len(body) < self.middleware.minimum_size):
+                self.passthrough = True
+                await self.send({**start, "headers": self._headers(None if more_body else len(body))})
+                await self.send(message)
+                return
+
+            self.compressor = self.middleware.encodings[self.encoding]()
+            compressed = self._compress(body, final=not more_body)
+            # a streamed response's length is not known up front
+            await self.send({**start, "headers": self._headers(None if more_body else len(compressed))})
+            self.start = None
+            await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+        else:
+            compressed = self._compress(body, final=not more_body)
+            if compressed or not more_body:
+                await self.send({"type": "http.response.body", "body": compressed, "more_body": more_body})
+
+        if not more_body:
+            self.middleware.stats.record(self._route(), self.encoding, self.bytes_in, self.bytes_out, self.cpu_seconds)
+
+compression_stats = CompressionStats()
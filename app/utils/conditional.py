@@ -0,0 +1,52 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from typing import Any, Dict, List, Optional
+
+def conversation_etag(stamp: Dict[str, Any]) -> str:
+  """
+  Build a conversation's ETag from its stamp
+
+  The ETag is weak: the conversation's token count is bumped when new messages are reserved,
+  a moment before the stamp changes once they are stored.
+  """
+  return f'W/"{stamp.get("version", 0)}-{stamp.get("stored_messages", 0)}"'
+
+def conversations_etag(stamps: List[Dict[str, Any]]) -> str:
+  """
+  Build the ETag of a page of conversations, which changes when any of them changes, or when
+  conversations are created or deleted within the page
+  """
+  digest = hashlib.sha256()
+  for stamp in stamps:
+    digest.update(f'{stamp["_id"]}:{stamp.get("version", 0)}-{stamp.get("stored_messages", 0)};'.encode("utf-8"))
+  return f'W/"{digest.hexdigest()[:32]}"'
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+  """
+  Compare an If-None-Match header with an ETag the way GET requests do, ignoring weakness
+  """
+  if not if_none_match:
+    return False
+  if if_none_match.strip() == "*":
+    return True
+  opaque = etag.removeprefix("W/")
+  return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+def format_last_modified(updated_at: Optional[datetime]) -> Optional[str]:
+  if updated_at is None:
+    return None
+  # pymongo returns naive datetimes in UTC
+  if updated_at.tzinfo is None:
+    updated_at = updated_at.replace(tzinfo=timezone.utc)
+  return format_datetime(updated_at.astimezone(timezone.utc), usegmt=True)
+
+def validator_headers(etag: str, updated_at: Optional[datetime]) -> Dict[str, str]:
+  """
+  Build the ETag and Last-Modified headers of a response
+  """
+  headers = {"ETag": etag}
+  last_modified = format_last_modified(updated_at)
+  if last_modified is not None:
+    headers["Last-Modified"] = last_modified
+  return headers
@@ -0,0 +1,83 @@
+import os
+from typing import Dict, Tuple
+from models.schemas import ConversationFull, ContextMetadata, QueryRoleType
+from utils.token_counter import TOKENS_PER_REPLY
+
+# The budget of models missing from CONTEXT_WINDOWS, gpt-3.5-turbo's 16385 tokens for the prompt and completion together
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '16385'))
+COMPLETION_TOKEN_RESERVE = int(os.getenv('COMPLETION_TOKEN_RESERVE', '1024'))
+
+def parse_context_windows(spec: str) -> Dict[str, int]:
+  """
+  Parse context windows such as "gpt-4o=128000,gpt-4=8192" into tokens by model name prefix
+  """
+  windows = {}
+  for entry in filter(None, (part.strip() for part in spec.split(","))):
+    model, tokens = entry.split("=", 1)
+    windows[model.strip()] = int(tokens)
+  return windows
+
+# Tokens each model accepts for the prompt and completion together, by model name prefix
+CONTEXT_WINDOWS = {
+  "gpt-3.5-turbo": 16385,
+  "gpt-4": 8192,
+  "gpt-4-32k": 32768,
+  "gpt-4-turbo": 128000,
+  "gpt-4o": 128000,
+  "gpt-4o-mini": 128000,
+  **parse_context_windows(os.getenv('CONTEXT_WINDOWS', ''))
+}
+
+def get_token_budget(model: str) -> int:
+  """
+  The context window of a model, e.g. gpt-4o-2024-08-06 has gpt-4o's, or CONTEXT_TOKEN_BUDGET for unknown models
+  """
+  prefixes = [prefix for prefix in CONTEXT_WINDOWS if model.startswith(prefix)]
+  return CONTEXT_WINDOWS[max(prefixes, key=len)] if prefixes else CONTEXT_TOKEN_BUDGET
+
+def get_completion_reserve(conversation: ConversationFull) -> int:
+  """
+  Tokens to set aside for the completion: the conversation's `max_tokens` param, or COMPLETION_TOKEN_RESERVE
+  """
+  return int(conversation.params.get("max_tokens", COMPLETION_TOKEN_RESERVE))
+
+def build_context(conversation: ConversationFull, token_budget: int = CONTEXT_TOKEN_BUDGET) -> Tuple[ConversationFull, ContextMetadata]:
+  """
+  Fit a conversation's history into the LLM's token budget
+
+  System messages are always kept. The remaining budget is filled with the newest messages,
+  after reserving room for the completion (the conversation's `max_tokens` param, or
+  COMPLETION_TOKEN_RESERVE). The newest message is always sent, even if it alone exceeds the budget.
+  Token counts stored on the messages are used, so the history is not re-tokenised. Prompts
+  saved before the counts existed are counted once by migrate_prompt_tokens.
+
+  Args:
+    conversation (ConversationFull): The conversation with its full history
+    token_budget (int): The context window of the model the turn goes to, see get_token_budget
+
+  Returns:
+    Tuple[ConversationFull, ContextMetadata]: The conversation with only the messages to send, and the trimming decision
+  """
+  available = max(token_budget - get_completion_reserve(conversation) - TOKENS_PER_REPLY, 0)
+  message_tokens = [message.tokens for message in conversation.messages]
+
+  keep = [message.role == QueryRoleType.system for message in conversation.messages]
+  used = sum(tokens for tokens, kept in zip(message_tokens, keep) if kept)
+
+  for index in range(len(conversation.messages) - 1, -1, -1):
+    if keep[index]:
+      continue
+    is_newest = index == len(conversation.messages) - 1
+    if used + message_tokens[index] > available and not is_newest:
+      break
+    keep[index] = True
+    used += message_tokens[index]
+
+  messages = [message for message, kept in zip(conversation.messages, keep) if kept]
+  metadata = ContextMetadata(
+    messages_sent=len(messages),
+    messages_dropped=len(conversation.messages) - len(messages),
+    prompt_tokens=used,
+    token_budget=available
+  )
+  return conversation.model_copy(update={"messages": messages}), metadata
@@ -0,0 +1,140 @@
+import sys
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from models.schemas import PromptRead
+
+# Measured footprint of a PromptRead besides its content string
+MESSAGE_OVERHEAD_BYTES = 1000
+
+def estimate_size(messages: List[PromptRead]) -> int:
+    return sum(MESSAGE_OVERHEAD_BYTES + sys.getsizeof(message.content) for message in messages)
+
+class CachedConversation:
+    __slots__ = ("version", "messages", "size")
+
+    def __init__(self, version: int, messages: List[PromptRead]) -> None:
+        self.version = version
+        self.messages = messages
+        self.size = estimate_size(messages)
+
+    @property
+    def last_sequence(self) -> int:
+        return self.messages[-1].sequence if self.messages else 0
+
+class ConversationCache:
+    """
+    In-process LRU cache of conversation histories, bounded by entries and estimated memory.
+
+    Entries belong to a version of the conversation, which changes on anything but new messages.
+    New messages extend an entry instead of replacing it. An entry only holds messages with
+    consecutive sequences, so a message whose position was reserved but that is not written yet
+    is never skipped: the messages after a gap are read again until the gap is filled.
+
+    Not thread safe, meant to be used from the event loop.
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.extensions = 0
+        self.invalidations = 0
+        self.evictions = 0
+        self._entries: "OrderedDict[str, CachedConversation]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def peek(self, conversation_id: str) -> Optional[CachedConversation]:
+        """Get an entry without counting a lookup or refreshing its recency."""
+        return self._entries.get(conversation_id)
+
+    def validate(self, conversation_id: str, version: int, message_count: int) -> bool:
+        """
+        Count a lookup, and drop the entry if it belongs to an older version of the conversation
+        or holds more messages than the conversation has
+        """
+        entry = self._entries.get(conversation_id)
+        if entry is None or entry.version != version or entry.last_sequence > message_count:
+            if entry is not None:
+                self.invalidate(conversation_id)
+            self.misses += 1
+            return False
+        self._entries.move_to_end(conversation_id)
+        self.hits += 1
+        return True
+
+    def record_miss(self) -> None:
+        self.misses += 1
+
+    def set(self, conversation_id: str, version: int, messages: List[PromptRead]) -> None:
+        """Cache a conversation's messages, up to the first gap in their sequences."""
+        self.invalidate(conversation_id, count=False)
+        if self.max_entries <= 0:
+            return
+        entry = CachedConversation(version, [])
+        self._entries[conversation_id] = entry
+        self._append(entry, messages)
+        self._evict()
+
+    def extend(self, conversation_id: str, messages: List[PromptRead]) -> None:
+        """Append new messages to a cached conversation, up to the first gap in their sequences."""
+        entry = self._entries.get(conversation_id)
+        if entry is None:
+            return
+        if self._append(entry, messages):
+            self.extensions += 1
+            self._evict()
+
+    def invalidate(self, conversation_id: str, count: bool = True) -> None:
+        entry = self._entries.pop(conversation_id, None)
+        if entry is not None:
+            self.size -= entry.size
+            if count:
+                self.invalidations += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "extensions": self.extensions,
+            "invalidations": self.invalidations,
+            "evictions": self.evictions
+        }
+
+    def _append(self, entry: CachedConversation, messages: List[PromptRead]) -> bool:
+        added = []
+        next_sequence = entry.last_sequence + 1
+        for message in messages:
+            if message.sequence < next_sequence:
+                continue
+            if message.sequence != next_sequence:
+                break
+            added.append(message)
+            next_sequence += 1
+        if not added:
+            return False
+        # replace rather than extend the list, conversations already handed out keep their messages
+        entry.messages = entry.messages + added
+        added_size = estimate_size(added)
+        entry.size += added_size
+        self.size += added_size
+        return True
+
+    def _evict(self) -> None:
+        while self._entries and (len(self._entries) > self.max_entries or self.size > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self.size -= entry.size
+            self.evictions += 1
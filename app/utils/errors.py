@@ -1,6 +1,11 @@
 
 from models.schemas import APIError
 from fastapi.responses import JSONResponse
+from beanie.exceptions import DocumentNotFound
+from utils.openai import OpenAIException
+from utils.scheduler import RateLimitExceeded, AdmissionQueueFull
+from utils.resilience import CircuitOpenError
+import asyncio
 
 def create_error_response(status_code: int, message: str, request: dict, error: Exception) -> JSONResponse:
     return APIError(
@@ -9,3 +14,23 @@ def create_error_response(status_code: int, message: str, request: dict, error:
         request=request,
         details={"error": str(error)}
     )
+
+def create_query_error_response(conversation_id: str, error: Exception) -> APIError:
+    """
+    Describe a failed query with the API error POST /query/{conversation_id} returns for it
+    """
+    if isinstance(error, DocumentNotFound):
+        status_code, message = 404, "Conversation not found"
+    elif isinstance(error, RateLimitExceeded):
+        status_code, message = 429, "Rate limit exceeded"
+    elif isinstance(error, AdmissionQueueFull):
+        status_code, message = 503, "Too many queries are waiting for the LLM"
+    elif isinstance(error, CircuitOpenError):
+        status_code, message = 503, "LLM is unavailable"
+    elif isinstance(error, OpenAIException):
+        status_code, message = 422, "Unable to create resource due to errors"
+    elif isinstance(error, asyncio.TimeoutError):
+        status_code, message = 504, "Query timed out"
+    else:
+        status_code, message = 500, "Internal Server Error"
+    return create_error_response(status_code, message, {"method": "POST", "url": "/query/" + conversation_id}, error)
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import math
+import os
+import random
+import time
+import uuid
+from typing import Any, AsyncIterator, Callable, Dict, List, Mapping, Optional, Tuple
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from utils.providers import LLMProvider, ProviderError
+
+# Run with `uvicorn utils.fake_llm:create_default_app --factory --port 8081` and point OPENAI_BASE_URL at http://localhost:8081/v1
+FAKE_LLM_LATENCY_MEDIAN = float(os.getenv('FAKE_LLM_LATENCY_MEDIAN', '0.5'))
+FAKE_LLM_LATENCY_SIGMA = float(os.getenv('FAKE_LLM_LATENCY_SIGMA', '0.5'))
+FAKE_LLM_TOKENS_PER_SECOND = float(os.getenv('FAKE_LLM_TOKENS_PER_SECOND', '50'))
+FAKE_LLM_ERROR_RATE = float(os.getenv('FAKE_LLM_ERROR_RATE', '0'))
+FAKE_LLM_REPLY_TOKENS = int(os.getenv('FAKE_LLM_REPLY_TOKENS', '20'))
+# Seed the latency and error draws for reproducible runs
+FAKE_LLM_SEED = int(os.getenv('FAKE_LLM_SEED')) if os.getenv('FAKE_LLM_SEED') else None
+
+class FakeLLM:
+    """
+    A stand-in for the OpenAI chat completions API with a controllable latency distribution,
+    throughput and error rate, for testing how the app behaves when the LLM is slow or down, and
+    for load tests and CI without the real API. It is served over HTTP by create_app, or
+    in-process by FakeProvider.
+
+    Latencies follow a log-normal distribution around `latency_median` by default, which has the
+    long tail real LLM latencies have. `latency` replaces it, e.g. with a scripted sequence.
+    """
+
+    def __init__(self, latency_median: float = FAKE_LLM_LATENCY_MEDIAN, latency_sigma: float = FAKE_LLM_LATENCY_SIGMA, tokens_per_second: float = FAKE_LLM_TOKENS_PER_SECOND, error_rate: float = FAKE_LLM_ERROR_RATE, reply_tokens: int = FAKE_LLM_REPLY_TOKENS, latency: Optional[Callable[[], float]] = None, seed: Optional[int] = FAKE_LLM_SEED) -> None:
+        self.random = random.Random(seed)
+        self.latency = latency or (lambda: self.random.lognormvariate(math.log(latency_median), latency_sigma))
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.reply_tokens = reply_tokens
+        self.started = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def reply(self, body: Dict[str, Any]) -> str:
+        return " ".join(f"token{i}" for i in range(int(body.get("max_tokens") or self.reply_tokens)))
+
+    def completion(self, body: Dict[str, Any], content: str) -> Dict[str, Any]:
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in body.get("messages", []))
+        completion_tokens = len(content.split())
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        }
+
+    def chunk(self, body: Dict[str, Any], completion_id: str, delta: Dict[str, str], finish_reason: Optional[str] = None) -> str:
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+        }
+        return f"data: {json.dumps(chunk)}\n\n"
+
+    async def first_token(self, body: Dict[str, Any]) -> str:
+        """
+        Wait for the time to first token and return the reply
+
+        Raises:
+          - ProviderError: With status 500, for `error_rate` of the calls
+        """
+        self.started += 1
+        try:
+            await asyncio.sleep(self.latency())
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.random.random() < self.error_rate:
+            self.failed += 1
+            raise ProviderError("Fake LLM error", 500)
+        return self.reply(body)
+
+    async def tokens(self, content: str) -> AsyncIterator[str]:
+        """Yield the reply's content deltas at `tokens_per_second`."""
+        try:
+            for i, token in enumerate(content.split()):
+                await asyncio.sleep(1 / self.tokens_per_second)
+                yield token if i == 0 else " " + token
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        self.completed += 1
+
+    async def complete(self, body: Dict[str, Any]) -> str:
+        content = await self.first_token(body)
+        try:
+            await asyncio.sleep(len(content.split()) / self.tokens_per_second)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        self.completed += 1
+        return content
+
+    async def stream(self, body: Dict[str, Any], content: str) -> AsyncIterator[str]:
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        yield self.chunk(body, completion_id, {"role": "assistant", "content": ""})
+        async for delta in self.tokens(content):
+            yield self.chunk(body, completion_id, {"content": delta})
+        yield self.chunk(body, completion_id, {}, "stop")
+        yield "data: [DONE]\n\n"
+
+    async def handle(self, body: Dict[str, Any]) -> Any:
+        try:
+            if body.get("stream"):
+                return StreamingResponse(self.stream(body, await self.first_token(body)), media_type="text/event-stream")
+            return JSONResponse(content=self.completion(body, await self.complete(body)))
+        except ProviderError as e:
+            return JSONResponse(status_code=e.status_code, content={"error": {"message": str(e), "type": "server_error", "param": None, "code": None}})
+
+class FakeProvider(LLMProvider):
+    """Serves completions from a FakeLLM in-process, without the HTTP round trip."""
+
+    name = "fake"
+    default_model = "fake"
+
+    def __init__(self, fake: FakeLLM) -> None:
+        self.fake = fake
+
+    async def complete(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Tuple[str, Mapping[str, str]]:
+        return await self.fake.complete({"model": model, "messages": messages, **params}), {}
+
+    async def open_stream(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Tuple[Mapping[str, str], AsyncIterator[str]]:
+        content = await self.fake.first_token({"model": model, "messages": messages, **params})
+        return {}, self.fake.tokens(content)
+
+def create_app(fake: FakeLLM) -> FastAPI:
+    fake_app = FastAPI()
+    fake_app.state.fake = fake
+
+    @fake_app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        return await fake.handle(await request.json())
+
+    return fake_app
+
+def create_default_app() -> FastAPI:
+    """Serve a FakeLLM configured from the FAKE_LLM_* environment variables."""
+    return create_app(FakeLLM())
@@ -0,0 +1,97 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Deque, Generic, List, Optional, Set, Tuple, TypeVar
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+class GroupCommit(Generic[T]):
+    """
+    Combines concurrent writes into bulk writes.
+
+    A write issued while no bulk write is running is written straight away. Writes issued while
+    one is running are queued and go out together in the next one, so batching never adds
+    latency when the writer is idle and grows with load.
+    """
+
+    def __init__(self, write_many: Callable[[List[T]], Awaitable[None]], max_batch: int) -> None:
+        self.write_many = write_many
+        self.max_batch = max_batch
+        self._pending: Deque[Tuple[List[T], asyncio.Future]] = deque()
+        self._flushing = False
+        # the running flush, referenced so it is not garbage collected while it runs
+        self._flusher: Optional[asyncio.Task] = None
+        self.writes = 0
+        self.batches = 0
+
+    async def write(self, items: List[T]) -> None:
+        """
+        Write items as part of the next bulk write
+
+        Raises:
+          Exception: The bulk write's error, if it failed for any of these items
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((items, future))
+        self.writes += 1
+        if not self._flushing:
+            self._flushing = True
+            self._flusher = asyncio.ensure_future(self._flush())
+            self._flusher.add_done_callback(self._flushed)
+        await future
+
+    def _flushed(self, task: asyncio.Task) -> None:
+        if task is self._flusher:
+            self._flusher = None
+        if not task.cancelled() and task.exception() is not None:
+            error = task.exception()
+            logger.error(f"Group commit flush failed: {error}", exc_info=error)
+
+    def _next_batch(self) -> List[Tuple[List[T], asyncio.Future]]:
+        batch, size = [], 0
+        while self._pending and (not batch or size + len(self._pending[0][0]) <= self.max_batch):
+            items, future = self._pending.popleft()
+            batch.append((items, future))
+            size += len(items)
+        return batch
+
+    async def _flush(self) -> None:
+        batch: List[Tuple[List[T], asyncio.Future]] = []
+        try:
+            while self._pending:
+                batch = self._next_batch()
+                self.batches += 1
+                failed: Set[int] = set()
+                error = None
+                try:
+                    await self.write_many([item for items, _ in batch for item in items])
+                except BulkWriteError as e:
+                    # an unordered bulk write reports the items it could not write
+                    failed = {write_error["index"] for write_error in e.details.get("writeErrors", [])}
+                    error = e
+                except Exception as e:
+                    failed = set(range(sum(len(items) for items, _ in batch)))
+                    error = e
+
+                offset = 0
+                for items, future in batch:
+                    indexes = range(offset, offset + len(items))
+                    offset += len(items)
+                    if future.done():
+                        continue
+                    if any(index in failed for index in indexes):
+                        future.set_exception(error)
+                    else:
+                        future.set_result(None)
+        except Exception as e:
+            # fail the writes of a flush that died, rather than leave them waiting forever
+            for _, future in batch + list(self._pending):
+                if not future.done():
+                    future.set_exception(e)
+            self._pending.clear()
+            raise
+        finally:
+            self._flushing = False
@@ -0,0 +1,208 @@
+import asyncio
+import logging
+import os
+from typing import Any, Dict, List, Optional, Tuple
+from pymongo.errors import DuplicateKeyError
+from models.models import QueryJob, JobStatus
+from models.schemas import PromptCreate
+from db.db_jobs import create_job, get_job, claim_next_job, complete_job, fail_job, renew_job_lock, count_queued_jobs, idempotent_job_id, JOB_LOCK_TIMEOUT
+from db.db_idempotency import IdempotencyKeyMismatch
+from utils.anonymise import anonymise_async
+from utils.errors import create_query_error_response
+from utils.pipeline import run_query, hash_query
+from utils.scheduler import Priority
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_QUEUE_LIMIT = int(os.getenv('JOB_QUEUE_LIMIT', '1000'))
+# Seconds a job may spend in rate limit admission and the LLM call
+JOB_TIMEOUT = float(os.getenv('JOB_TIMEOUT', '120'))
+# A running job renews its lock this often, so it is only resumed by another worker once its own worker is gone
+JOB_HEARTBEAT_INTERVAL = float(os.getenv('JOB_HEARTBEAT_INTERVAL', '30'))
+# Idle workers check Mongo this often for jobs queued by other processes or left over from a restart
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '2'))
+
+FINISHED_STATUSES = (JobStatus.completed, JobStatus.failed)
+
+class JobQueueFull(Exception):
+    pass
+
+class JobWorkerPool:
+    """
+    Runs queued query jobs on a bounded number of worker tasks.
+
+    Jobs live in Mongo, so jobs queued before a restart, or by another process, are picked up by
+    polling. A running job's worker renews its lock every `heartbeat_interval`, and a job whose
+    worker died is resumed once its lock is older than `lock_timeout`. A resumed job's turn is
+    saved at most once, see run_query.
+    """
+
+    def __init__(self, workers: int, queue_limit: int, job_timeout: float, poll_interval: float, heartbeat_interval: float, lock_timeout: float) -> None:
+        if heartbeat_interval >= lock_timeout:
+            raise ValueError(f"JOB_HEARTBEAT_INTERVAL ({heartbeat_interval}s) must be shorter than JOB_LOCK_TIMEOUT ({lock_timeout}s)")
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.job_timeout = job_timeout
+        self.poll_interval = poll_interval
+        self.heartbeat_interval = heartbeat_interval
+        self._tasks: List[asyncio.Task] = []
+        self._wakeup = asyncio.Event()
+        # job id -> [event set when the job finishes, number of waiters]
+        self._waiters: Dict[str, List[Any]] = {}
+        self.busy = 0
+        self.completed = 0
+        self.failed = 0
+        self.queue_seconds = 0.0
+        self.run_seconds = 0.0
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+        logger.info(f"Started {self.workers} query job workers")
+
+    async def stop(self) -> None:
+        """Stop the workers, jobs they were running are resumed once their locks time out."""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, conversation_id: str, query: PromptCreate, force_cache: bool = False, idempotency_key: Optional[str] = None) -> Tuple[QueryJob, bool]:
+        """
+        Queue a query for the workers
+
+        The query is anonymised before it is stored with the job, and not again when the job runs.
+        Retries with the same Idempotency-Key get the job the first request queued.
+
+        Returns:
+          Tuple[QueryJob, bool]: The job, and whether it was queued by an earlier request with the same key
+
+        Raises:
+          - JobQueueFull: If JOB_QUEUE_LIMIT jobs are already waiting
+          - IdempotencyKeyMismatch: If the key was already used with a different request
+        """
+        job_id = request_hash = None
+        if idempotency_key is not None:
+            job_id, request_hash = idempotent_job_id(conversation_id, idempotency_key), hash_query(query, force_cache)
+            existing = await get_job(job_id)
+            if existing is not None:
+                return self._replay(existing, request_hash, idempotency_key), True
+
+        if await count_queued_jobs() >= self.queue_limit:
+            raise JobQueueFull(f"{self.queue_limit} query jobs are already queued")
+        content = await anonymise_async(query.content, query.role)
+        try:
+            job = await create_job(conversation_id, query.role, content, force_cache, job_id, request_hash)
+        except DuplicateKeyError:
+            # a concurrent retry queued the job first
+            return self._replay(await get_job(job_id), request_hash, idempotency_key), True
+        self._wakeup.set()
+        return job, False
+
+    def _replay(self, job: QueryJob, request_hash: str, idempotency_key: str) -> QueryJob:
+        if job.request_hash != request_hash:
+            raise IdempotencyKeyMismatch(f"Idempotency key {idempotency_key} was already used with a different request")
+        return job
+
+    async def wait(self, job_id: str, timeout: float) -> Optional[QueryJob]:
+        """
+        Long-poll a job until it finishes or the timeout passes
+
+        Jobs run by this process wake the waiter as soon as they finish, jobs run by other
+        processes are noticed within JOB_POLL_INTERVAL.
+
+        Returns:
+          Optional[QueryJob]: The job as it is when it finished or the timeout passed, None if it does not exist
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        waiter = self._waiters.setdefault(job_id, [asyncio.Event(), 0])
+        waiter[1] += 1
+        try:
+            while True:
+                job = await get_job(job_id)
+                remaining = deadline - loop.time()
+                if job is None or job.status in FINISHED_STATUSES or remaining <= 0:
+                    return job
+                try:
+                    await asyncio.wait_for(waiter[0].wait(), min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            waiter[1] -= 1
+            if waiter[1] == 0 and self._waiters.get(job_id) is waiter:
+                del self._waiters[job_id]
+
+    async def stats(self) -> Dict[str, float]:
+        finished = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "busy": self.busy,
+            "queued": await count_queued_jobs(),
+            "queue_limit": self.queue_limit,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_queue_seconds": self.queue_seconds / finished if finished else 0.0,
+            "avg_run_seconds": self.run_seconds / finished if finished else 0.0
+        }
+
+    async def _work(self) -> None:
+        while True:
+            try:
+                # clear before claiming, so a job queued after an empty claim still wakes the worker
+                self._wakeup.clear()
+                job = await claim_next_job()
+                if job is None:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error running query job: {str(e)}")
+                await asyncio.sleep(self.poll_interval)
+
+    async def _keep_locked(self, job: QueryJob) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            if not await renew_job_lock(job.id, job.attempts):
+                logger.warning(f"Query job {job.id} was resumed by another worker")
+                return
+
+    async def _run(self, job: QueryJob) -> None:
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        self.busy += 1
+        heartbeat = asyncio.ensure_future(self._keep_locked(job))
+        try:
+            query = PromptCreate(content=job.content, role=job.role)
+            # the timeout stops before the turn is persisted, a job never fails after storing its response,
+            # and the job id keys the turn, so a resumed job does not store it again
+            prompt_response, headers = await run_query(
+                job.conversation_id, query, job.force_cache, Priority.background, anonymised=True, timeout=self.job_timeout, turn_id=job.id
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Query job {job.id} failed: {str(e)}")
+            await fail_job(job.id, job.attempts, create_query_error_response(job.conversation_id, e).dict())
+            self.failed += 1
+        else:
+            await complete_job(job.id, job.attempts, prompt_response.content, headers)
+            self.completed += 1
+        finally:
+            heartbeat.cancel()
+            self.busy -= 1
+        self.queue_seconds += (job.started_at - job.created_at).total_seconds()
+        self.run_seconds += loop.time() - started
+        logger.info(f"Query job {job.id} finished in {loop.time() - started:.2f}s after {(job.started_at - job.created_at).total_seconds():.2f}s queued")
+
+        waiter = self._waiters.get(job.id)
+        if waiter is not None:
+            waiter[0].set()
+
+job_pool = JobWorkerPool(JOB_WORKERS, JOB_QUEUE_LIMIT, JOB_TIMEOUT, JOB_POLL_INTERVAL, JOB_HEARTBEAT_INTERVAL, JOB_LOCK_TIMEOUT)
@@ -0,0 +1,50 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional
+
+class ConcurrencyLimiter:
+    """
+    Caps the number of concurrent operations globally and per key.
+
+    Per-key semaphores are created on demand and dropped again once no
+    caller holds or waits on them, so memory stays bounded by the number
+    of keys that are currently active.
+    """
+
+    def __init__(self, global_limit: int, per_key_limit: int) -> None:
+        self.global_limit = global_limit
+        self.per_key_limit = per_key_limit
+        self._global = asyncio.Semaphore(global_limit)
+        # key -> [semaphore, number of holders and waiters]
+        self._per_key: Dict[str, List] = {}
+
+    @property
+    def in_flight(self) -> int:
+        """Number of operations currently holding a global slot."""
+        return self.global_limit - self._global._value
+
+    @asynccontextmanager
+    async def slot(self, key: Optional[str] = None) -> AsyncIterator[None]:
+        """
+        Wait for a free slot for the given key, then for a global slot.
+
+        Args:
+          key (Optional[str]): The key to limit on, e.g. a conversation id. No per-key limit is applied when None.
+        """
+        if key is None:
+            async with self._global:
+                yield
+            return
+
+        entry = self._per_key.get(key)
+        if entry is None:
+            entry = self._per_key[key] = [asyncio.Semaphore(self.per_key_limit), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._global:
+                    yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._per_key.pop(key, None)
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+logger = logging.getLogger(__name__)
+
+class Mailboxes:
+    """
+    Runs work for each key one item at a time, in submission order, on a task owned by that key.
+
+    Work for different keys runs in parallel. A key's task and queue are created on its first
+    submission and evicted once the queue has been idle for `idle_timeout` seconds, so memory
+    is bounded by the number of recently active keys.
+    """
+
+    def __init__(self, idle_timeout: float) -> None:
+        self.idle_timeout = idle_timeout
+        self._queues: Dict[Hashable, asyncio.Queue] = {}
+        self._workers: Dict[Hashable, asyncio.Task] = {}
+        self.processed = 0
+
+    def __len__(self) -> int:
+        return len(self._queues)
+
+    @property
+    def queued(self) -> int:
+        return sum(queue.qsize() for queue in self._queues.values())
+
+    def submit(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        """
+        Queue fn behind the work already submitted for the key
+
+        Args:
+          key (Hashable): Identifies the mailbox, work with the same key never overlaps
+          fn (Callable[[], Awaitable[Any]]): Starts the work once the previous work for the key has finished
+
+        Returns:
+          asyncio.Future: Resolves to fn's result. Cancelling it before fn starts drops the work
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(key)
+        # a worker only finishes early when its event loop is shutting down
+        if queue is None or self._workers[key].done():
+            queue = asyncio.Queue()
+            self._queues[key] = queue
+            self._workers[key] = asyncio.ensure_future(self._run(key, queue))
+        queue.put_nowait((fn, future))
+        return future
+
+    async def _run(self, key: Hashable, queue: "asyncio.Queue[Tuple[Callable[[], Awaitable[Any]], asyncio.Future]]") -> None:
+        try:
+            await self._drain(key, queue)
+        finally:
+            if self._queues.get(key) is queue:
+                del self._queues[key]
+                del self._workers[key]
+            # fail the work that will never run instead of leaving its callers waiting
+            while not queue.empty():
+                _, future = queue.get_nowait()
+                if not future.done():
+                    future.cancel()
+
+    async def _drain(self, key: Hashable, queue: "asyncio.Queue[Tuple[Callable[[], Awaitable[Any]], asyncio.Future]]") -> None:
+        while True:
+            try:
+                fn, future = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                # submit never yields between looking up and filling a queue, so an empty queue stays empty
+                if queue.empty():
+                    return
+                continue
+
+            if future.cancelled():
+                continue
+            try:
+                result = await fn()
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                else:
+                    logger.error(f"Error in mailbox {key}: {str(e)}")
+            else:
+                if not future.done():
+                    future.set_result(result)
+            self.processed += 1
@@ -0,0 +1,298 @@
+import asyncio
+import threading
+import time
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+from pymongo import monitoring
+
+# Upper bounds in seconds, from a cached lookup to a slow LLM call
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+StatsSamples = List[Tuple[Dict[str, str], Dict[str, Any]]]
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def format_labels(labels: Iterable[Tuple[str, str]]) -> str:
+    pairs = ",".join(f'{name}="{escape_label_value(str(value))}"' for name, value in labels)
+    return "{" + pairs + "}" if pairs else ""
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Metric(ABC):
+    """A metric with one child per combination of label values, created on first use."""
+
+    type = ""
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], Any] = {}
+
+    def labels(self, *values: str) -> Any:
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} takes labels {', '.join(self.labelnames)}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    def reset(self) -> None:
+        self._children.clear()
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render_child(list(zip(self.labelnames, values)), child))
+        return lines
+
+    @abstractmethod
+    def _new_child(self) -> Any:
+        """Create the child that holds the value of one combination of label values."""
+
+    def _render_child(self, labels: List[Tuple[str, str]], child: Any) -> List[str]:
+        return [f"{self.name}{format_labels(labels)} {format_value(child.value)}"]
+
+class CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self) -> None:
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+class Counter(Metric):
+    type = "counter"
+
+    def _new_child(self) -> CounterChild:
+        return CounterChild()
+
+class GaugeChild(CounterChild):
+    __slots__ = ()
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def _new_child(self) -> GaugeChild:
+        return GaugeChild()
+
+class HistogramChild:
+    __slots__ = ("upper_bounds", "counts", "count", "sum", "max")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]) -> None:
+        self.upper_bounds = upper_bounds
+        # one count per bucket, the last one for values above every bound
+        self.counts = [0] * (len(upper_bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def time(self) -> "Timer":
+        return Timer(self)
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else 0.0
+
+class Timer:
+    """Observes the seconds spent in a with block, including blocks that raise."""
+
+    __slots__ = ("child", "started")
+
+    def __init__(self, child: HistogramChild) -> None:
+        self.child = child
+
+    def __enter__(self) -> "Timer":
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.child.observe(time.perf_counter() - self.started)
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labelnames)
+        self.upper_bounds = tuple(sorted(buckets))
+
+    def time(self, *values: str) -> Timer:
+        return Timer(self.labels(*values))
+
+    def _new_child(self) -> HistogramChild:
+        return HistogramChild(self.upper_bounds)
+
+    def _render_child(self, labels: List[Tuple[str, str]], child: HistogramChild) -> List[str]:
+        lines = []
+        cumulative = 0
+        for upper_bound, count in zip(self.upper_bounds + (float("inf"),), child.counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{format_labels(labels + [('le', format_value(upper_bound))])} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(child.sum)}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {child.count}")
+        return lines
+
+class StatsCollector:
+    """
+    Exports the numeric values of stats dicts as `{prefix}_{key}` samples, read when the metrics are rendered
+
+    The stats mix levels and running totals, so they are exported untyped.
+    """
+
+    def __init__(self, prefix: str, help: str, collect: Callable[[], Union[StatsSamples, Awaitable[StatsSamples]]]) -> None:
+        self.prefix = prefix
+        self.help = help
+        self.collect = collect
+
+    async def render(self) -> List[str]:
+        samples = self.collect()
+        if asyncio.iscoroutine(samples):
+            samples = await samples
+        by_name: Dict[str, List[str]] = {}
+        for labels, stats in samples:
+            for key, value in stats.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                name = f"{self.prefix}_{key}"
+                by_name.setdefault(name, []).append(f"{name}{format_labels(sorted(labels.items()))} {format_value(value)}")
+        lines = []
+        for name, samples_lines in by_name.items():
+            lines.extend([f"# HELP {name} {self.help}", f"# TYPE {name} untyped", *samples_lines])
+        return lines
+
+class MetricsRegistry:
+    """
+    The process's metrics, rendered in the Prometheus text format
+
+    Metrics are updated in place on the hot path without locks, which is safe as they are only
+    updated from the event loop. Components that already keep stats are read at render time.
+    """
+
+    def __init__(self) -> None:
+        self._metrics: List[Metric] = []
+        self._collectors: List[StatsCollector] = []
+
+    def register(self, metric: Any) -> Any:
+        self._metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix: str, help: str, collect: Callable[[], Union[StatsSamples, Awaitable[StatsSamples]]]) -> None:
+        self._collectors.append(StatsCollector(prefix, help, collect))
+
+    def reset(self) -> None:
+        """Drop every observation, so a test or benchmark measures only its own work."""
+        for metric in self._metrics:
+            metric.reset()
+
+    async def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            lines.extend(await collector.render())
+        return "\n".join(lines) + "\n"
+
+registry = MetricsRegistry()
+
+query_stage_seconds: Histogram = registry.register(Histogram(
+    "query_stage_seconds", "Seconds spent in each stage of the query pipeline", ("stage",)
+))
+mongo_command_seconds: Histogram = registry.register(Histogram(
+    "mongo_command_seconds", "Seconds MongoDB commands took, by command and collection", ("command", "collection")
+))
+mongo_command_failures: Counter = registry.register(Counter(
+    "mongo_command_failures_total", "MongoDB commands that failed, by command and collection", ("command", "collection")
+))
+llm_tokens: Counter = registry.register(Counter(
+    "llm_tokens_total", "Tokens sent to and generated by the LLM, by provider and model", ("model", "kind")
+))
+http_requests_in_flight: Gauge = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests being handled, streamed responses until their last chunk is sent"
+))
+http_request_seconds: Histogram = registry.register(Histogram(
+    "http_request_seconds", "Seconds spent handling HTTP requests, by route template, method and status", ("route", "method", "status")
+))
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """
+    Times every MongoDB command the client sends
+
+    Motor runs commands on its worker threads, so the listener takes a lock to update the metrics.
+    """
+
+    def __init__(self, seconds: Histogram, failures: Counter) -> None:
+        self.seconds = seconds
+        self.failures = failures
+        self._lock = threading.Lock()
+        # (connection, request id) -> collection of the commands in progress
+        self._collections: Dict[Tuple[Any, int], str] = {}
+
+    def started(self, event: monitoring.CommandStartedEvent) -> None:
+        collection = event.command.get(event.command_name)
+        if not isinstance(collection, str):
+            # getMore names the cursor, other commands name no collection
+            collection = event.command.get("collection", "")
+        with self._lock:
+            self._collections[(event.connection_id, event.request_id)] = collection
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent) -> None:
+        self._finish(event, failed=False)
+
+    def failed(self, event: monitoring.CommandFailedEvent) -> None:
+        self._finish(event, failed=True)
+
+    def _finish(self, event: Any, failed: bool) -> None:
+        with self._lock:
+            collection = self._collections.pop((event.connection_id, event.request_id), "")
+            self.seconds.labels(event.command_name, collection).observe(event.duration_micros / 1e6)
+            if failed:
+                self.failures.labels(event.command_name, collection).inc()
+
+mongo_command_metrics = MongoCommandMetrics(mongo_command_seconds, mongo_command_failures)
+
+class MetricsMiddleware:
+    """Counts the HTTP requests in flight and times each request, until its last body chunk is sent."""
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status: List[Optional[int]] = [None]
+
+        async def send_with_status(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        in_flight = http_requests_in_flight.labels()
+        in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            in_flight.dec()
+            # the router stores the matched route in the scope, unmatched paths share one label
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_request_seconds.labels(route, scope["method"], str(status[0] or 500)).observe(time.perf_counter() - started)
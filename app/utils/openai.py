@@ -1,26 +1,229 @@
+import asyncio
 import os
-from openai import OpenAI
-from models.schemas import ConversationFull, PromptCreate
+import httpx
+import logging
+import openai
+from typing import Any, AsyncIterator, Dict, List, Tuple
+from openai import AsyncOpenAI
+from models.schemas import ConversationFull, PromptCreate, ROUTING_PARAMS
+from utils.providers import LLMProvider, OpenAIProvider, ProviderError, parse_size_routes, select_route
+from utils.fake_llm import FakeLLM, FakeProvider
+from utils.limiter import ConcurrencyLimiter
+from utils.scheduler import AdmissionScheduler
+from utils.resilience import CircuitBreaker, CircuitOpenError, Hedger
+
+logger = logging.getLogger(__name__)
 
 class OpenAIException(Exception):
     pass
 
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# The provider used when a conversation does not pick one with its `provider` param: openai or fake
+LLM_PROVIDER = os.getenv('LLM_PROVIDER', 'openai')
+# Send prompts to a cheaper or faster model by size, e.g. "2000=openai:gpt-4o-mini,16000=openai:gpt-4o"
+LLM_SIZE_ROUTES = parse_size_routes(os.getenv('LLM_SIZE_ROUTES', ''))
+OPENAI_MODEL = os.getenv('OPENAI_MODEL', 'gpt-3.5-turbo')
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT', '60'))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv('OPENAI_CONNECT_TIMEOUT', '5'))
+OPENAI_MAX_RETRIES = int(os.getenv('OPENAI_MAX_RETRIES', '2'))
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS', '500'))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('OPENAI_MAX_KEEPALIVE_CONNECTIONS', '100'))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv('OPENAI_KEEPALIVE_EXPIRY', '30'))
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '256'))
+OPENAI_MAX_CONCURRENCY_PER_CONVERSATION = int(os.getenv('OPENAI_MAX_CONCURRENCY_PER_CONVERSATION', '2'))
+# Starting rate limits, replaced by the x-ratelimit-* headers of the first response
+OPENAI_REQUESTS_PER_MINUTE = float(os.getenv('OPENAI_REQUESTS_PER_MINUTE', '3500'))
+OPENAI_TOKENS_PER_MINUTE = float(os.getenv('OPENAI_TOKENS_PER_MINUTE', '90000'))
+OPENAI_ADMISSION_MAX_QUEUE = int(os.getenv('OPENAI_ADMISSION_MAX_QUEUE', '1000'))
+# Send a second request when one is slower than this percentile of recent requests
+OPENAI_HEDGE_ENABLED = os.getenv('OPENAI_HEDGE_ENABLED', 'false').lower() == 'true'
+OPENAI_HEDGE_PERCENTILE = float(os.getenv('OPENAI_HEDGE_PERCENTILE', '95'))
+OPENAI_HEDGE_MIN_SAMPLES = int(os.getenv('OPENAI_HEDGE_MIN_SAMPLES', '20'))
+OPENAI_HEDGE_WINDOW = int(os.getenv('OPENAI_HEDGE_WINDOW', '1000'))
+# Fail fast for OPENAI_BREAKER_RECOVERY_TIMEOUT seconds after this many consecutive failed calls to a provider
+OPENAI_BREAKER_FAILURE_THRESHOLD = int(os.getenv('OPENAI_BREAKER_FAILURE_THRESHOLD', '5'))
+OPENAI_BREAKER_RECOVERY_TIMEOUT = float(os.getenv('OPENAI_BREAKER_RECOVERY_TIMEOUT', '30'))
+OPENAI_BREAKER_HALF_OPEN_CALLS = int(os.getenv('OPENAI_BREAKER_HALF_OPEN_CALLS', '1'))
+
+# Store the client globally but don't initialize it immediately
+client = None
+
+limiter = ConcurrencyLimiter(OPENAI_MAX_CONCURRENCY, OPENAI_MAX_CONCURRENCY_PER_CONVERSATION)
+scheduler = AdmissionScheduler(OPENAI_REQUESTS_PER_MINUTE, OPENAI_TOKENS_PER_MINUTE, OPENAI_ADMISSION_MAX_QUEUE)
+
+providers: Dict[str, LLMProvider] = {
+  "openai": OpenAIProvider(lambda: get_client(), OPENAI_MODEL),
+  "fake": FakeProvider(FakeLLM())
+}
+# one breaker per provider, so an outage of one does not stop the others
+breakers: Dict[str, CircuitBreaker] = {}
+# one latency window per provider and model, as their latencies differ widely
+hedgers: Dict[str, Hedger] = {}
+
+def is_provider_failure(error: BaseException) -> bool:
+  """
+  Whether an error means the API is down or overloaded, rather than the request being rejected
+  """
+  if isinstance(error, (openai.APIStatusError, ProviderError)):
+    return error.status_code >= 500
+  return isinstance(error, (openai.APIConnectionError, httpx.TransportError, asyncio.TimeoutError))
 
-def generate_response(conversation: ConversationFull) -> str:
+def get_breaker(provider: str) -> CircuitBreaker:
+  if provider not in breakers:
+    breakers[provider] = CircuitBreaker(OPENAI_BREAKER_FAILURE_THRESHOLD, OPENAI_BREAKER_RECOVERY_TIMEOUT, OPENAI_BREAKER_HALF_OPEN_CALLS, is_provider_failure)
+  return breakers[provider]
+
+def get_hedger(model_key: str) -> Hedger:
+  if model_key not in hedgers:
+    hedgers[model_key] = Hedger(OPENAI_HEDGE_PERCENTILE, OPENAI_HEDGE_MIN_SAMPLES, OPENAI_HEDGE_WINDOW)
+  return hedgers[model_key]
+
+def get_client() -> AsyncOpenAI:
+  """
+  Lazily initialize the async OpenAI client.
+  The client shares one pooled httpx connection pool with keep-alive across all requests.
+  """
+  global client
+  if client is None:
+    http_client = httpx.AsyncClient(
+      limits=httpx.Limits(
+        max_connections=OPENAI_MAX_CONNECTIONS,
+        max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+      ),
+      timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+    )
+    client = AsyncOpenAI(
+      api_key=os.getenv('OPENAI_API_KEY'),
+      http_client=http_client,
+      max_retries=OPENAI_MAX_RETRIES
+    )
+  return client
+
+async def close_client() -> None:
+  global client
+  if client is not None:
+    await client.close()
+    client = None
+
+def build_messages_list(conversation: ConversationFull) -> List[Dict[str, str]]:
+  """
+  Build the chat messages payload sent to the LLM from a conversation
+  """
+  return [{"role": message.role, "content": message.content} for message in conversation.messages]
+
+def select_llm(conversation: ConversationFull) -> Tuple[str, str]:
+  """
+  Pick the provider and model for a conversation, see select_route
+
+  Returns:
+    Tuple[str, str]: The provider name and the model
+
+  Raises:
+    - OpenAIException: If the conversation picks an unknown provider
+  """
+  prompt_tokens = sum(message.tokens for message in conversation.messages)
+  try:
+    return select_route(conversation.params, prompt_tokens, LLM_PROVIDER, LLM_SIZE_ROUTES, providers)
+  except ProviderError as e:
+    raise OpenAIException(str(e))
+
+def get_model_key(conversation: ConversationFull) -> str:
+  """
+  Name the provider and model a conversation's completion comes from, e.g. "openai:gpt-3.5-turbo"
+  """
+  return ":".join(select_llm(conversation))
+
+def get_api_params(conversation: ConversationFull) -> Dict[str, Any]:
+  return {name: value for name, value in conversation.params.items() if name not in ROUTING_PARAMS}
+
+def observe_rate_limits(error: Exception) -> None:
+  """
+  Feed the rate limit headers of a failed API call to the admission scheduler
+  """
+  response = getattr(error, "response", None)
+  if isinstance(response, httpx.Response):
+    scheduler.observe_headers(response.headers, rate_limited=response.status_code == 429)
+
+async def generate_response(conversation: ConversationFull) -> PromptCreate:
   """
   Generate a response from the LLM
+
+  The provider and model come from the conversation's `provider` and `model` params, LLM_SIZE_ROUTES
+  or LLM_PROVIDER. Waits for a free slot in the global and per-conversation concurrency limits before
+  calling the provider, so the event loop stays free for other requests while the completion is in
+  flight. The response's rate limit headers are passed on to the admission scheduler.
+
+  With OPENAI_HEDGE_ENABLED, a call slower than OPENAI_HEDGE_PERCENTILE of recent calls to the same
+  model is hedged with a second one, taking its own concurrency slot, and the first to finish is used.
+  Calls fail fast while the provider's circuit breaker is open.
+
+  Args:
+    conversation (ConversationFull): The conversation whose messages are sent to the LLM
+
+  Returns:
+    PromptCreate: The assistant's response
+
+  Raises:
+    - CircuitOpenError: If the provider is failing and its circuit breaker is open
+    - OpenAIException: If the LLM call failed
   """
 
-  messages_list = [{"role": message.role, "content": message.content} for message in conversation.messages]
+  messages_list = build_messages_list(conversation)
+  provider_name, model = select_llm(conversation)
+  provider = providers[provider_name]
+  params = get_api_params(conversation)
+
+  async def call_provider():
+    async with limiter.slot(conversation.id):
+      return await provider.complete(model, messages_list, params)
 
   try:
-    response = client.chat.completions.create(
-      model="gpt-3.5-turbo",
-      messages=messages_list,
-      **conversation.params
-    )
-    return PromptCreate(content=response.choices[0].message.content.strip(), role="assistant")
+    async with get_breaker(provider_name).guard():
+      if OPENAI_HEDGE_ENABLED:
+        content, headers = await get_hedger(f"{provider_name}:{model}").call(call_provider)
+      else:
+        content, headers = await call_provider()
+    scheduler.observe_headers(headers)
+    return PromptCreate(content=content.strip(), role="assistant")
+  except CircuitOpenError:
+    raise
   except Exception as e:
-    print(f'Error generating response: {e}')
+    observe_rate_limits(e)
+    logger.exception("Error generating response")
     raise OpenAIException(f"Error generating response: {e}")
+
+async def stream_response(conversation: ConversationFull) -> AsyncIterator[str]:
+  """
+  Stream a response from the LLM, yielding content deltas as the model produces them
+
+  Holds a concurrency slot for the whole lifetime of the stream. Streams are not hedged, but fail
+  fast while the provider's circuit breaker is open.
+
+  Args:
+    conversation (ConversationFull): The conversation whose messages are sent to the LLM
+
+  Yields:
+    str: The next chunk of the assistant's response
+
+  Raises:
+    - CircuitOpenError: If the provider is failing and its circuit breaker is open
+    - OpenAIException: If the LLM call failed
+  """
+
+  messages_list = build_messages_list(conversation)
+
+  try:
+    provider_name, model = select_llm(conversation)
+    async with limiter.slot(conversation.id):
+      # the breaker sees whether the stream opened, a stream cut short midway is not an outage
+      async with get_breaker(provider_name).guard():
+        headers, deltas = await providers[provider_name].open_stream(model, messages_list, get_api_params(conversation))
+      scheduler.observe_headers(headers)
+      async for delta in deltas:
+        yield delta
+  except CircuitOpenError:
+    raise
+  except Exception as e:
+    observe_rate_limits(e)
+    logger.exception("Error streaming response")
+    raise OpenAIException(f"Error streaming response: {e}")
@@ -0,0 +1,409 @@
+from pydantic import BaseModel
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple, Union
+from models.schemas import PromptCreate, PromptRead, ConversationFull, BatchQueryItem
+from db.db_query import build_prompt, save_prompts, turn_prompt_ids, get_turn_response
+from db.db_conversations import get_conversation_full
+from db.db_idempotency import claim_idempotency_key, complete_idempotency_key, release_idempotency_key, get_idempotency_record, IdempotencyKeyMismatch, IdempotencyKeyInProgress
+from models.models import IdempotencyStatus, Prompt
+from utils.openai import generate_response, stream_response, scheduler, get_model_key, select_llm
+from utils.completion_cache import get_cached_completion, set_cached_completion
+from utils.context import build_context, get_completion_reserve, get_token_budget
+from utils.token_counter import TOKENS_PER_REPLY
+from utils.scheduler import Priority
+from utils.singleflight import SingleFlight
+from utils.mailbox import Mailboxes
+from utils.metrics import query_stage_seconds, llm_tokens
+
+class PreparedQuery(BaseModel):
+  conversation: ConversationFull
+  query_prompt: Prompt
+  headers: Dict[str, str]
+  cached_response: Optional[PromptCreate] = None
+  cache_key: Optional[str] = None
+  estimated_tokens: int = 0
+  prompt_tokens: int = 0
+  priority: int = Priority.interactive
+  deadline: Optional[float] = None
+  turn_id: Optional[str] = None
+
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv('IDEMPOTENCY_WAIT_TIMEOUT', '120'))
+IDEMPOTENCY_POLL_INTERVAL = float(os.getenv('IDEMPOTENCY_POLL_INTERVAL', '0.25'))
+# A conversation's mailbox is evicted after it has had no queued turns for this many seconds
+QUERY_MAILBOX_IDLE_TIMEOUT = float(os.getenv('QUERY_MAILBOX_IDLE_TIMEOUT', '60'))
+BATCH_QUERY_CONCURRENCY = int(os.getenv('BATCH_QUERY_CONCURRENCY', '16'))
+# How long a query of each priority may wait for the rate limits, counted from when it arrived
+ADMISSION_MAX_WAIT = {
+  Priority.interactive: float(os.getenv('ADMISSION_INTERACTIVE_MAX_WAIT', '10')),
+  Priority.batch: float(os.getenv('ADMISSION_BATCH_MAX_WAIT', '120')),
+  Priority.background: float(os.getenv('ADMISSION_BACKGROUND_MAX_WAIT', '600'))
+}
+
+query_flights: SingleFlight = SingleFlight()
+idempotency_flights: SingleFlight = SingleFlight()
+# turns of one conversation run one at a time in arrival order, turns of different conversations in parallel
+conversation_mailboxes = Mailboxes(QUERY_MAILBOX_IDLE_TIMEOUT)
+
+# marks the end of a streamed turn's deltas
+STREAM_END = object()
+
+def hash_query(query: PromptCreate, force_cache: bool) -> str:
+  """
+  Hash what makes two requests with the same idempotency key the same request
+  """
+  return hashlib.sha256(json.dumps([query.role, query.content, force_cache]).encode("utf-8")).hexdigest()
+
+def get_admission_deadline(priority: int) -> float:
+  return time.monotonic() + ADMISSION_MAX_WAIT[priority]
+
+async def load_conversation(conversation_id: str) -> ConversationFull:
+  with query_stage_seconds.time("load_conversation"):
+    return await get_conversation_full(conversation_id)
+
+def record_llm_tokens(prepared: PreparedQuery, response_prompt: Prompt) -> None:
+  model_key = get_model_key(prepared.conversation)
+  llm_tokens.labels(model_key, "prompt").inc(prepared.prompt_tokens)
+  llm_tokens.labels(model_key, "completion").inc(response_prompt.tokens)
+
+async def prepare_query(
+    conversation_id: str,
+    query: PromptCreate,
+    force_cache: bool = False,
+    priority: int = Priority.interactive,
+    deadline: Optional[float] = None,
+    anonymised: bool = False,
+    turn_id: Optional[str] = None
+) -> PreparedQuery:
+  """
+  Anonymise the query and assemble what the LLM call needs
+
+  The query is saved together with the response once the turn completes, so prepared queries
+  of the same conversation must complete in order, which the conversation's mailbox guarantees.
+
+  Args:
+    conversation_id (str): The unique identifier for the conversation
+    query (PromptCreate): The prompt object containing the query content
+    force_cache (bool): Use the completion cache even when the conversation samples with a temperature above 0
+    priority (int): The query's admission priority under the LLM rate limits
+    deadline (Optional[float]): time.monotonic() by which the rate limits must admit the query
+    anonymised (bool): The query's content was already anonymised
+    turn_id (Optional[str]): Identifies a turn that may run more than once, its prompts are then saved only once
+
+  Returns:
+    PreparedQuery: The trimmed conversation, the response headers describing the context and cache decisions, any cached
+    completion, and what the rate limits need to admit the query
+
+  Raises:
+    - DocumentNotFound: If the conversation is not found
+    - OpenAIException: If the conversation picks an unknown LLM provider
+  """
+  # anonymise the query while the conversation history is read
+  query_prompt, conversation = await asyncio.gather(
+    build_prompt(conversation_id, query, anonymised=anonymised, prompt_id=turn_prompt_ids(turn_id)[0] if turn_id else None),
+    load_conversation(conversation_id)
+  )
+
+  # append the query to the history and fit the messages into the context window of the model the turn is routed to
+  conversation = conversation.model_copy(update={
+    "messages": [*conversation.messages, PromptRead.model_validate(query_prompt.dict(by_alias=True))]
+  })
+  with query_stage_seconds.time("build_context"):
+    conversation, context_metadata = build_context(conversation, get_token_budget(select_llm(conversation)[1]))
+
+  # reuse an identical earlier completion when possible
+  cached_response, cache_status, cache_key = await get_cached_completion(conversation, get_model_key(conversation), force=force_cache)
+  return PreparedQuery(
+    conversation=conversation,
+    query_prompt=query_prompt,
+    headers={**context_metadata.to_headers(), "X-Cache": cache_status},
+    cached_response=cached_response,
+    cache_key=cache_key,
+    estimated_tokens=context_metadata.prompt_tokens + TOKENS_PER_REPLY + get_completion_reserve(conversation),
+    prompt_tokens=context_metadata.prompt_tokens,
+    priority=priority,
+    deadline=deadline,
+    turn_id=turn_id
+  )
+
+async def admit_query(prepared: PreparedQuery) -> None:
+  """
+  Wait for the LLM rate limits to admit the query, cached completions need no admission
+
+  Raises:
+    - RateLimitExceeded: If the query cannot be admitted before its deadline
+    - AdmissionQueueFull: If too many queries are already waiting for admission
+  """
+  if prepared.cached_response is None:
+    with query_stage_seconds.time("admission"):
+      await scheduler.admit(prepared.estimated_tokens, prepared.priority, prepared.deadline)
+
+async def complete_query(conversation_id: str, prepared: PreparedQuery, timeout: Optional[float] = None) -> PromptCreate:
+  """
+  Query the LLM, unless a cached completion exists, and persist the query and the response
+
+  A query shed by the rate limits is not persisted, so the client can retry it. The timeout only
+  bounds admission and the LLM call, persisting is never cut short, so a turn that timed out has
+  not stored a response.
+
+  Raises:
+    - RateLimitExceeded: If the query cannot be admitted before its deadline
+    - AdmissionQueueFull: If too many queries are already waiting for admission
+    - OpenAIException: If the LLM call failed
+    - asyncio.TimeoutError: If admission and the LLM call took longer than the timeout
+  """
+  loop = asyncio.get_running_loop()
+  started = loop.time()
+  await asyncio.wait_for(admit_query(prepared), timeout)
+  try:
+    if prepared.cached_response is not None:
+      prompt_response = prepared.cached_response
+    else:
+      remaining = None if timeout is None else max(timeout - (loop.time() - started), 0)
+      with query_stage_seconds.time("generate_response"):
+        prompt_response = await asyncio.wait_for(generate_response(prepared.conversation), remaining)
+      await set_cached_completion(prepared.cache_key, get_model_key(prepared.conversation), prompt_response)
+  except Exception:
+    # keep the query in the conversation even though it got no response
+    await save_prompts(conversation_id, [prepared.query_prompt], skip_stored=prepared.turn_id is not None)
+    raise
+
+  # add the query and the response to the conversation in one write
+  response_prompt = await build_prompt(conversation_id, prompt_response, prompt_id=turn_prompt_ids(prepared.turn_id)[1] if prepared.turn_id else None)
+  if prepared.cached_response is None:
+    record_llm_tokens(prepared, response_prompt)
+  await save_prompts(conversation_id, [prepared.query_prompt, response_prompt], skip_stored=prepared.turn_id is not None)
+  return prompt_response
+
+async def complete_query_stream(conversation_id: str, prepared: PreparedQuery) -> AsyncIterator[str]:
+  """
+  Stream the LLM's response deltas, or a cached completion as a single delta, then persist the query and the assembled response
+
+  The caller admits the query under the rate limits first.
+
+  Raises:
+    - OpenAIException: If the LLM call failed
+  """
+  chunks = []
+  try:
+    if prepared.cached_response is not None:
+      chunks.append(prepared.cached_response.content)
+      yield prepared.cached_response.content
+    else:
+      # from the request until the LLM sends the last delta
+      with query_stage_seconds.time("stream_response"):
+        async for delta in stream_response(prepared.conversation):
+          chunks.append(delta)
+          yield delta
+  except Exception:
+    await save_prompts(conversation_id, [prepared.query_prompt])
+    raise
+
+  # add the query and the assembled response to the conversation once the stream has ended
+  prompt_response = PromptCreate(content="".join(chunks).strip(), role="assistant")
+  if prepared.cached_response is None:
+    await set_cached_completion(prepared.cache_key, get_model_key(prepared.conversation), prompt_response)
+  response_prompt = await build_prompt(conversation_id, prompt_response)
+  if prepared.cached_response is None:
+    record_llm_tokens(prepared, response_prompt)
+  await save_prompts(conversation_id, [prepared.query_prompt, response_prompt])
+
+async def open_query_stream(conversation_id: str, query: PromptCreate, force_cache: bool = False) -> Tuple[Dict[str, str], AsyncIterator[str]]:
+  """
+  Queue a streamed turn behind the conversation's earlier turns
+
+  Returns once the query is prepared. The turn runs on the conversation's mailbox, so it still
+  persists the query and the response when the client stops reading the deltas.
+
+  Returns:
+    Tuple[Dict[str, str], AsyncIterator[str]]: The response headers and the LLM's response deltas
+
+  Raises:
+    - DocumentNotFound: If the conversation is not found
+    - RateLimitExceeded: If the query cannot be admitted before its deadline
+    - AdmissionQueueFull: If too many queries are already waiting for admission
+  """
+  deadline = get_admission_deadline(Priority.interactive)
+  prepared_headers: asyncio.Future = asyncio.get_running_loop().create_future()
+  deltas: asyncio.Queue = asyncio.Queue()
+
+  async def turn() -> None:
+    # the client went away while the turn was queued
+    if prepared_headers.cancelled():
+      return
+    try:
+      prepared = await prepare_query(conversation_id, query, force_cache, Priority.interactive, deadline)
+      await admit_query(prepared)
+    except Exception as e:
+      if not prepared_headers.done():
+        prepared_headers.set_exception(e)
+      return
+    if not prepared_headers.done():
+      prepared_headers.set_result(prepared.headers)
+
+    try:
+      async for delta in complete_query_stream(conversation_id, prepared):
+        deltas.put_nowait(delta)
+    except Exception as e:
+      deltas.put_nowait(e)
+    else:
+      deltas.put_nowait(STREAM_END)
+
+  async def read_deltas() -> AsyncIterator[str]:
+    while True:
+      delta = await deltas.get()
+      if delta is STREAM_END:
+        return
+      if isinstance(delta, Exception):
+        raise delta
+      yield delta
+
+  conversation_mailboxes.submit(conversation_id, turn)
+  headers = await prepared_headers
+  return headers, read_deltas()
+
+async def run_query(
+    conversation_id: str,
+    query: PromptCreate,
+    force_cache: bool = False,
+    priority: int = Priority.interactive,
+    anonymised: bool = False,
+    timeout: Optional[float] = None,
+    turn_id: Optional[str] = None
+) -> Tuple[PromptCreate, Dict[str, str]]:
+  """
+  Run the whole query pipeline as one turn on the conversation's mailbox: prepare the query,
+  query the LLM and persist the query and the response
+
+  The query must be admitted by the LLM rate limits within ADMISSION_MAX_WAIT of the priority,
+  counted from now, so time spent waiting for the conversation's earlier turns counts as well.
+  Queries whose content was anonymised before, like those of query jobs, pass `anonymised`.
+  `timeout` bounds admission and the LLM call, see complete_query. A turn that may run more than
+  once, like a resumed query job, passes a `turn_id`: a run after the turn was saved returns the
+  stored response without querying the LLM again, and the turn's prompts are never saved twice.
+
+  Returns:
+    Tuple[PromptCreate, Dict[str, str]]: The assistant's response and the response headers
+  """
+  deadline = get_admission_deadline(priority)
+
+  async def turn() -> Tuple[PromptCreate, Dict[str, str]]:
+    if turn_id is not None:
+      stored_response = await get_turn_response(turn_id)
+      if stored_response is not None:
+        return stored_response, {"X-Turn-Replayed": "true"}
+    prepared = await prepare_query(conversation_id, query, force_cache, priority, deadline, anonymised, turn_id)
+    prompt_response = await complete_query(conversation_id, prepared, timeout)
+    return prompt_response, prepared.headers
+
+  return await conversation_mailboxes.submit(conversation_id, turn)
+
+async def run_query_once(conversation_id: str, query: PromptCreate, force_cache: bool = False) -> Tuple[PromptCreate, Dict[str, str]]:
+  """
+  Run the query pipeline, joining an identical query on the same conversation that is already running
+
+  Double submits and client retries then share one LLM call and persist one user and one assistant message.
+
+  Returns:
+    Tuple[PromptCreate, Dict[str, str]]: The assistant's response and the response headers, with X-Coalesced set for joined queries
+  """
+  key = (conversation_id, query.role, query.content, force_cache)
+  (prompt_response, headers), shared = await query_flights.do(key, lambda: run_query(conversation_id, query, force_cache))
+  if shared:
+    headers = {**headers, "X-Coalesced": "true"}
+  return prompt_response, headers
+
+async def run_query_idempotent(conversation_id: str, query: PromptCreate, idempotency_key: str, force_cache: bool = False) -> Tuple[PromptCreate, Dict[str, str]]:
+  """
+  Run the query pipeline at most once per Idempotency-Key
+
+  The first request with a key runs the pipeline and stores its response. Retries replay the stored
+  response, and retries that arrive while the first request is still running wait for it: in this
+  process by joining its run, in other processes by polling the stored key.
+
+  Args:
+    conversation_id (str): The unique identifier for the conversation
+    query (PromptCreate): The prompt object containing the query content
+    idempotency_key (str): The client's Idempotency-Key header
+    force_cache (bool): Use the completion cache even when the conversation samples with a temperature above 0
+
+  Returns:
+    Tuple[PromptCreate, Dict[str, str]]: The assistant's response and the response headers, with Idempotent-Replayed set for replays
+
+  Raises:
+    - IdempotencyKeyMismatch: If the key was already used with a different request
+    - IdempotencyKeyInProgress: If the request holding the key did not finish within IDEMPOTENCY_WAIT_TIMEOUT
+  """
+  record_id = f"{conversation_id}:{idempotency_key}"
+  request_hash = hash_query(query, force_cache)
+
+  async def run_or_replay() -> Tuple[PromptCreate, Dict[str, str]]:
+    deadline = asyncio.get_running_loop().time() + IDEMPOTENCY_WAIT_TIMEOUT
+    while True:
+      record = await claim_idempotency_key(record_id, request_hash)
+      if record is None:
+        try:
+          prompt_response, headers = await run_query_once(conversation_id, query, force_cache)
+        except BaseException:
+          await release_idempotency_key(record_id)
+          raise
+        await complete_idempotency_key(record_id, prompt_response.content, headers)
+        return prompt_response, headers
+
+      if record.request_hash != request_hash:
+        raise IdempotencyKeyMismatch(f"Idempotency key {idempotency_key} was already used with a different request")
+
+      # another process holds the key, wait until it completes or releases it
+      while record is not None and record.status == IdempotencyStatus.pending:
+        if asyncio.get_running_loop().time() > deadline:
+          raise IdempotencyKeyInProgress(f"Request with idempotency key {idempotency_key} is still in progress")
+        await asyncio.sleep(IDEMPOTENCY_POLL_INTERVAL)
+        record = await get_idempotency_record(record_id)
+
+      if record is not None:
+        return PromptCreate(content=record.response, role="assistant"), {**record.headers, "Idempotent-Replayed": "true"}
+      # the request failed and released the key, try to run it again
+
+  (prompt_response, headers), shared = await idempotency_flights.do(record_id, run_or_replay)
+  if shared:
+    headers = {**headers, "Idempotent-Replayed": "true"}
+  return prompt_response, headers
+
+async def run_query_batch(items: List[BatchQueryItem], force_cache: bool = False, concurrency: int = BATCH_QUERY_CONCURRENCY) -> AsyncIterator[Tuple[int, Union[PromptCreate, Exception]]]:
+  """
+  Run many queries, at most `concurrency` at a time, yielding each result as soon as it is ready
+
+  Queries on the same conversation still take turns in submission order, and the prompts of
+  queries completing together are inserted together. Queries that have not started are
+  cancelled when the caller stops iterating.
+
+  Args:
+    items (List[BatchQueryItem]): The conversations and the prompts to send to them
+    force_cache (bool): Use the completion cache even when the conversations sample with a temperature above 0
+    concurrency (int): The maximum number of queries running at once
+
+  Yields:
+    Tuple[int, Union[PromptCreate, Exception]]: The item's index, and the assistant's response or the error the query failed with
+  """
+  semaphore = asyncio.Semaphore(concurrency)
+
+  async def run_item(index: int, item: BatchQueryItem) -> Tuple[int, Union[PromptCreate, Exception]]:
+    async with semaphore:
+      try:
+        prompt_response, _ = await run_query(item.conversation_id, item.query, force_cache, Priority.batch)
+        return index, prompt_response
+      except Exception as e:
+        return index, e
+
+  pending = {asyncio.ensure_future(run_item(index, item)) for index, item in enumerate(items)}
+  try:
+    while pending:
+      done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+      for task in done:
+        yield task.result()
+  finally:
+    for task in pending:
+      task.cancel()
@@ -0,0 +1,107 @@
+from abc import ABC, abstractmethod
+from typing import Any, AsyncIterator, Callable, Dict, List, Mapping, Optional, Tuple
+from openai import AsyncOpenAI
+
+class ProviderError(Exception):
+    """A failed LLM call, with the HTTP status the provider answered with."""
+
+    def __init__(self, message: str, status_code: int) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+
+class LLMProvider(ABC):
+    """
+    A backend that generates chat completions.
+
+    Providers only make the call. Concurrency limits, rate limit admission, hedging and the
+    circuit breaker are applied around them by utils.openai, the same way for every provider.
+    """
+
+    name = ""
+    default_model = ""
+
+    @abstractmethod
+    async def complete(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Tuple[str, Mapping[str, str]]:
+        """
+        Returns:
+          Tuple[str, Mapping[str, str]]: The completion's content and the response headers
+        """
+
+    @abstractmethod
+    async def open_stream(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Tuple[Mapping[str, str], AsyncIterator[str]]:
+        """
+        Returns:
+          Tuple[Mapping[str, str], AsyncIterator[str]]: The response headers, once the stream is open, and the content deltas
+        """
+
+class OpenAIProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, get_client: Callable[[], AsyncOpenAI], default_model: str) -> None:
+        self.get_client = get_client
+        self.default_model = default_model
+
+    async def complete(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Tuple[str, Mapping[str, str]]:
+        raw_response = await self.get_client().chat.completions.with_raw_response.create(
+            model=model,
+            messages=messages,
+            **params
+        )
+        response = raw_response.parse()
+        return response.choices[0].message.content, raw_response.headers
+
+    async def open_stream(self, model: str, messages: List[Dict[str, str]], params: Dict[str, Any]) -> Tuple[Mapping[str, str], AsyncIterator[str]]:
+        raw_response = await self.get_client().chat.completions.with_raw_response.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            **params
+        )
+        stream = raw_response.parse()
+
+        async def deltas() -> AsyncIterator[str]:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+
+        return raw_response.headers, deltas()
+
+def parse_size_routes(spec: str) -> List[Tuple[int, str, str]]:
+    """
+    Parse size routes such as "2000=openai:gpt-4o-mini,16000=openai:gpt-4o": prompts of up to
+    2000 tokens go to gpt-4o-mini, up to 16000 to gpt-4o, and larger ones to the default model.
+
+    Returns:
+      List[Tuple[int, str, str]]: (max prompt tokens, provider, model), smallest first
+    """
+    routes = []
+    for entry in filter(None, (part.strip() for part in spec.split(","))):
+        max_tokens, target = entry.split("=", 1)
+        provider, _, model = target.partition(":")
+        routes.append((int(max_tokens), provider.strip(), model.strip()))
+    return sorted(routes)
+
+def select_route(params: Mapping[str, Any], prompt_tokens: int, default_provider: str, size_routes: List[Tuple[int, str, str]], providers: Mapping[str, LLMProvider]) -> Tuple[str, str]:
+    """
+    Pick the provider and model for a call
+
+    A conversation's `provider` and `model` params win. Otherwise the first size route the prompt
+    fits in is used, then the default provider. A provider without a model uses its default model.
+
+    Returns:
+      Tuple[str, str]: The provider name and the model
+
+    Raises:
+      - ProviderError: If the provider is not registered
+    """
+    provider: Optional[str] = params.get("provider")
+    model: Optional[str] = params.get("model")
+    if provider is None and model is None:
+        for max_tokens, route_provider, route_model in size_routes:
+            if prompt_tokens <= max_tokens:
+                provider, model = route_provider, route_model or None
+                break
+    provider = provider or default_provider
+    if provider not in providers:
+        raise ProviderError(f"Unknown LLM provider {provider}", 400)
+    return provider, model or providers[provider].default_model
@@ -0,0 +1,191 @@
+import asyncio
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+T = TypeVar("T")
+
+class LatencyTracker:
+    """Keeps the latencies of the most recent calls to estimate a percentile."""
+
+    def __init__(self, window: int) -> None:
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, percentile: float) -> Optional[float]:
+        if not self._samples:
+            return None
+        ordered = sorted(self._samples)
+        index = min(max(math.ceil(percentile / 100 * len(ordered)) - 1, 0), len(ordered) - 1)
+        return ordered[index]
+
+class Hedger:
+    """
+    Hedges calls against tail latency.
+
+    A call still running after the `percentile` of recent call latencies gets a second, identical
+    call, and whichever succeeds first wins while the other is cancelled. Hedging starts once
+    `min_samples` latencies have been seen, so the delay reflects how the dependency behaves.
+    """
+
+    def __init__(self, percentile: float, min_samples: int, window: int) -> None:
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.latencies = LatencyTracker(window)
+        self.calls = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+
+    def delay(self) -> Optional[float]:
+        """Seconds after which a call is hedged, None while there are too few samples."""
+        if len(self.latencies) < self.min_samples:
+            return None
+        return self.latencies.percentile(self.percentile)
+
+    async def _timed(self, call: Callable[[], Awaitable[T]]) -> T:
+        started = time.monotonic()
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            # a call cancelled for being slow took at least this long, leaving it out would bias the percentile down
+            self.latencies.record(time.monotonic() - started)
+            raise
+        self.latencies.record(time.monotonic() - started)
+        return result
+
+    async def call(self, call: Callable[[], Awaitable[T]]) -> T:
+        """
+        Run `call`, starting a second one if the first is slow
+
+        A call that fails before the hedge starts fails straight away, as a second call would most
+        likely fail the same way. Once hedged, a failure of one call waits for the other.
+        """
+        self.calls += 1
+        delay = self.delay()
+        if delay is None:
+            return await self._timed(call)
+
+        first = asyncio.ensure_future(self._timed(call))
+        second = None
+        try:
+            done, _ = await asyncio.wait({first}, timeout=delay)
+            if done:
+                return first.result()
+
+            self.hedged += 1
+            second = asyncio.ensure_future(self._timed(call))
+            pending = {first, second}
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is second:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            first.cancel()
+            if second is not None:
+                second.cancel()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "hedge_wins": self.hedge_wins,
+            "delay": self.delay()
+        }
+
+class CircuitOpenError(Exception):
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """
+    Fails calls fast while a dependency is down.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls are rejected for
+    `recovery_timeout` seconds. Then it is half-open: up to `half_open_max_calls` probe calls go
+    through, the circuit closes again when one succeeds and reopens when one fails.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, recovery_timeout: float, half_open_max_calls: int = 1, is_failure: Callable[[BaseException], bool] = lambda error: True) -> None:
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.is_failure = is_failure
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probes = 0
+        self.rejected = 0
+
+    def _before_call(self) -> None:
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.recovery_timeout - time.monotonic()
+            if remaining > 0:
+                self.rejected += 1
+                raise CircuitOpenError(f"Circuit open after {self.failures} consecutive failures", remaining)
+            self.state = self.HALF_OPEN
+            self.probes = 0
+        if self.state == self.HALF_OPEN:
+            if self.probes >= self.half_open_max_calls:
+                self.rejected += 1
+                raise CircuitOpenError("Circuit half-open, waiting for the probe call", self.recovery_timeout)
+            self.probes += 1
+
+    def _open(self) -> None:
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+    @asynccontextmanager
+    async def guard(self) -> AsyncIterator[None]:
+        """
+        Run a call through the breaker, recording whether it failed
+
+        Raises:
+          - CircuitOpenError: If the circuit is open, without running the call
+        """
+        self._before_call()
+        probing = self.state == self.HALF_OPEN
+        try:
+            yield
+        except asyncio.CancelledError:
+            # a cancelled call says nothing about the dependency
+            if probing and self.state == self.HALF_OPEN:
+                self.probes -= 1
+            raise
+        except Exception as e:
+            if not self.is_failure(e):
+                self.failures = 0
+                if self.state == self.HALF_OPEN:
+                    self.state = self.CLOSED
+                raise
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self._open()
+            raise
+        else:
+            self.failures = 0
+            self.state = self.CLOSED
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.failures,
+            "rejected": self.rejected
+        }
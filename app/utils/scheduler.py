@@ -0,0 +1,244 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import re
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from enum import IntEnum
+from typing import Dict, List, Mapping, Optional
+
+logger = logging.getLogger(__name__)
+
+class Priority(IntEnum):
+    interactive = 0
+    batch = 1
+    background = 2
+
+class AdmissionRejected(Exception):
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class RateLimitExceeded(AdmissionRejected):
+    """The rate limits cannot admit the request before its deadline."""
+
+class AdmissionQueueFull(AdmissionRejected):
+    """Too many requests are already waiting for admission."""
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|s|m|h)")
+DURATION_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+# Back-off after a 429 that says neither when to retry nor when the limits reset
+DEFAULT_RETRY_AFTER = 1.0
+
+def parse_duration(value: str) -> float:
+    """Parse a rate limit reset duration such as "20ms", "1.5s" or "6m0s" into seconds."""
+    return sum(float(amount) * DURATION_SECONDS[unit] for amount, unit in DURATION_PART.findall(value))
+
+def parse_retry_after(value: str) -> Optional[float]:
+    """
+    Parse a Retry-After header, either delay seconds or an HTTP date, into seconds from now
+
+    Returns None when the value is neither.
+    """
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds())
+
+class TokenBucket:
+    """A bucket refilled continuously at `capacity` per minute, the way OpenAI replenishes its limits."""
+
+    def __init__(self, capacity: float) -> None:
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    @property
+    def per_second(self) -> float:
+        return self.capacity / 60
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_second)
+        self.updated = now
+
+    def time_until(self, amount: float, now: float) -> float:
+        """Seconds until `amount` tokens are available, without taking them."""
+        self.refill(now)
+        return max(amount - self.tokens, 0) / self.per_second
+
+    def take(self, amount: float) -> None:
+        self.tokens -= amount
+
+    def sync(self, limit: float, remaining: float, now: float) -> None:
+        """Follow the limit and remaining budget reported by the API, which also counts other clients' usage."""
+        self.refill(now)
+        self.capacity = limit
+        self.tokens = min(self.tokens, remaining)
+
+class AdmissionScheduler:
+    """
+    Admits LLM requests under requests-per-minute and tokens-per-minute token buckets.
+
+    Requests that cannot be admitted straight away queue by priority, then arrival. A request
+    whose deadline cannot be met given the requests queued ahead of it is rejected right away
+    instead of waiting for the deadline to pass.
+    """
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float, max_queue: int) -> None:
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.max_queue = max_queue
+        self.blocked_until = 0.0
+        # [priority, deadline, arrival, tokens, future]
+        self._queue: List[list] = []
+        self._arrivals = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.admitted = 0
+        self.rejected = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def estimate_wait(self, tokens: int, priority: int, now: float) -> float:
+        """Seconds until a new request would be admitted, after the requests queued ahead of it."""
+        ahead = [waiter for waiter in self._queue if waiter[0] <= priority and not waiter[4].done()]
+        return max(
+            self.blocked_until - now,
+            self.requests.time_until(len(ahead) + 1, now),
+            self.tokens.time_until(sum(waiter[3] for waiter in ahead) + tokens, now)
+        )
+
+    async def admit(self, tokens: int, priority: int = Priority.interactive, deadline: Optional[float] = None) -> None:
+        """
+        Wait until the request fits in the rate limits
+
+        Args:
+          tokens (int): Estimated prompt and completion tokens of the request
+          priority (int): Lower values are admitted first
+          deadline (Optional[float]): time.monotonic() by which the request must be admitted
+
+        Raises:
+          - RateLimitExceeded: If the request cannot be admitted before its deadline
+          - AdmissionQueueFull: If max_queue requests are already waiting
+        """
+        now = time.monotonic()
+        wait = self.estimate_wait(tokens, priority, now)
+        if wait <= 0 and not self._queue:
+            self._take(tokens)
+            return
+        if deadline is not None and now + wait > deadline:
+            self.rejected += 1
+            raise RateLimitExceeded(f"Rate limits cannot admit the request within its deadline, estimated wait {wait:.1f}s", wait)
+        if len(self._queue) >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionQueueFull(f"{self.max_queue} requests are already waiting for the rate limits", wait)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, [priority, deadline if deadline is not None else float("inf"), next(self._arrivals), tokens, future])
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.ensure_future(self._dispatch())
+        else:
+            self._wakeup.set()
+        await future
+
+    def observe_headers(self, headers: Mapping[str, str], rate_limited: bool = False) -> None:
+        """
+        Follow the x-ratelimit-* headers of an API response, and back off after a 429
+        """
+        now = time.monotonic()
+        for name, bucket in (("requests", self.requests), ("tokens", self.tokens)):
+            limit, remaining = headers.get(f"x-ratelimit-limit-{name}"), headers.get(f"x-ratelimit-remaining-{name}")
+            if limit is not None and remaining is not None:
+                try:
+                    bucket.sync(float(limit), float(remaining), now)
+                except ValueError:
+                    logger.warning(f"Ignoring malformed x-ratelimit-*-{name} headers: {limit}, {remaining}")
+
+        if rate_limited:
+            retry_after = None
+            if headers.get("retry-after-ms") is not None:
+                try:
+                    retry_after = max(0.0, float(headers["retry-after-ms"])) / 1000
+                except ValueError:
+                    logger.warning(f"Ignoring malformed retry-after-ms header: {headers['retry-after-ms']}")
+            if retry_after is None and headers.get("retry-after") is not None:
+                retry_after = parse_retry_after(headers["retry-after"])
+            if retry_after is None:
+                resets = [headers.get(f"x-ratelimit-reset-{name}") for name in ("requests", "tokens")]
+                resets = [parse_duration(reset) for reset in resets if reset is not None]
+                retry_after = max(resets) if resets else DEFAULT_RETRY_AFTER
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            logger.warning(f"Rate limited by the API, holding admissions for {retry_after:.1f}s")
+
+    def stats(self) -> Dict[str, float]:
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return {
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queued": len(self._queue),
+            "requests_available": self.requests.tokens,
+            "tokens_available": self.tokens.tokens
+        }
+
+    def _take(self, tokens: int) -> None:
+        self.requests.take(1)
+        self.tokens.take(tokens)
+        self.admitted += 1
+
+    def _shed_expired(self, now: float, head_wait: float) -> None:
+        # nobody is admitted before the head, so a deadline before its admission cannot be met
+        kept = []
+        for waiter in self._queue:
+            if waiter[4].done():
+                continue
+            if now + head_wait > waiter[1]:
+                self.rejected += 1
+                waiter[4].set_exception(RateLimitExceeded("Rate limits did not admit the request within its deadline", head_wait))
+                continue
+            kept.append(waiter)
+        if len(kept) != len(self._queue):
+            heapq.heapify(kept)
+            self._queue = kept
+
+    async def _dispatch(self) -> None:
+        while self._queue:
+            _, _, _, tokens, future = self._queue[0]
+            if future.done():
+                heapq.heappop(self._queue)
+                continue
+
+            now = time.monotonic()
+            wait = max(
+                self.blocked_until - now,
+                self.requests.time_until(1, now),
+                # a request larger than the bucket waits for a full bucket and leaves it in debt
+                self.tokens.time_until(min(tokens, self.tokens.capacity), now)
+            )
+            if wait <= 0:
+                heapq.heappop(self._queue)
+                self._take(tokens)
+                future.set_result(None)
+                continue
+
+            self._shed_expired(now, wait)
+            if not self._queue or self._queue[0][4] is not future:
+                continue
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,50 @@
+import asyncio
+from typing import Awaitable, Callable, Dict, Generic, Hashable, Tuple, TypeVar
+
+T = TypeVar("T")
+
+class SingleFlight(Generic[T]):
+    """
+    Coalesces concurrent calls with the same key into one execution whose result is shared.
+
+    The shared call runs in its own task, so a caller that disconnects or is cancelled does
+    not cancel the work the other callers are waiting on.
+    """
+
+    def __init__(self) -> None:
+        self._calls: Dict[Hashable, asyncio.Task] = {}
+        self.executions = 0
+        self.coalesced = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> Tuple[T, bool]:
+        """
+        Run fn, or wait for the identical call that is already running
+
+        Args:
+          key (Hashable): Identifies identical calls
+          fn (Callable[[], Awaitable[T]]): Starts the call when no identical call is running
+
+        Returns:
+          Tuple[T, bool]: The result, and whether it was shared from another caller's execution
+        """
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.executions += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        return await asyncio.shield(task), shared
+
+    def _forget(self, key: Hashable, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # mark the exception as retrieved in case every caller went away
+        if not task.cancelled():
+            task.exception()
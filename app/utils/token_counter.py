@@ -1,20 +1,64 @@
+import asyncio
+import logging
+import os
 import tiktoken
-from models.models import Conversation, Prompt
-from models.schemas import PromptCreate
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import List, Sequence
+from models.schemas import PromptBase
 
-def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
-    """Count the number of tokens in a given text."""
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = "gpt-3.5-turbo"
+
+# ChatML framing: every message is wrapped in <|start|>{role}\n{content}<|end|>\n,
+# and every reply is primed with <|start|>assistant<|message|>
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 3
+
+# Texts shorter than this are encoded inline, the thread hop costs more than encoding them
+TOKENIZER_OFFLOAD_MIN_CHARS = int(os.getenv('TOKENIZER_OFFLOAD_MIN_CHARS', '2000'))
+TOKENIZER_THREADS = int(os.getenv('TOKENIZER_THREADS', '4'))
+
+# tiktoken releases the GIL while encoding, so long messages are encoded in parallel on this pool
+executor = ThreadPoolExecutor(max_workers=TOKENIZER_THREADS, thread_name_prefix="tokenizer")
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = DEFAULT_MODEL) -> tiktoken.Encoding:
+    """Load the encoding for a model once and reuse it for every later call."""
     try:
-        encoder = tiktoken.encoding_for_model(model)
-        return len(encoder.encode(text))
+        return tiktoken.encoding_for_model(model)
     except KeyError:
-        print(f"Warning: model {model} not found. Using cl100k_base encoding.")
-        encoder = tiktoken.get_encoding("cl100k_base")
-        return len(encoder.encode(text))
-
-async def count_message_tokens(message: PromptCreate, model: str = "gpt-3.5-turbo") -> int:
-    """Count tokens for a single message."""
-    tokens = count_tokens(message.content, model)
-    if message.role:
-        tokens += count_tokens(message.role, model)
-    return tokens
\ No newline at end of file
+        logger.warning(f"Model {model} not found, using the cl100k_base encoding")
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Count the number of tokens in a given text."""
+    return len(get_encoding(model).encode(text))
+
+def count_messages_tokens_sync(messages: Sequence[PromptBase], model: str = DEFAULT_MODEL) -> List[int]:
+    """Count the ChatML tokens of each message on the calling thread."""
+    # encode_batch would start a thread pool of its own on every call
+    encoding = get_encoding(model)
+    return [
+        TOKENS_PER_MESSAGE + len(encoding.encode_ordinary(message.content)) + len(encoding.encode_ordinary(message.role))
+        for message in messages
+    ]
+
+async def count_messages_tokens(messages: Sequence[PromptBase], model: str = DEFAULT_MODEL) -> List[int]:
+    """Count the ChatML tokens of each message, off the event loop and in parallel unless the batch is small."""
+    if sum(len(message.content) for message in messages) < TOKENIZER_OFFLOAD_MIN_CHARS:
+        return count_messages_tokens_sync(messages, model)
+    loop = asyncio.get_running_loop()
+    counts = await asyncio.gather(*[
+        loop.run_in_executor(executor, count_messages_tokens_sync, [message], model) for message in messages
+    ])
+    return [count for message_counts in counts for count in message_counts]
+
+async def count_message_tokens(message: PromptBase, model: str = DEFAULT_MODEL) -> int:
+    """Count tokens for a single message, including its ChatML framing."""
+    return (await count_messages_tokens([message], model))[0]
+
+def count_request_tokens(message_tokens: Sequence[int]) -> int:
+    """Count the prompt tokens of a chat request from the token counts of its messages."""
+    return sum(message_tokens) + TOKENS_PER_REPLY